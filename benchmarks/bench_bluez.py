@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+#
+# Bluetooth server scale benchmark
+#
+# Runs the BtServer against the mock org.bluez service (mock_bluez.py) on a
+# private dbus-daemon with 10, 100 and 300 paired hosts and measures:
+# - the profile registration and the connection of all paired clients,
+#   once with immediate and once with slow bluez replies
+# - the client list signalling of all clients becoming alive and switching the active host
+# - the delivery of a device property change storm to the clients
+# There is no radio: the L2CAP connections fail and the clients are then
+# marked alive, so the host switching works on all of them.
+# Requires dbus-daemon and dbus_next.
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import subprocess
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rpi_kvm"))
+
+import dbus_next
+from mock_bluez import MockBluez, ping
+from bt_client import BtClient
+from bt_server import BtServer
+
+DEVICE_COUNTS = [10, 100, 300]
+SLOW_REPLY_DELAY = 0.05
+SWITCH_COUNT = 200
+STORM_CHANGE_COUNT = 2000
+STORM_RATE_HZ = 5000
+
+class ClientsChangeCounter(object):
+    def __init__(self):
+        self.count = 0
+
+    def on_clients_change(self, client_names):
+        self.count += 1
+
+async def wait_until(condition, timeout_s=60):
+    end_time = time.perf_counter() + timeout_s
+    while not condition():
+        if time.perf_counter() > end_time:
+            raise TimeoutError("Benchmark: Condition not reached in time")
+        await asyncio.sleep(0.001)
+
+async def bench_startup(device_count, reply_delay):
+    mock_bluez = MockBluez(device_count, reply_delay)
+    await mock_bluez.start()
+    bt_server = BtServer()
+    start = time.perf_counter()
+    await bt_server._register_bluez_profile()
+    registered = time.perf_counter()
+    await bt_server._connect_to_paired_clients()
+    await wait_until(lambda: len(bt_server._clients) == device_count)
+    connected = time.perf_counter()
+    result = {
+        "name": f"startup ({device_count} hosts, {reply_delay * 1000:.0f} ms replies)",
+        "hosts": device_count,
+        "register_profile_ms": (registered - start) * 1000,
+        "connect_paired_clients_ms": (connected - registered) * 1000,
+    }
+    return result, mock_bluez, bt_server
+
+async def bench_switching(device_count, bt_server):
+    loop = asyncio.get_running_loop()
+    for client in bt_server._clients.values():
+        await wait_until(lambda: client._task is None or client._task.done())
+    counter = ClientsChangeCounter()
+    bt_server.register_on_clients_change_handler(counter)
+    start = time.perf_counter()
+    for client in bt_server._clients.values():
+        # Stands in for an established link - the client counts as alive
+        client._task = loop.create_future()
+        client._notify_alive_change()
+    signalled = time.perf_counter()
+    bt_server.switch_active_host_to(next(iter(bt_server._clients)))
+    switch_start = time.perf_counter()
+    for i in range(SWITCH_COUNT):
+        bt_server.switch_to_next_connected_host()
+        bt_server.get_connected_client_names()
+    switched = time.perf_counter()
+    for client in bt_server._clients.values():
+        client._task.cancel()
+        client._notify_alive_change()
+    return {
+        "name": f"host switching ({device_count} hosts)",
+        "hosts": device_count,
+        "clients_change_signal_ms": (signalled - start) * 1000,
+        "clients_change_signals": counter.count,
+        "switch_us": (switched - switch_start) * 1_000_000 / SWITCH_COUNT,
+    }
+
+def counting_handler(on_properties_changed, received):
+    # dbus_next only accepts handlers with exactly the three signal arguments
+    def count_changes(interface_name, changed_properties, invalidated_properties):
+        received[0] += 1
+        on_properties_changed(interface_name, changed_properties, invalidated_properties)
+    return count_changes
+
+async def bench_storm(device_count, mock_bluez, bt_server):
+    received = [0]
+    for client in bt_server._clients.values():
+        client._bluez_props.off_properties_changed(client._on_properties_changed)
+        client._bluez_props.on_properties_changed(counting_handler(client._on_properties_changed, received))
+    # Each client receives the changes of its own device only
+    start = time.perf_counter()
+    emitted = await mock_bluez.property_storm(STORM_CHANGE_COUNT, STORM_RATE_HZ)
+    await wait_until(lambda: received[0] >= emitted, timeout_s=30)
+    duration_s = time.perf_counter() - start
+    return {
+        "name": f"property storm ({device_count} hosts)",
+        "hosts": device_count,
+        "changes": emitted,
+        "changes_per_s": emitted / duration_s,
+    }
+
+async def close_clients(bt_server):
+    bt_server.stop()
+    for client in bt_server._clients.values():
+        client.stop()
+        # The match rule of the property signals is added without waiting for the reply
+        await ping(client._dbus)
+        client._dbus.disconnect()
+
+async def run_on_bus():
+    results = []
+    for device_count in DEVICE_COUNTS:
+        for reply_delay in (0, SLOW_REPLY_DELAY):
+            result, mock_bluez, bt_server = await bench_startup(device_count, reply_delay)
+            results.append(result)
+            if not reply_delay:
+                results.append(await bench_switching(device_count, bt_server))
+                results.append(await bench_storm(device_count, mock_bluez, bt_server))
+            await close_clients(bt_server)
+            mock_bluez.stop()
+    return results
+
+def run():
+    daemon = subprocess.Popen(["dbus-daemon", "--session", "--nofork", "--print-address"], stdout=subprocess.PIPE, text=True)
+    working_dir = os.getcwd()
+    try:
+        os.environ["DBUS_SESSION_BUS_ADDRESS"] = daemon.stdout.readline().strip()
+        BtClient.BLUEZ_BUS_TYPE = dbus_next.BusType.SESSION
+        # The client order file is written relative to the working directory
+        with tempfile.TemporaryDirectory() as temp_dir:
+            os.mkdir(os.path.join(temp_dir, "conf"))
+            os.chdir(temp_dir)
+            # The daemon is stopped after the event loop, the bus connections of the BtServer are still open
+            return asyncio.run(run_on_bus())
+    finally:
+        os.chdir(working_dir)
+        daemon.terminate()
+        daemon.wait()
+
+def main():
+    for result in run():
+        values = ", ".join(f"{key} {value:.1f}" for key, value in result.items() if key not in ("name", "hosts"))
+        print(f"{result['name']:>38}: {values}")
+
+if __name__ == "__main__":
+    main()
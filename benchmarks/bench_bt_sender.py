@@ -0,0 +1,120 @@
+#!/usr/bin/python3
+#
+# Bluetooth client sender benchmark
+#
+# Drives the interrupt channel sender of BtClient against a local
+# socketpair(AF_UNIX, SOCK_SEQPACKET) standing in for the L2CAP socket and
+# compares it with the former sender loop (asyncio.Queue, wait_for with a
+# timeout per message and a bytes conversion per send). A thread on the other
+# end of the socket pair receives the reports. The CPU time is measured for
+# the event loop thread only, so it covers the producer and the sender.
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rpi_kvm"))
+
+from bt_client import BtClient
+
+REPORT_COUNT = 50000
+BURST_SIZE = 16
+MAX_QUEUED = 32
+
+def keyboard_reports(count):
+    for i in range(count):
+        # alternating press and release of KEY_A
+        yield [0xA1, 1, 0, 0, 4 if i % 2 == 0 else 0, 0, 0, 0, 0, 0]
+
+def start_receiver(receive_socket, count):
+    def receive():
+        for _ in range(count):
+            receive_socket.recv(64)
+    receiver = threading.Thread(target=receive)
+    receiver.start()
+    return receiver
+
+async def wait_for_receiver(receiver):
+    while receiver.is_alive():
+        await asyncio.sleep(0.001)
+
+async def bench_report_queue(count):
+    send_socket, receive_socket = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    send_socket.setblocking(False)
+    client = BtClient("00:00:00:00:00:00")
+    client._name = "Bench"
+    client._interrupt_socket = send_socket
+    client._is_connected = True
+    receiver = start_receiver(receive_socket, count)
+
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+    sender_task = asyncio.create_task(client._send_loop())
+    for index, report in enumerate(keyboard_reports(count)):
+        client._message_queue.put(report)
+        if index % BURST_SIZE == BURST_SIZE - 1:
+            await asyncio.sleep(0)
+            while len(client._message_queue) > MAX_QUEUED:
+                await asyncio.sleep(0)
+    await wait_for_receiver(receiver)
+    result = summarize("report-queue", count, time.perf_counter() - start, time.thread_time() - cpu_start)
+
+    client.stop()
+    await sender_task
+    send_socket.close()
+    receive_socket.close()
+    return result
+
+async def bench_legacy_queue(count):
+    send_socket, receive_socket = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    send_socket.setblocking(False)
+    loop = asyncio.get_running_loop()
+    message_queue = asyncio.Queue()
+    receiver = start_receiver(receive_socket, count)
+
+    async def legacy_send_loop():
+        while True:
+            try:
+                message = await asyncio.wait_for(message_queue.get(), timeout=2)
+                await loop.sock_sendall(send_socket, bytes(message))
+                message_queue.task_done()
+            except asyncio.TimeoutError:
+                pass
+
+    start = time.perf_counter()
+    cpu_start = time.thread_time()
+    sender_task = asyncio.create_task(legacy_send_loop())
+    for index, report in enumerate(keyboard_reports(count)):
+        message_queue.put_nowait(report)
+        if index % BURST_SIZE == BURST_SIZE - 1:
+            await asyncio.sleep(0)
+            while message_queue.qsize() > MAX_QUEUED:
+                await asyncio.sleep(0)
+    await wait_for_receiver(receiver)
+    result = summarize("legacy-queue", count, time.perf_counter() - start, time.thread_time() - cpu_start)
+
+    sender_task.cancel()
+    send_socket.close()
+    receive_socket.close()
+    return result
+
+def summarize(name, count, duration_s, cpu_s):
+    return {
+        "name": name,
+        "reports": count,
+        "sends_per_s": count / duration_s,
+        "cpu_per_report_us": cpu_s * 1_000_000 / count,
+    }
+
+async def run(count=REPORT_COUNT):
+    return [await bench_legacy_queue(count), await bench_report_queue(count)]
+
+def main():
+    for result in asyncio.run(run()):
+        print(f"{result['name']:>15}: {result['sends_per_s']:10.0f} sends/s"
+              f"  cpu {result['cpu_per_report_us']:6.2f} us/report")
+
+if __name__ == "__main__":
+    main()
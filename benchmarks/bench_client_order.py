@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+#
+# Client order benchmark
+#
+# Measures with 10, 100 and 1000 known hosts:
+# - PersistentClientOrder.sort_clients called with the addresses of all hosts in reverse order
+# - HostRing.step, the switch to the next connected host
+# - moving a host one order higher and back, with the ring following the order
+
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rpi_kvm"))
+
+from client_order import PersistentClientOrder, HostRing
+
+CALL_COUNT = 2000
+HOST_COUNTS = [10, 100, 1000]
+
+def create_client_order(host_count):
+    client_order = PersistentClientOrder()
+    # Filled directly - add_client writes the order file on every call
+    for index in range(host_count):
+        client_order.clients[f"00:1A:7D:DA:{index >> 8:02X}:{index & 255:02X}"] = index
+    client_order._index_orders()
+    return client_order
+
+def create_host_ring(client_order):
+    host_ring = HostRing(client_order)
+    for client_address in client_order.clients:
+        host_ring.add(client_address)
+    return host_ring
+
+def change_order(client_order, host_ring, client_address):
+    for changed_address in client_order.change_order_higher(client_address):
+        host_ring.update_order(changed_address)
+    for changed_address in client_order.change_order_lower(client_address):
+        host_ring.update_order(changed_address)
+
+def measure(name, host_count, count, statement):
+    duration_s = min(timeit.repeat(statement, number=count, repeat=3))
+    return {
+        "name": f"{name} ({host_count} hosts)",
+        "hosts": host_count,
+        "calls": count,
+        "us_per_call": duration_s * 1_000_000 / count,
+    }
+
+def run(count=CALL_COUNT):
+    results = []
+    for host_count in HOST_COUNTS:
+        client_order = create_client_order(host_count)
+        client_addresses = list(reversed(client_order.clients.keys()))
+        results.append(measure("sort clients", host_count, count, lambda: client_order.sort_clients(client_addresses)))
+        host_ring = create_host_ring(client_order)
+        first_address = client_addresses[-1]
+        results.append(measure("ring step", host_count, count, lambda: host_ring.step(first_address)))
+        middle_address = client_addresses[host_count // 2]
+        # Each call writes the order file - the writer is kept from writing
+        client_order.save_to_file = lambda: None
+        results.append(measure("change order", host_count, count, lambda: change_order(client_order, host_ring, middle_address)))
+    return results
+
+def main():
+    for result in run():
+        print(f"{result['name']:>28}: {result['us_per_call']:8.2f} us/call")
+
+if __name__ == "__main__":
+    main()
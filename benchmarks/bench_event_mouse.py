@@ -0,0 +1,60 @@
+#!/usr/bin/python3
+#
+# Event mouse benchmark
+#
+# Feeds a high rate stream of relative motion frames (REL_X, REL_Y, a wheel
+# event every 8th frame and SYN_REPORT) through EventMouse._handle_event and
+# commits the frames to a MouseFrameScheduler, like a 1000 Hz gaming mouse
+# does. Measures the cost per evdev event.
+
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rpi_kvm"))
+
+from evdev import InputEvent, ecodes
+from mouse import EventMouse, MouseFrameScheduler
+
+FRAME_COUNT = 50000
+
+class FakeInputDevice(object):
+    path = "/dev/input/event-bench"
+    name = "Benchmark mouse"
+
+def create_frames(count):
+    events = []
+    for i in range(count):
+        sec, usec = divmod(i * 1000, 1_000_000)
+        events.append(InputEvent(sec, usec, ecodes.EV_REL, ecodes.REL_X, 3))
+        events.append(InputEvent(sec, usec, ecodes.EV_REL, ecodes.REL_Y, -2))
+        if i % 8 == 0:
+            events.append(InputEvent(sec, usec, ecodes.EV_REL, ecodes.REL_WHEEL, 1))
+        events.append(InputEvent(sec, usec, ecodes.EV_SYN, ecodes.SYN_REPORT, 0))
+    return events
+
+def run(count=FRAME_COUNT):
+    events = create_frames(count)
+    event_mouse = EventMouse(FakeInputDevice())
+    # Not running - the frames are only committed, sending is not part of the measurement
+    scheduler = MouseFrameScheduler(None, lambda: 0)
+    event_mouse.commit_frame_cb = scheduler.commit_frame
+
+    def handle_events():
+        for event in events:
+            event_mouse._handle_event(event)
+
+    duration_s = min(timeit.repeat(handle_events, number=1, repeat=3))
+    return [{
+        "name": "rel stream",
+        "frames": count,
+        "events": len(events),
+        "ns_per_event": duration_s * 1_000_000_000 / len(events),
+        "events_per_s": len(events) / duration_s,
+    }]
+
+def main():
+    for result in run():
+        print(f"{result['name']:>12}: {result['ns_per_event']:8.1f} ns/event  {result['events_per_s']:10.0f} events/s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+#
+# HID report encoder microbenchmark
+#
+# Measures the cost per report of building sendable bluetooth HID input reports,
+# once as Python lists like kvm_service did before and once packed into the
+# reusable buffers of the HidReportEncoder, optionally including the check
+# for repeated reports.
+
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rpi_kvm"))
+
+from usb_hid_decoder import UsbHidDecoder
+from hid_report_encoder import HidReportEncoder
+
+REPORT_COUNT = 200000
+MODIFIERS = [False, False, False, False, False, False, True, False]
+KEYS = bytes([4, 0, 0, 0, 0, 0])
+KEY_BITMAP = HidReportEncoder.key_bitmap_from_keys(KEYS)
+
+def list_keyboard_report():
+    modifiers_int = UsbHidDecoder.convert_modifier_bit_mask_to_int(MODIFIERS)
+    return bytes([0xA1, 1, modifiers_int, 0, *KEYS])
+
+def list_mouse_report_8bit():
+    return bytes([0xA1, 2, 1, -5 & 255, 7 & 255, 0 & 255, 0 & 255])
+
+def list_mouse_report_16bit():
+    x_pos_word = -500
+    y_pos_word = 700
+    return bytes([0xA1, 3, 1,
+        x_pos_word & 255, (x_pos_word >> 8) & 255,
+        y_pos_word & 255, (y_pos_word >> 8) & 255,
+        0, 0])
+
+def run(count=REPORT_COUNT):
+    encoder = HidReportEncoder()
+    cases = [
+        ("list keyboard", list_keyboard_report),
+        ("encoder keyboard", lambda: encoder.keyboard_report(2, KEYS)),
+        ("encoder keyboard nkro", lambda: encoder.keyboard_nkro_report(2, KEY_BITMAP)),
+        ("encoder keyboard+repeat", lambda: encoder.is_repeated("host", encoder.keyboard_report(2, KEYS))),
+        ("list mouse 8bit", list_mouse_report_8bit),
+        ("encoder mouse 8bit", lambda: encoder.mouse_report_8bit(1, -5, 7, 0, 0)),
+        ("list mouse 16bit", list_mouse_report_16bit),
+        ("encoder mouse 16bit", lambda: encoder.mouse_report_16bit(1, -500, 700, 0, 0)),
+    ]
+    results = []
+    for name, encode in cases:
+        duration_s = min(timeit.repeat(encode, number=count, repeat=3))
+        results.append({
+            "name": name,
+            "reports": count,
+            "ns_per_report": duration_s * 1_000_000_000 / count,
+        })
+    return results
+
+def main():
+    for result in run():
+        print(f"{result['name']:>25}: {result['ns_per_report']:8.1f} ns/report")
+
+if __name__ == "__main__":
+    main()
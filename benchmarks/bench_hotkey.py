@@ -0,0 +1,69 @@
+#!/usr/bin/python3
+#
+# Hotkey matcher benchmark
+#
+# Measures the hotkey evaluation per keyboard report with 1, 10 and 200
+# configured hotkeys. The hotkey trie is compared with a linear scan over
+# all hotkeys like the former detector did (without numpy).
+
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rpi_kvm"))
+
+from settings import Settings
+from hotkey import HotkeyDetector, HotkeyConfig, HotkeyAktion, HotkeyBinding
+
+REPORT_COUNT = 100000
+HOTKEY_COUNTS = [1, 10, 200]
+
+def create_detector(hotkey_count):
+    config = HotkeyConfig(Settings())
+    # The configured next host hotkey plus generated combinations of Ctrl + Alt + key
+    for index in range(hotkey_count - 1):
+        stroke = HotkeyConfig.combination_key(0x05, [4 + index % 50, 0x3A + index // 50, 0, 0, 0, 0])
+        config.bindings.append(HotkeyBinding(HotkeyAktion.IndicateHost, [stroke]))
+    return HotkeyDetector(config)
+
+def create_linear_hotkeys(config):
+    linear_hotkeys = []
+    for binding in config.bindings:
+        modifiers_int, keys = binding.strokes[0]
+        pressed_keys = sorted(key for key in keys if key)
+        linear_hotkeys.append(([modifiers_int, *pressed_keys, *[0] * (6 - len(pressed_keys))], binding))
+    return linear_hotkeys
+
+def linear_evaluate(linear_hotkeys, new_input):
+    for key_combination, action in linear_hotkeys:
+        if key_combination == new_input:
+            return action
+    return None
+
+def run(count=REPORT_COUNT):
+    miss_keys = bytes([0x15, 0, 0, 0, 0, 0])
+    hit_keys = bytes([0, 0, 0x47, 0, 0, 0]) # Next host hotkey in another key slot
+    results = []
+    for hotkey_count in HOTKEY_COUNTS:
+        detector = create_detector(hotkey_count)
+        linear_hotkeys = create_linear_hotkeys(detector._config)
+        cases = [
+            ("trie miss", lambda: detector.evaluate_new_input(0, miss_keys)),
+            ("trie hit", lambda: detector.evaluate_new_input(0, hit_keys)),
+            ("linear miss", lambda: linear_evaluate(linear_hotkeys, [0, *miss_keys])),
+        ]
+        for name, evaluate in cases:
+            duration_s = min(timeit.repeat(evaluate, number=count, repeat=3))
+            results.append({
+                "name": f"{name} ({hotkey_count} hotkeys)",
+                "hotkeys": hotkey_count,
+                "reports": count,
+                "ns_per_report": duration_s * 1_000_000_000 / count,
+            })
+    return results
+
+def main():
+    for result in run():
+        print(f"{result['name']:>28}: {result['ns_per_report']:8.1f} ns/report")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+#
+# Input trace replay benchmark
+#
+# Replays an input trace as fast as possible through the keyboard and mouse
+# event handlers into the report pipeline and measures the events per second
+# and the reports produced, once batched per evdev frame and once with one
+# keyboard report per key change. Without a trace recorded by
+# "input_trace.py record" a generated trace of typing chords and mouse
+# motion is used.
+#
+# Usage: bench_input_replay.py [trace]
+
+import os
+import sys
+import asyncio
+import tempfile
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rpi_kvm"))
+
+from evdev import InputEvent, ecodes
+from input_trace import InputTraceRecorder, InputTraceReplayer
+
+CHORD_COUNT = 2000
+MOTION_FRAME_COUNT = 20000
+# Ctrl + Shift + A pressed in one evdev frame
+CHORD_KEYS = [ecodes.KEY_LEFTCTRL, ecodes.KEY_LEFTSHIFT, ecodes.KEY_A]
+
+def write_generated_trace(path):
+    recorder = InputTraceRecorder(path)
+    record_keyboard_event = recorder.add_keyboard("Generated keyboard")
+    record_mouse_event = recorder.add_mouse("Generated mouse")
+    time_us = 1_000_000
+    def event(event_type, code, value):
+        return InputEvent(time_us // 1_000_000, time_us % 1_000_000, event_type, code, value)
+    for chord_index in range(CHORD_COUNT):
+        for value in (1, 0):
+            time_us += 50_000
+            for key in CHORD_KEYS:
+                record_keyboard_event(event(ecodes.EV_KEY, key, value))
+            record_keyboard_event(event(ecodes.EV_SYN, ecodes.SYN_REPORT, 0))
+    for frame_index in range(MOTION_FRAME_COUNT):
+        time_us += 1_000
+        record_mouse_event(event(ecodes.EV_REL, ecodes.REL_X, 3))
+        record_mouse_event(event(ecodes.EV_REL, ecodes.REL_Y, -2))
+        record_mouse_event(event(ecodes.EV_SYN, ecodes.SYN_REPORT, 0))
+    recorder.close()
+
+def replay(trace_path):
+    results = []
+    for name, batch_frames in [("frame batching", True), ("per key", False)]:
+        result = asyncio.run( InputTraceReplayer(trace_path, batch_frames=batch_frames).run() )
+        result["name"] = name
+        results.append(result)
+    return results
+
+def run(trace_path=None):
+    if trace_path:
+        return replay(trace_path)
+    with tempfile.TemporaryDirectory() as trace_dir:
+        trace_path = os.path.join(trace_dir, "generated.trace")
+        write_generated_trace(trace_path)
+        return replay(trace_path)
+
+def main():
+    for result in run(sys.argv[1] if len(sys.argv) > 1 else None):
+        print(f"{result['name']:>15}: {result['events_per_s']:10.0f} events/s, "
+            f"{result['keyboard_reports']} keyboard reports, {result['mouse_reports']} mouse reports")
+
+if __name__ == "__main__":
+    main()
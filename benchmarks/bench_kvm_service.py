@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+#
+# KVM service report path benchmark
+#
+# Calls the D-Bus methods SendKeyboardUsbTelegram and SendMouseUsbTelegram of
+# the KvmDbusService directly (without a bus) against a fake bluetooth server
+# and measures the cost per telegram: hotkey evaluation, report encoding and
+# the check for repeated reports. Mouse telegrams are measured with the
+# 8 bit and the 16 bit mouse report.
+
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rpi_kvm"))
+
+from settings import Settings
+from hotkey import HotkeyDetector, HotkeyConfig
+from kvm_service import KvmDbusService
+from bench_report_channel import FakeBtServer
+
+TELEGRAM_COUNT = 100000
+NO_MODIFIERS = [False] * 8
+NO_BUTTONS = [False] * 8
+
+def create_service(mouse_report):
+    settings = Settings()
+    settings['hid']['mouseReport'] = mouse_report
+    bt_server = FakeBtServer()
+    return KvmDbusService(settings, HotkeyDetector(HotkeyConfig(settings)), bt_server), bt_server
+
+def run(count=TELEGRAM_COUNT):
+    service_8bit, bt_server_8bit = create_service("8bit")
+    service_16bit, bt_server_16bit = create_service("16bit")
+    pressed_keys = bytes([4, 0, 0, 0, 0, 0])
+    released_keys = bytes(6)
+    key_toggle = [False]
+
+    def send_keyboard():
+        # Alternating press and release, so no report is dropped as repeated
+        key_toggle[0] = not key_toggle[0]
+        service_8bit.SendKeyboardUsbTelegram(NO_MODIFIERS, pressed_keys if key_toggle[0] else released_keys)
+
+    cases = [
+        ("keyboard telegram", send_keyboard, bt_server_8bit),
+        ("mouse telegram 8bit", lambda: service_8bit.SendMouseUsbTelegram(NO_BUTTONS, 5, -3, 0, 0), bt_server_8bit),
+        ("mouse telegram 16bit", lambda: service_16bit.SendMouseUsbTelegram(NO_BUTTONS, 500, -300, 0, 0), bt_server_16bit),
+    ]
+    results = []
+    for name, send, bt_server in cases:
+        duration_s = min(timeit.repeat(send, number=count, repeat=3))
+        results.append({
+            "name": name,
+            "telegrams": count,
+            "ns_per_telegram": duration_s * 1_000_000_000 / count,
+        })
+        bt_server.receive_times.clear()
+    return results
+
+def main():
+    for result in run():
+        print(f"{result['name']:>22}: {result['ns_per_telegram']:8.1f} ns/telegram")
+
+if __name__ == "__main__":
+    main()
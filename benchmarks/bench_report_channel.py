@@ -0,0 +1,139 @@
+#!/usr/bin/python3
+#
+# Report channel vs. D-Bus benchmark
+#
+# Sends keyboard reports from a producer to a KvmDbusService, once over the
+# report channel socket and once via D-Bus method calls, and measures the
+# reports per second and the latency until the report reaches the bluetooth
+# server. Producer and service share one process and one event loop, so the
+# numbers are meant for comparing both paths, not as absolute values.
+# The D-Bus path runs on a private dbus-daemon and is skipped without one.
+
+import os
+import sys
+import time
+import asyncio
+import subprocess
+import tempfile
+import statistics
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rpi_kvm"))
+
+import dbus_next
+from dbus_next.aio import MessageBus
+from settings import Settings
+from hotkey import HotkeyDetector, HotkeyConfig
+from kvm_service import KvmDbusService
+from report_channel import ReportChannelServer, KvmReportLink
+from latency import LatencyTracer
+
+REPORT_COUNT = 5000
+BENCH_BUS_NAME = "org.rpi.kvmservice.bench"
+
+class FakeBtServer(object):
+    def __init__(self):
+        self.receive_times = []
+        self.latency_tracer = LatencyTracer()
+        self.active_host_address = "00:00:00:00:00:00"
+
+    def register_on_clients_change_handler(self, handler):
+        pass
+
+    def send(self, message, event_time_us=0):
+        self.receive_times.append(time.perf_counter_ns())
+
+def create_service():
+    bt_server = FakeBtServer()
+    hotkey_detector = HotkeyDetector(HotkeyConfig(Settings()))
+    return KvmDbusService(Settings(), hotkey_detector, bt_server), bt_server
+
+def summarize(name, send_times, receive_times, duration_s):
+    latencies_us = sorted((received - sent) / 1000 for sent, received in zip(send_times, receive_times))
+    return {
+        "name": name,
+        "reports": len(receive_times),
+        "reports_per_s": len(receive_times) / duration_s,
+        "latency_p50_us": latencies_us[len(latencies_us) // 2],
+        "latency_p99_us": latencies_us[int(len(latencies_us) * 0.99)],
+        "latency_mean_us": statistics.mean(latencies_us),
+    }
+
+def keyboard_reports(count):
+    for i in range(count):
+        # alternating press and release of KEY_A
+        yield (0, bytes([4 if i % 2 == 0 else 0, 0, 0, 0, 0, 0]))
+
+async def bench_report_channel(count):
+    service, bt_server = create_service()
+    socket_path = os.path.join(tempfile.mkdtemp(), "reports.sock")
+    server = ReportChannelServer(service, socket_path)
+    server_task = asyncio.create_task(server.run())
+    while not os.path.exists(socket_path):
+        await asyncio.sleep(0.01)
+    link = KvmReportLink("Bench", socket_path)
+    await link.connect()
+
+    send_times = []
+    start = time.perf_counter()
+    for modifiers, keys in keyboard_reports(count):
+        send_times.append(time.perf_counter_ns())
+        await link.send_keyboard(modifiers, keys)
+    while len(bt_server.receive_times) < count:
+        await asyncio.sleep(0)
+    duration_s = time.perf_counter() - start
+
+    server.stop()
+    await server_task
+    return summarize("report-channel", send_times, bt_server.receive_times, duration_s)
+
+async def bench_dbus(count):
+    service, bt_server = create_service()
+    service_bus = await MessageBus(bus_type=dbus_next.BusType.SESSION).connect()
+    service_bus.export("/org/rpi/kvmservice", service)
+    await service_bus.request_name(BENCH_BUS_NAME)
+
+    client_bus = await MessageBus(bus_type=dbus_next.BusType.SESSION).connect()
+    introspection = await client_bus.introspect(BENCH_BUS_NAME, "/org/rpi/kvmservice")
+    kvm_service_obj = client_bus.get_proxy_object(BENCH_BUS_NAME, "/org/rpi/kvmservice", introspection)
+    kvm_dbus_iface = kvm_service_obj.get_interface("org.rpi.kvmservice")
+
+    send_times = []
+    start = time.perf_counter()
+    for modifiers, keys in keyboard_reports(count):
+        send_times.append(time.perf_counter_ns())
+        await kvm_dbus_iface.call_send_keyboard_usb_telegram([False] * 8, keys)
+    duration_s = time.perf_counter() - start
+
+    client_bus.disconnect()
+    service_bus.disconnect()
+    return summarize("d-bus", send_times, bt_server.receive_times, duration_s)
+
+def run_dbus_on_private_bus(count):
+    daemon = subprocess.Popen(["dbus-daemon", "--session", "--nofork", "--print-address"], stdout=subprocess.PIPE, text=True)
+    session_bus_address = os.environ.get("DBUS_SESSION_BUS_ADDRESS")
+    try:
+        os.environ["DBUS_SESSION_BUS_ADDRESS"] = daemon.stdout.readline().strip()
+        return asyncio.run(bench_dbus(count))
+    finally:
+        if session_bus_address is None:
+            del os.environ["DBUS_SESSION_BUS_ADDRESS"]
+        else:
+            os.environ["DBUS_SESSION_BUS_ADDRESS"] = session_bus_address
+        daemon.terminate()
+        daemon.wait()
+
+def run(count=REPORT_COUNT):
+    results = [asyncio.run(bench_report_channel(count))]
+    try:
+        results.append(run_dbus_on_private_bus(count))
+    except Exception as e:
+        # stdout carries the JSON report of run_benchmarks.py
+        print(f"D-Bus benchmark skipped: {e}", file=sys.stderr)
+    return results
+
+def main():
+    for result in run():
+        print(f"{result['name']:>15}: {result['reports_per_s']:10.0f} reports/s"
+              f"  p50 {result['latency_p50_us']:8.1f} us  p99 {result['latency_p99_us']:8.1f} us")
+
+if __name__ == "__main__":
+    main()
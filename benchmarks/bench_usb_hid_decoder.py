@@ -0,0 +1,43 @@
+#!/usr/bin/python3
+#
+# USB HID decoder microbenchmark
+#
+# Measures the encode helpers of the UsbHidDecoder used per input event:
+# the modifier/button bit mask conversion, the mouse button index and the
+# byte clamping, plus the evdev -> usb key code lookup of the keyboards.
+
+import os
+import sys
+import timeit
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rpi_kvm"))
+
+from evdev import ecodes
+from usb_hid_decoder import UsbHidDecoder
+
+CALL_COUNT = 200000
+MODIFIERS = [False, False, False, False, False, False, True, False]
+
+def run(count=CALL_COUNT):
+    lookup_table = UsbHidDecoder.build_evdev_lookup_table(ecodes.KEY, ecodes.KEY_MAX)
+    cases = [
+        ("modifier bit mask to int", lambda: UsbHidDecoder.convert_modifier_bit_mask_to_int(MODIFIERS)),
+        ("mouse button index", lambda: UsbHidDecoder.encode_mouse_button_index(ecodes.BTN_LEFT)),
+        ("byte size clamp", lambda: UsbHidDecoder.enshure_byte_size(-300)),
+        ("evdev key lookup", lambda: lookup_table[ecodes.KEY_A]),
+    ]
+    results = []
+    for name, encode in cases:
+        duration_s = min(timeit.repeat(encode, number=count, repeat=3))
+        results.append({
+            "name": name,
+            "calls": count,
+            "ns_per_call": duration_s * 1_000_000_000 / count,
+        })
+    return results
+
+def main():
+    for result in run():
+        print(f"{result['name']:>25}: {result['ns_per_call']:8.1f} ns/call")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+#
+# Benchmark suite runner
+#
+# Runs the run() function of every bench_*.py module in this directory and
+# writes all results with the machine, python version and git commit as JSON,
+# so runs of different commits can be compared. A benchmark failing, e.g.
+# for a missing session bus, is recorded with its error and skipped.
+#
+# Usage: run_benchmarks.py [-o results.json] [--compare old.json] [name ...]
+# The names select benchmarks, e.g. "hotkey" for bench_hotkey.py.
+
+import os
+import sys
+import glob
+import json
+import time
+import asyncio
+import inspect
+import argparse
+import platform
+import importlib
+import subprocess
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+
+def find_benchmarks():
+    return sorted(os.path.basename(path)[len("bench_"):-len(".py")] for path in glob.glob(os.path.join(BENCHMARKS_PATH, "bench_*.py")))
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=BENCHMARKS_PATH, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+def run_benchmark(name):
+    module = importlib.import_module(f"bench_{name}")
+    results = module.run()
+    if inspect.iscoroutine(results):
+        results = asyncio.run(results)
+    return results
+
+def run(names=None):
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": git_commit(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "benchmarks": {},
+    }
+    for name in names if names else find_benchmarks():
+        print(f"Running {name}...", file=sys.stderr)
+        try:
+            report["benchmarks"][name] = {"results": run_benchmark(name)}
+        except Exception as e:
+            print(f"Benchmark {name} failed: {e}", file=sys.stderr)
+            report["benchmarks"][name] = {"error": str(e)}
+    return report
+
+def compare(old_report, new_report):
+    """Prints the relative change of every numeric value of results with the same name."""
+    for name, benchmark in new_report["benchmarks"].items():
+        old_benchmark = old_report["benchmarks"].get(name, {})
+        old_results = {result["name"]: result for result in old_benchmark.get("results", [])}
+        for result in benchmark.get("results", []):
+            old_result = old_results.get(result["name"])
+            if not old_result:
+                continue
+            for key, value in result.items():
+                old_value = old_result.get(key)
+                # Only measured values, the parameters of a benchmark are equal
+                if type(value) not in (int, float) or type(old_value) not in (int, float) or not old_value or value == old_value:
+                    continue
+                print(f"{name} / {result['name']} / {key}: {old_value:.1f} -> {value:.1f} ({(value - old_value) / old_value:+.1%})")
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the benchmark suite and writes the results as JSON")
+    parser.add_argument("names", nargs="*", help=f"Benchmarks to run, default all: {', '.join(find_benchmarks())}")
+    parser.add_argument("-o", "--output", help="Result file, default stdout")
+    parser.add_argument("--compare", help="Result file of an earlier run to compare with")
+    args = parser.parse_args()
+
+    sys.path.insert(0, BENCHMARKS_PATH)
+    report = run(args.names)
+    content = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(content)
+    else:
+        print(content)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(json.load(f), report)
+
+if __name__ == "__main__":
+    main()
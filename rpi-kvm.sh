@@ -20,9 +20,13 @@ case "$1" in
     start)
         sudo ./scripts/init.sh
         ;;
+    start-single)
+        sudo ./scripts/init.sh single
+        ;;
     restart)
+        mode=$(sudo tmux show-environment -t rpi-kvm RPI_KVM_MODE 2>/dev/null | cut -d= -f2)
         sudo tmux kill-session -t rpi-kvm
-        sudo ./scripts/init.sh
+        sudo ./scripts/init.sh $mode
         ;;
     update-mac)
         sudo ./scripts/update-mac.sh
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+#
+# All-in-one runtime
+#
+# Runs the bluetooth server, the KVM D-Bus service, the web server, the info hub
+# and the mouse and keyboard input loops as tasks of one asyncio loop. Inside
+# this process the components call each other directly. The D-Bus service is
+# still exported for external clients.
+
+import os
+import asyncio
+import signal
+import json
+import logging
+from settings import Settings
+from bt_server import BtServer
+from hotkey import HotkeyDetector, HotkeyConfig
+from kvm_service import KvmDbusService
+from report_channel import ReportChannelServer, DirectReportLink
+from web import WebServer
+from info_hub import InfoHub
+from mouse import KvmMouse, run_mice
+from keyboard import run_keyboards
+from persistence import JsonFileWriter
+
+class LocalKvmInterface(object):
+    """Offers the calls and signals of the org.rpi.kvmservice D-Bus proxy
+    interface for components running in the same process."""
+    def __init__(self, kvm_service, bt_server):
+        self._kvm_service = kvm_service
+        self._bt_server = bt_server
+
+    async def call_get_connected_client_names(self):
+        return self._bt_server.get_connected_client_names()
+
+    async def call_get_clients_info(self):
+        return json.dumps(self._bt_server.get_clients_info_dict())
+
+    async def call_get_latency_stats(self):
+        return json.dumps(self._kvm_service.get_latency_stats())
+
+    async def call_connect_client(self, client_address):
+        self._bt_server.connect_client(client_address)
+
+    async def call_disconnect_client(self, client_address):
+        self._bt_server.disconnect_client(client_address)
+
+    async def call_remove_client(self, client_address):
+        self._bt_server.remove_client(client_address)
+
+    async def call_change_client_order(self, client_address, order_type):
+        self._bt_server.change_client_order(client_address, order_type)
+
+    async def call_switch_active_host(self, client_address):
+        self._kvm_service.switch_active_host(client_address)
+
+    async def call_reload_settings(self):
+        self._kvm_service.reload_settings()
+
+    async def call_restart_info_hub(self):
+        self._kvm_service.restart_info_hub()
+
+    def on_signal_host_change(self, handler):
+        self._kvm_service.add_local_signal_handler("host_change", handler)
+
+    def on_signal_clients_change(self, handler):
+        self._kvm_service.add_local_signal_handler("clients_change", handler)
+
+    def on_signal_restart_info_hub(self, handler):
+        self._kvm_service.add_local_signal_handler("restart_info_hub", handler)
+
+async def main():
+    logging.basicConfig(format='KVM %(levelname)s: %(message)s', level=logging.INFO)
+
+    if not os.geteuid() == 0: # Check if user is root
+        logging.error("Root permissions required: Execute as root or with sudo")
+        return
+
+    bt_server = BtServer()
+    bt_server_task = asyncio.create_task( bt_server.run() )
+
+    settings = Settings()
+    settings.load_from_file()
+    hotkey_config = HotkeyConfig(settings)
+    hotkey_detector = HotkeyDetector(hotkey_config)
+    kvm_dbus_service = KvmDbusService(settings, hotkey_detector, bt_server)
+    kvm_dbus_service_task = asyncio.create_task( kvm_dbus_service.run() )
+    report_channel_server = ReportChannelServer(kvm_dbus_service)
+    report_channel_server_task = asyncio.create_task( report_channel_server.run() )
+
+    kvm_iface = LocalKvmInterface(kvm_dbus_service, bt_server)
+    report_link = DirectReportLink(kvm_dbus_service)
+    info_hub = InfoHub(kvm_iface)
+    component_tasks = [
+        asyncio.create_task( WebServer(settings, kvm_iface).run() ),
+        asyncio.create_task( info_hub.run() ),
+        asyncio.create_task( run_mice(KvmMouse(report_link), settings) ),
+        asyncio.create_task( run_keyboards(report_link, settings) ),
+    ]
+
+    main_future = asyncio.Future()
+
+    def signal_handler(sig, frame):
+        logging.error("System: Ctrl+C has been pressed - Shut down")
+        main_future.set_result("")
+    signal.signal(signal.SIGINT, signal_handler)
+
+    await main_future # wait unitl signal interrupts
+
+    for task in component_tasks:
+        task.cancel()
+    info_hub.cleanup()
+    report_channel_server.stop()
+    await report_channel_server_task
+    kvm_dbus_service.stop()
+    await kvm_dbus_service_task
+    bt_server.stop()
+    await bt_server_task
+    # Settings and client order changes not written yet
+    await JsonFileWriter.flush_all()
+    logging.error("System: Shut down completed")
+
+if __name__ == "__main__":
+    asyncio.run( main() )
@@ -1,3 +1,4 @@
+import os
 import asyncio
 import dbus_next
 from dbus_next.aio import MessageBus
@@ -5,6 +6,8 @@ import socket
 import enum
 import logging
 import common
+from latency import now_us
+from report_queue import ReportQueue
 
 class BtConnectionRole(enum.Enum):
     Master = 1
@@ -14,6 +17,14 @@ class BtConnectionRole(enum.Enum):
 class BtClient(object):
     BT_CONTROL_PORT = 17  # Service port - control port specified in the bluetooth HID specification
     BT_INTERRUPT_PORT = 19  # Service port - interrupt port specified in the bluetooth HID specification
+    # The drain rate is measured over windows of completed reports. A window in
+    # which a send had to wait for the socket shows what the link drains. Without
+    # such a wait the link kept up and the estimate grows till the link is saturated again.
+    DRAIN_WINDOW = 0.5
+    DRAIN_RATE_GROWTH = 1.25
+    DRAIN_RATE_MAX = 100_000
+    # Bus of the org.bluez service - RPI_KVM_BLUEZ_BUS=session runs against mock_bluez.py
+    BLUEZ_BUS_TYPE = dbus_next.BusType.SESSION if os.environ.get("RPI_KVM_BLUEZ_BUS") == "session" else dbus_next.BusType.SYSTEM
 
     @staticmethod
     async def create_via_address(address):
@@ -46,10 +57,17 @@ class BtClient(object):
         self._control_socket = None
         self._interrupt_socket = None
         self._loop = asyncio.get_event_loop()
-        self._message_queue = asyncio.Queue()
+        self._message_queue = ReportQueue()
         self._task = None
         self._bt_master_task = None
         self._bt_check_alive_task = None
+        self.latency_tracer = None
+        # Called with the client when it becomes alive or its connection task ended
+        self.alive_change_cb = None
+        self._drain_rate = BtClient.DRAIN_RATE_MAX
+        self._drain_window_start = 0
+        self._drain_window_reports = 0
+        self._is_drain_window_saturated = False
 
     @property
     def address(self):
@@ -74,25 +92,56 @@ class BtClient(object):
     def is_connected(self):
         return self._is_connected
 
+    @property
+    def link_stats(self):
+        """Reports per second the link can drain and the number of queued reports."""
+        self._update_drain_rate()
+        return (int(self._drain_rate), len(self._message_queue))
+
+    def _update_drain_rate(self):
+        now = self._loop.time()
+        duration = now - self._drain_window_start
+        if duration < BtClient.DRAIN_WINDOW:
+            return
+        if self._is_drain_window_saturated:
+            self._drain_rate = max(1, self._drain_window_reports / duration)
+        else:
+            self._drain_rate = min(BtClient.DRAIN_RATE_MAX, max(self._drain_window_reports / duration, self._drain_rate * BtClient.DRAIN_RATE_GROWTH))
+        self._drain_window_start = now
+        self._drain_window_reports = 0
+        self._is_drain_window_saturated = False
+
     @property
     def info(self):
         info_dict = {}
         info_dict["name"] = self.name
         info_dict["address"] = self.address
         info_dict["isConnected"] = self.is_connected
+        info_dict["queue"] = self._message_queue.stats
         return info_dict
 
     def connect(self):
         if not self._task or self._task.done():
-            self._stop_event = False
-            self._task = asyncio.create_task(self._run())
+            self._start_task()
 
     def accept_connection(self, control_socket, interrupt_socket):
         if not self._task or self._task.done():
             self._control_socket = control_socket
             self._interrupt_socket = interrupt_socket
-            self._stop_event = False
-            self._task = asyncio.create_task(self._run())
+            self._start_task()
+
+    def _start_task(self):
+        self._stop_event = False
+        self._task = asyncio.create_task(self._run())
+        self._task.add_done_callback(self._on_task_done)
+        self._notify_alive_change()
+
+    def _on_task_done(self, task):
+        self._notify_alive_change()
+
+    def _notify_alive_change(self):
+        if self.alive_change_cb:
+            self.alive_change_cb(self)
 
     async def _establish_socket_connection(self):
         if self._control_socket and self._interrupt_socket:
@@ -118,7 +167,8 @@ class BtClient(object):
             self._checking_connection_state_periodically()
 
     def _handle_state_at_successfull_connection(self):
-        self._message_queue = asyncio.Queue()
+        self._message_queue.clear()
+        self._drain_rate = BtClient.DRAIN_RATE_MAX
         self._is_connected = True
 
     def _disconnect(self):
@@ -129,9 +179,11 @@ class BtClient(object):
             self._interrupt_socket.close()
             self._interrupt_socket = None
         self._is_connected = False
+        self._message_queue.wake()
 
     def stop(self):
         self._stop_event = True
+        self._message_queue.wake()
 
     async def join(self):
         await self._task
@@ -140,7 +192,7 @@ class BtClient(object):
         self._bluez_obj = None
         while not self._bluez_obj:
             try:
-                self._dbus = await MessageBus(bus_type=dbus_next.BusType.SYSTEM).connect()
+                self._dbus = await MessageBus(bus_type=BtClient.BLUEZ_BUS_TYPE).connect()
                 introspection = await self._dbus.introspect(
                     "org.bluez", self._device_object_path)
                 self._bluez_obj = self._dbus.get_proxy_object(
@@ -166,26 +218,39 @@ class BtClient(object):
         await self._establish_socket_connection()
         if self._is_connected:
             logging.info(f"\033[0;32m{self.name}: Connection established ({self.address})\033[0m")
-        while self._is_connected and not self._stop_event:
-            message = ""
-            try:
-                message = await asyncio.wait_for(self._message_queue.get(), timeout=2)
-                await self._loop.sock_sendall(self._interrupt_socket, bytes(message))
-                self._message_queue.task_done()
-            except asyncio.QueueEmpty:
-                pass
-            except asyncio.TimeoutError:
-                pass
-            except socket.error:
-                logging.error(f"{self._name}: Socket error during send")
-                self._disconnect()
-            except:
-                logging.error(f"{self._name}: Message could not be sed: {message}")
-                raise
-
+        await self._send_loop()
         logging.info(f"\033[0;31m{self.name}: Connection terminated - client closed ({self.address})\033[0m")
         self._disconnect()
 
+    async def _send_loop(self):
+        while self._is_connected and not self._stop_event:
+            await self._message_queue.wait_ready()
+            # Drain every report which is ready in one wakeup
+            while self._is_connected and not self._stop_event and len(self._message_queue):
+                message, enqueue_time_us, event_time_us = self._message_queue.get_nowait()
+                dequeue_time_us = now_us()
+                try:
+                    try:
+                        self._interrupt_socket.send(message)
+                    except BlockingIOError:
+                        # The socket buffer is full - the link is the bottleneck
+                        self._is_drain_window_saturated = True
+                        await self._loop.sock_sendall(self._interrupt_socket, message)
+                except OSError:
+                    logging.error(f"{self._name}: Socket error during send")
+                    self._disconnect()
+                    break
+                except:
+                    logging.error(f"{self._name}: Message could not be sed: {message}")
+                    raise
+                sent_time_us = now_us()
+                self._drain_window_reports += 1
+                self._update_drain_rate()
+                if event_time_us and self.latency_tracer:
+                    self.latency_tracer.record("queue", self._address, dequeue_time_us - enqueue_time_us)
+                    self.latency_tracer.record("send", self._address, sent_time_us - dequeue_time_us)
+                    self.latency_tracer.record("total", self._address, sent_time_us - event_time_us)
+
     def _enshure_bt_master(self):
         if not self._bt_master_task or self._bt_master_task.done():
             self._bt_master_task = asyncio.create_task(self._switch_to_master())
@@ -211,7 +276,7 @@ class BtClient(object):
         while self._is_connected and not self._stop_event:
             await asyncio.sleep(4)
             # sending an empty message to check if socket connection is still alive
-            self.send(bytes([0, 0, 0, 0]))
+            self.send(ReportQueue.ALIVE_MESSAGE)
         logging.debug(f"{self._name}: Sending periodic messages to check connection state stopped")
 
     async def _get_connection_role(self):
@@ -224,6 +289,6 @@ class BtClient(object):
                     return BtConnectionRole.Master
         return BtConnectionRole.NotConnected
 
-    def send(self, message):
+    def send(self, message, event_time_us=0):
         if self._is_connected:
-            self._message_queue.put_nowait(message)
+            self._message_queue.put(message, now_us() if event_time_us else 0, event_time_us)
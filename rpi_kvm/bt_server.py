@@ -9,7 +9,25 @@ import socket
 import logging
 import common
 from bt_client import BtClient
-from client_order import PersistentClientOrder
+from client_order import PersistentClientOrder, HostRing
+from latency import LatencyTracer
+
+class PendingConnection(object):
+    """Control and interrupt channel of a host, one of them is not accepted yet."""
+    def __init__(self, timer):
+        self.control_socket = None
+        self.interrupt_socket = None
+        self.timer = timer
+
+    @property
+    def is_complete(self):
+        return self.control_socket is not None and self.interrupt_socket is not None
+
+    def close(self):
+        self.timer.cancel()
+        for channel_socket in (self.control_socket, self.interrupt_socket):
+            if channel_socket:
+                channel_socket.close()
 
 class BtServer(object):
     NAME = "RPI-KVM"
@@ -18,6 +36,7 @@ class BtServer(object):
 
     BT_CONTROL_PORT = 17  # Service port - control port specified in the bluetooth HID specification
     BT_INTERRUPT_PORT = 19  # Service port - interrupt port specified in the bluetooth HID specification
+    PAIRING_TIMEOUT = 5 # Seconds till an accepted channel without its counterpart is closed
 
     def __init__(self):
         self._loop = asyncio.get_event_loop()
@@ -25,10 +44,30 @@ class BtServer(object):
         self._has_stopped = False
         self._clients = {}
         self._clients_connected = {}
+        # host address -> PendingConnection
+        self._pending_connections = {}
         self._active_host = None
         self._handlers_on_clients_change = []
         self._clients_order = PersistentClientOrder()
         self._clients_order.load_from_file()
+        # Addresses of the connected clients in client order
+        self._connected_ring = HostRing(self._clients_order)
+        self._latency_tracer = LatencyTracer()
+
+    @property
+    def latency_tracer(self):
+        return self._latency_tracer
+
+    @property
+    def link_stats(self):
+        """Drain rate and queue depth of the active host link or None."""
+        if self._active_host and self._active_host.is_connected:
+            return self._active_host.link_stats
+        return None
+
+    @property
+    def active_host_address(self):
+        return self._active_host.address if self._active_host else ""
 
     def stop(self):
         self._stop_event = True
@@ -62,7 +101,7 @@ class BtServer(object):
             "AutoConnect": Variant('b', True),
             "ServiceRecord": Variant('s', service_record)
         }
-        bus = await MessageBus(bus_type=dbus_next.BusType.SYSTEM).connect()
+        bus = await MessageBus(bus_type=BtClient.BLUEZ_BUS_TYPE).connect()
         # retrieve a proxy for the bluez profile interface
         introspection = await bus.introspect(
             "org.bluez", "/org/bluez")
@@ -79,7 +118,7 @@ class BtServer(object):
 
     async def _connect_to_paired_clients(self):
         logging.info("Server: Connect to already paired clients")
-        bus = await MessageBus(bus_type=dbus_next.BusType.SYSTEM).connect()
+        bus = await MessageBus(bus_type=BtClient.BLUEZ_BUS_TYPE).connect()
         # retrieve a proxy for the bluez profile interface
         introspection = await bus.introspect(
             "org.bluez", "/")
@@ -118,22 +157,18 @@ class BtServer(object):
         self.control_socket.listen(5)
         self.interrupt_socket.listen(5)
 
+        # Both channels are accepted independently and paired by the host address
+        accept_tasks = [
+            asyncio.create_task(self._accept_channel(self.control_socket, BtServer.BT_CONTROL_PORT)),
+            asyncio.create_task(self._accept_channel(self.interrupt_socket, BtServer.BT_INTERRUPT_PORT)),
+        ]
         while not self._stop_event:
-            try:
-                self._check_for_client_communication_change()
-                client_control_socket, (client_address, client_port) = await asyncio.wait_for(
-                    self._loop.sock_accept(self.control_socket), timeout=2)
-                client_interrupt_socket, (client_address, client_port) = await asyncio.wait_for(
-                    self._loop.sock_accept(self.interrupt_socket), timeout=2)
-                if client_address in self._clients:
-                    client = self._clients[client_address]
-                else:
-                    client = await BtClient.create_via_address(client_address)
-                    self._add_client(client)
-                client.accept_connection(client_control_socket, client_interrupt_socket)
-            except asyncio.TimeoutError:
-                await asyncio.sleep(3)
+            await asyncio.sleep(1)
 
+        for accept_task in accept_tasks:
+            accept_task.cancel()
+        for client_address in list(self._pending_connections):
+            self._pending_connections.pop(client_address).close()
         logging.warning("Server: Closing receiving server sockets")
         self.control_socket.close()
         self.interrupt_socket.close()
@@ -147,11 +182,67 @@ class BtServer(object):
         logging.warning("Server: All clients stopped")
         logging.warning("Server: Stopped successfully")
 
+    async def _accept_channel(self, server_socket, port):
+        while True:
+            try:
+                client_socket, (client_address, client_port) = await self._loop.sock_accept(server_socket)
+            except OSError as e:
+                logging.error(f"Server: Accept on port {port} failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            self._on_channel_accepted(client_address, port, client_socket)
+
+    def _on_channel_accepted(self, client_address, port, client_socket):
+        pending_connection = self._pending_connections.get(client_address)
+        if not pending_connection:
+            timer = self._loop.call_later(BtServer.PAIRING_TIMEOUT, self._expire_pending_connection, client_address)
+            pending_connection = PendingConnection(timer)
+            self._pending_connections[client_address] = pending_connection
+        if port == BtServer.BT_CONTROL_PORT:
+            if pending_connection.control_socket:
+                logging.warning(f"Server: {client_address} opened the control channel again - Replacing the former one")
+                pending_connection.control_socket.close()
+            pending_connection.control_socket = client_socket
+        else:
+            if pending_connection.interrupt_socket:
+                logging.warning(f"Server: {client_address} opened the interrupt channel again - Replacing the former one")
+                pending_connection.interrupt_socket.close()
+            pending_connection.interrupt_socket = client_socket
+        if pending_connection.is_complete:
+            pending_connection.timer.cancel()
+            del self._pending_connections[client_address]
+            asyncio.create_task( self._accept_client_connection(client_address, pending_connection.control_socket, pending_connection.interrupt_socket) )
+
+    def _expire_pending_connection(self, client_address):
+        pending_connection = self._pending_connections.pop(client_address, None)
+        if pending_connection:
+            logging.warning(f"Server: {client_address} opened only one channel within {BtServer.PAIRING_TIMEOUT} s - Closing it")
+            pending_connection.close()
+
+    async def _accept_client_connection(self, client_address, control_socket, interrupt_socket):
+        if client_address in self._clients:
+            client = self._clients[client_address]
+        else:
+            client = await BtClient.create_via_address(client_address)
+            self._add_client(client)
+        client.accept_connection(control_socket, interrupt_socket)
+
     def _add_client(self, client):
         if client.address in self._clients:
             logging.info(f"Server: Client {client.name} was connected before - Stop old instance")
             self._clients[client.address].stop()
         self._clients[client.address] = client
+        client.latency_tracer = self._latency_tracer
+        # The client may have been started before it was added
+        client.alive_change_cb = self._on_client_alive_change
+        if client.address not in self._clients_order.clients:
+            self._clients_order.add_client(client)
+        if client.is_alive:
+            self._clients_connected[client.address] = client
+            self._connected_ring.add(client.address)
+        else:
+            self._clients_connected.pop(client.address, None)
+            self._connected_ring.remove(client.address)
         if not self._active_host:
             if self._clients_order.active_client == client.address:
                 logging.info(f"Server: Active host: {client.name}")
@@ -161,25 +252,36 @@ class BtServer(object):
             self._active_host = client
         self._notify_on_clients_change()
 
-    def _check_for_client_communication_change(self):
-        old_clients_connected = self._clients_connected.copy()
-        self._clients_connected = {}
-        for client_address, client in self._clients.items():
-            if client.is_alive:
-                self._clients_connected[client_address] = client
-            if client_address not in self._clients_order.clients:
-                self._clients_order.add_client(client)
-        if self._clients_connected != old_clients_connected:
-            self._notify_on_clients_change()
+    def _on_client_alive_change(self, client):
+        # Stopped instances replaced by a reconnection or removed clients are not tracked anymore
+        if self._clients.get(client.address) is not client:
+            return
+        if client.is_alive:
+            if self._clients_connected.get(client.address) is client:
+                return
+            self._clients_connected[client.address] = client
+            self._connected_ring.add(client.address)
+        elif client.address in self._clients_connected:
+            self._clients_connected.pop(client.address)
+            self._connected_ring.remove(client.address)
+        else:
+            return
+        self._notify_on_clients_change()
 
     def switch_to_next_connected_host(self):
-        if len(self._clients_connected) > 1:
-            next_host = self._get_connected_client_addresses()[1]
-            self._active_host = self._clients_connected[next_host]
-        elif len(self._clients_connected) == 1:
-            next_host = self._get_connected_client_addresses()[0]
-            self._active_host = self._clients_connected[next_host]
-        self._clients_order.active_client = self._active_host.address
+        self._switch_to_connected_host(self._connected_ring.step(self.active_host_address, 1))
+
+    def switch_to_previous_connected_host(self):
+        self._switch_to_connected_host(self._connected_ring.step(self.active_host_address, -1))
+
+    def switch_to_connected_host_number(self, host_number):
+        # host_number is the 1 based position of the connected host in the client order
+        self._switch_to_connected_host(self._connected_ring.at(host_number))
+
+    def _switch_to_connected_host(self, client_address):
+        if client_address:
+            self._active_host = self._clients_connected[client_address]
+            self._clients_order.active_client = client_address
 
     def switch_active_host_to(self, client_address):
         if client_address in self._clients:
@@ -187,14 +289,8 @@ class BtServer(object):
         self._clients_order.active_client = self._active_host.address
 
     def _get_connected_client_addresses(self):
-        if self._active_host and len(self._clients_connected) > 0:
-            client_addresses = self._clients_order.sort_clients( list(self._clients_connected.keys()) )
-            if self._active_host.address in client_addresses:
-                cur_active_index = client_addresses.index(self._active_host.address)
-            else:
-                cur_active_index = 0
-            client_addresses = [*client_addresses[cur_active_index:], *client_addresses[:cur_active_index]]
-            return client_addresses
+        if self._active_host and len(self._connected_ring) > 0:
+            return self._connected_ring.addresses_from(self._active_host.address)
         else:
             return None
 
@@ -244,10 +340,13 @@ class BtServer(object):
         if client_address in self._clients:
             client = self._clients[client_address]
             logging.info(f"Server: External trigger: Change order of {client.name} ({client.address}) {order_type}")
+            changed_addresses = []
             if order_type == "lower":
-                self._clients_order.change_order_lower(client_address)
+                changed_addresses = self._clients_order.change_order_lower(client_address)
             elif order_type == "higher":
-                self._clients_order.change_order_higher(client_address)
+                changed_addresses = self._clients_order.change_order_higher(client_address)
+            for changed_address in changed_addresses:
+                self._connected_ring.update_order(changed_address)
             self._notify_on_clients_change()
 
     def remove_client(self, client_address):
@@ -255,6 +354,8 @@ class BtServer(object):
             client = self._clients[client_address]
             logging.info(f"Server: External trigger: Remove {client.name} ({client.address})")
             self._clients.pop(client.address)
+            self._clients_connected.pop(client.address, None)
+            self._connected_ring.remove(client.address)
             self._notify_on_clients_change()
             asyncio.create_task( self._remove_client_from_system(client) )
             
@@ -266,7 +367,7 @@ class BtServer(object):
 
     async def _remove_client_from_bluez(self, client):
         logging.info(f"Server: Remove client {client.name} ({client.address}) from bluez")
-        dbus = await MessageBus(bus_type=dbus_next.BusType.SYSTEM).connect()
+        dbus = await MessageBus(bus_type=BtClient.BLUEZ_BUS_TYPE).connect()
         introspection = await dbus.introspect(
             "org.bluez", "/org/bluez/hci0")
         bluez_obj = dbus.get_proxy_object(
@@ -275,7 +376,7 @@ class BtServer(object):
         await bluez_adapter_itf.call_remove_device(client.object_path)
         logging.info(f"Server: Remove client {client.name} ({client.address}) from bluez done")
 
-    def send(self, message):
+    def send(self, message, event_time_us=0):
         if self._active_host:
-            self._active_host.send(message)
+            self._active_host.send(message, event_time_us)
 
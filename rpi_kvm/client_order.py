@@ -1,9 +1,11 @@
 #!/usr/bin/python3
 
 import os
+import bisect
 import collections
 import json
 import logging
+from persistence import JsonFileWriter
 
 class PersistentClientOrder(object):
     PATH_TO_FILE = "./conf/rpi-kvm-client-order.json"
@@ -18,6 +20,10 @@ class PersistentClientOrder(object):
                 # "B3:1A:7D:DA:71:11": 1,
             }
         }
+        # Host switches save the active client - written in the background to not stall the input
+        self._file_writer = JsonFileWriter(PersistentClientOrder.PATH_TO_FILE, self.as_dict)
+        # order -> address, the first client wins if an order is given twice
+        self._addresses_by_order = {}
 
     def __getitem__(self, key):
         return self._clients_order_dict[key]
@@ -50,11 +56,19 @@ class PersistentClientOrder(object):
                         self._clients_order_dict[subject][element] = data[subject][element]
                 else:
                     self._clients_order_dict[subject] = data[subject]
+        self._index_orders()
         self.save_to_file()
+
+    def _index_orders(self):
+        self._addresses_by_order = {}
+        for client_address, order in self.clients.items():
+            self._addresses_by_order.setdefault(order, client_address)
     
     def add_client(self, new_client):
         if new_client.address not in self.clients:
-            self._clients_order_dict["clients"][new_client.address] = len(self._clients_order_dict["clients"])
+            order = len(self._clients_order_dict["clients"])
+            self._clients_order_dict["clients"][new_client.address] = order
+            self._addresses_by_order.setdefault(order, new_client.address)
             self.save_to_file()
     
     def sort_clients(self, client_addresses):
@@ -65,35 +79,38 @@ class PersistentClientOrder(object):
         return list(collections.OrderedDict(sorted(sorted_clients_dict.items())).values())
 
     def change_order_lower(self, client_address):
-        if client_address in self.clients:
-            cur_order = self.clients[client_address]
-            if cur_order > 0:
-                new_order = cur_order - 1
-                list_of_orders = list(self.clients.values())
-                if new_order in list_of_orders: 
-                    index_of_client_at_new_order = list_of_orders.index(new_order)
-                    client_address_at_new_order = list(self.clients.keys())[index_of_client_at_new_order]
-                    self.clients[client_address_at_new_order] = cur_order
-                self.clients[client_address] = new_order
-                self.save_to_file()
+        """Returns the addresses of the clients whose order changed."""
+        if client_address in self.clients and self.clients[client_address] > 0:
+            return self._move_client(client_address, self.clients[client_address] - 1)
+        return []
 
     def change_order_higher(self, client_address):
+        """Returns the addresses of the clients whose order changed."""
         if client_address in self.clients:
-            cur_order = self.clients[client_address]
-            new_order = cur_order + 1
-            list_of_orders = list(self.clients.values())
-            if new_order in list_of_orders: 
-                index_of_client_at_new_order = list_of_orders.index(new_order)
-                client_address_at_new_order = list(self.clients.keys())[index_of_client_at_new_order]
-                self.clients[client_address_at_new_order] = cur_order
-            self.clients[client_address] = new_order
-            self.save_to_file()
+            return self._move_client(client_address, self.clients[client_address] + 1)
+        return []
+
+    def _move_client(self, client_address, new_order):
+        # Swaps the order with the client at the new order
+        cur_order = self.clients[client_address]
+        changed_addresses = [client_address]
+        client_address_at_new_order = self._addresses_by_order.get(new_order)
+        if client_address_at_new_order is not None:
+            self.clients[client_address_at_new_order] = cur_order
+            self._addresses_by_order[cur_order] = client_address_at_new_order
+            changed_addresses.append(client_address_at_new_order)
+        elif self._addresses_by_order.get(cur_order) == client_address:
+            del self._addresses_by_order[cur_order]
+        self.clients[client_address] = new_order
+        self._addresses_by_order[new_order] = client_address
+        self.save_to_file()
+        return changed_addresses
 
     def save_to_file(self):
-        file_content = json.dumps(self._clients_order_dict, indent=4)
-        with open(PersistentClientOrder.PATH_TO_FILE, 'w') as f:
-            f.write(file_content)
-        #logging.info(f"PersistentClientOrder written to: {PersistentClientOrder.PATH_TO_FILE}")
+        self._file_writer.save()
+
+    async def flush(self):
+        await self._file_writer.flush()
 
     def load_from_file(self):
         if not os.path.exists(PersistentClientOrder.PATH_TO_FILE):
@@ -111,7 +128,87 @@ class PersistentClientOrder(object):
                             self._clients_order_dict[subject][element] = saved_clients_order_dict[subject][element]
                     else:
                         self._clients_order_dict[subject] = saved_clients_order_dict[subject]
+        self._index_orders()
+
+
+class HostRing(object):
+    """The connected hosts in client order, maintained incrementally.
 
+    Stepping from a host to the next or previous one and jumping to the n-th
+    host are O(1). Connects, disconnects and order changes insert or remove
+    the single host only.
+    """
+    def __init__(self, client_order):
+        self._client_order = client_order
+        # Sorted by (order, address), addresses unknown to the client order are last
+        self._keys = []
+        self._addresses = []
+        # address -> index in _addresses
+        self._positions = {}
+
+    def __len__(self):
+        return len(self._addresses)
+
+    def __contains__(self, client_address):
+        return client_address in self._positions
+
+    def _key(self, client_address):
+        order = self._client_order.clients.get(client_address)
+        return (0, order, client_address) if order is not None else (1, 0, client_address)
+
+    def add(self, client_address):
+        if client_address in self._positions:
+            return
+        key = self._key(client_address)
+        index = bisect.bisect(self._keys, key)
+        self._keys.insert(index, key)
+        self._addresses.insert(index, client_address)
+        self._update_positions(index)
+
+    def remove(self, client_address):
+        index = self._positions.pop(client_address, None)
+        if index is None:
+            return
+        del self._keys[index]
+        del self._addresses[index]
+        self._update_positions(index)
+
+    def update_order(self, client_address):
+        """Moves the host to its position after its order changed.
+        Only the hosts between the old and the new position are renumbered."""
+        old_index = self._positions.get(client_address)
+        if old_index is None:
+            return
+        del self._keys[old_index]
+        del self._addresses[old_index]
+        key = self._key(client_address)
+        new_index = bisect.bisect(self._keys, key)
+        self._keys.insert(new_index, key)
+        self._addresses.insert(new_index, client_address)
+        self._update_positions(min(old_index, new_index), max(old_index, new_index) + 1)
+
+    def _update_positions(self, start_index, end_index=None):
+        for index in range(start_index, len(self._addresses) if end_index is None else end_index):
+            self._positions[self._addresses[index]] = index
+
+    def step(self, client_address, steps=1):
+        """Returns the host steps positions after the given one (negative: before).
+        A host not in the ring counts as the first host."""
+        if not self._addresses:
+            return None
+        index = self._positions.get(client_address, 0)
+        return self._addresses[(index + steps) % len(self._addresses)]
+
+    def at(self, host_number):
+        """Returns the host at the 1 based position or None."""
+        if 0 < host_number <= len(self._addresses):
+            return self._addresses[host_number - 1]
+        return None
+
+    def addresses_from(self, client_address):
+        """All hosts starting with the given one."""
+        index = self._positions.get(client_address, 0)
+        return [*self._addresses[index:], *self._addresses[:index]]
 
 def main():
     logging.basicConfig(format='PersistentClientOrder %(levelname)s: %(message)s', level=logging.DEBUG)
@@ -0,0 +1,123 @@
+#!/usr/bin/python3
+
+import struct
+import time
+
+class HidReportEncoder(object):
+    """Packs the bluetooth HID input reports into reusable buffers.
+
+    The returned buffer is overwritten by the next report of the same type,
+    receivers have to copy it (the send queue of the bluetooth client does).
+    """
+    # |- USB HID input report
+    # |     |- USB HID usage report => Keyboard
+    # |     |     |- Bit mask for modifier keys
+    # |     |     |  0x80: Right GUI
+    # |     |     |  0x40: Right Alt
+    # |     |     |  0x20: Right Shift
+    # |     |     |  0x10: Right Control
+    # |     |     |  0x08: Left GUI
+    # |     |     |  0x04: Left Alt
+    # |     |     |  0x02: Left Shift
+    # |     |     |  0x01: Left Control
+    # |     |     |     |- Vendor reserved
+    # |     |     |     |     |-> 6x pressed keys
+    # 0xA1, 0x01, 0xXX, 0x00, 0xXX, 0xXX, 0xXX, 0xXX, 0xXX, 0xXX
+    KEYBOARD_STRUCT = struct.Struct("<BBBB6s")
+    # |- USB HID input report
+    # |     |- USB HID usage report => N-key rollover keyboard
+    # |     |     |- Bit mask for modifier keys (see keyboard report)
+    # |     |     |     |-> 32 byte bitmap of pressed keys, bit n of byte n // 8 is usb key code n
+    # 0xA1, 0x04, 0xXX, 0xXX, ...
+    KEYBOARD_NKRO_STRUCT = struct.Struct("<BBB32s")
+    KEY_BITMAP_SIZE = 32
+    # |- USB HID input report
+    # |     |- USB HID usage report => Mouse
+    # |     |     |- Bit mask for mouse buttons
+    # |     |     |  0x80: Not defined
+    # |     |     |  0x40: Not defined
+    # |     |     |  0x20: Not defined
+    # |     |     |  0x10: Forward mouse button
+    # |     |     |  0x08: Backward mouse button
+    # |     |     |  0x04: Middle mouse button
+    # |     |     |  0x02: Right mouse button
+    # |     |     |  0x01: Left mouse button
+    # |     |     |     |- Mouse x position
+    # |     |     |     |     |- Mouse y position
+    # |     |     |     |     |     |- Vertical wheel position
+    # |     |     |     |     |     |     |- Horizontal wheel position
+    # 0xA1, 0x02, 0xXX, 0xXX, 0xXX, 0xXX, 0xXX]
+    MOUSE_8BIT_STRUCT = struct.Struct("<BBBbbbb")
+    # |- USB HID input report
+    # |     |- USB HID usage report => Mouse with 16 bit movement
+    # |     |     |- Bit mask for mouse buttons (see 8 bit report)
+    # |     |     |     |- Mouse x position (little endian)
+    # |     |     |     |           |- Mouse y position (little endian)
+    # |     |     |     |           |           |- Vertical wheel position
+    # |     |     |     |           |           |     |- Horizontal wheel position
+    # 0xA1, 0x03, 0xXX, 0xXX, 0xXX, 0xXX, 0xXX, 0xXX, 0xXX]
+    MOUSE_16BIT_STRUCT = struct.Struct("<BBBhhbb")
+    MOUSE_REPORT_IDS = (2, 3)
+    # A repeated report is sent again after this time, e.g. the idle mouse sync frame
+    REPEAT_WINDOW = 1
+
+    def __init__(self):
+        self._keyboard_buffer = bytearray(HidReportEncoder.KEYBOARD_STRUCT.size)
+        self._keyboard_nkro_buffer = bytearray(HidReportEncoder.KEYBOARD_NKRO_STRUCT.size)
+        self._mouse_8bit_buffer = bytearray(HidReportEncoder.MOUSE_8BIT_STRUCT.size)
+        self._mouse_16bit_buffer = bytearray(HidReportEncoder.MOUSE_16BIT_STRUCT.size)
+        # (host, report id) -> (last sent report, send time)
+        self._last_reports = {}
+
+    def keyboard_report(self, modifiers_int, keys):
+        HidReportEncoder.KEYBOARD_STRUCT.pack_into(self._keyboard_buffer, 0, 0xA1, 1, modifiers_int, 0, bytes(keys))
+        return self._keyboard_buffer
+
+    def keyboard_nkro_report(self, modifiers_int, key_bitmap):
+        HidReportEncoder.KEYBOARD_NKRO_STRUCT.pack_into(self._keyboard_nkro_buffer, 0, 0xA1, 4, modifiers_int, bytes(key_bitmap))
+        return self._keyboard_nkro_buffer
+
+    @staticmethod
+    def key_bitmap_from_keys(keys):
+        """Builds the N-key rollover bitmap of a 6 key slot report."""
+        key_bitmap = bytearray(HidReportEncoder.KEY_BITMAP_SIZE)
+        for key in keys:
+            if key:
+                key_bitmap[key >> 3] |= 1 << (key & 7)
+        return key_bitmap
+
+    def mouse_report_8bit(self, buttons_int, x_pos, y_pos, v_wheel, h_wheel):
+        HidReportEncoder.MOUSE_8BIT_STRUCT.pack_into(self._mouse_8bit_buffer, 0, 0xA1, 2, buttons_int, x_pos, y_pos, v_wheel, h_wheel)
+        return self._mouse_8bit_buffer
+
+    def mouse_report_16bit(self, buttons_int, x_pos, y_pos, v_wheel, h_wheel):
+        HidReportEncoder.MOUSE_16BIT_STRUCT.pack_into(self._mouse_16bit_buffer, 0, 0xA1, 3, buttons_int, x_pos, y_pos, v_wheel, h_wheel)
+        return self._mouse_16bit_buffer
+
+    def is_repeated(self, host, report):
+        """Checks if the report equals the last one sent to the host and
+        otherwise remembers it as the last sent report."""
+        report_id = report[1]
+        # Mouse motion is relative - only a report without motion can be repeated
+        if report_id in HidReportEncoder.MOUSE_REPORT_IDS and any(report[3:]):
+            return False
+        now = time.monotonic()
+        key = (host, report_id)
+        last_report = self._last_reports.get(key)
+        if last_report and last_report[0] == report and now - last_report[1] < HidReportEncoder.REPEAT_WINDOW:
+            return True
+        self._last_reports[key] = (bytes(report), now)
+        return False
+
+if __name__ == "__main__":
+    encoder = HidReportEncoder()
+    print(bytes(encoder.keyboard_report(0x02, [4, 0, 0, 0, 0, 0])) == bytes([0xA1, 1, 2, 0, 4, 0, 0, 0, 0, 0]))
+    key_bitmap = HidReportEncoder.key_bitmap_from_keys([4, 0x2C, 0, 0, 0, 0])
+    print(bytes(encoder.keyboard_nkro_report(0x02, key_bitmap)) == bytes([0xA1, 4, 2, 0x10, 0, 0, 0, 0, 0x10] + [0] * 26))
+    print(bytes(encoder.mouse_report_8bit(1, -1, 127, -127, 0)) == bytes([0xA1, 2, 1, 255, 127, 129, 0]))
+    print(bytes(encoder.mouse_report_16bit(0, -2, 300, 1, -1)) == bytes([0xA1, 3, 0, 254, 255, 44, 1, 1, 255]))
+    print(not encoder.is_repeated("host", encoder.keyboard_report(0, [4, 0, 0, 0, 0, 0])))
+    print(encoder.is_repeated("host", encoder.keyboard_report(0, [4, 0, 0, 0, 0, 0])))
+    print(not encoder.is_repeated("other host", encoder.keyboard_report(0, [4, 0, 0, 0, 0, 0])))
+    print(not encoder.is_repeated("host", encoder.mouse_report_8bit(0, 1, 0, 0, 0)))
+    print(not encoder.is_repeated("host", encoder.mouse_report_8bit(0, 1, 0, 0, 0)))
@@ -1,11 +1,68 @@
 #!/usr/bin/python3
 
+import os
+import enum
 import asyncio
 import evdev
 import logging
+from input_hotplug import InputHotplugWatcher, HotplugAction
+
+class DeviceClass(enum.Enum):
+    Keyboard = 1
+    Mouse = 2
+    Ignored = 3 # e.g. power buttons, lid switches and accelerometers
+
+class DeviceClassifier(object):
+    # Typing keys: most letters plus space make a keyboard. Remotes and HDMI-CEC
+    # nodes (arrows, digits, enter, volume) do not, they need hid.allowDevices.
+    LETTER_KEYS = {getattr(evdev.ecodes, f"KEY_{letter}") for letter in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"}
+    MIN_LETTER_KEYS = 20
+    # A standalone numpad has the complete keypad digit block
+    KEYPAD_KEYS = {getattr(evdev.ecodes, f"KEY_KP{digit}") for digit in "0123456789"}
+
+    def __init__(self, allow_devices=(), deny_devices=()):
+        # Device names or ids in the format "vendor:product" (hex)
+        self._allow_devices = set(allow_devices)
+        self._deny_devices = set(deny_devices)
+
+    def classify(self, fingerprint, capabilities):
+        vendor, product, version, phys, name = fingerprint
+        device_ids = {name, f"{vendor}:{product}"}
+        keys = set(capabilities.get(evdev.ecodes.EV_KEY, []))
+        if device_ids & self._deny_devices:
+            return DeviceClass.Ignored
+        if evdev.ecodes.BTN_RIGHT in keys:
+            return DeviceClass.Mouse
+        relative_axes = set(capabilities.get(evdev.ecodes.EV_REL, []))
+        if evdev.ecodes.BTN_LEFT in keys and evdev.ecodes.REL_X in relative_axes and evdev.ecodes.REL_Y in relative_axes:
+            return DeviceClass.Mouse
+        if evdev.ecodes.KEY_SPACE in keys and len(DeviceClassifier.LETTER_KEYS & keys) >= DeviceClassifier.MIN_LETTER_KEYS:
+            return DeviceClass.Keyboard
+        if DeviceClassifier.KEYPAD_KEYS <= keys:
+            return DeviceClass.Keyboard
+        if device_ids & self._allow_devices:
+            return DeviceClass.Keyboard
+        return DeviceClass.Ignored
 
 class HidScanner(object):
-    def __init__(self):
+    POLL_INTERVAL = 5 # Scan interval if hotplug events are not available
+    SYSFS_INPUT_PATH = "/sys/class/input"
+
+    def __init__(self, settings=None, input_path=InputHotplugWatcher.INPUT_PATH, sysfs_path=SYSFS_INPUT_PATH):
+        self._input_path = input_path
+        self._sysfs_path = sysfs_path
+        if settings:
+            self._classifier = DeviceClassifier(settings['hid']['allowDevices'], settings['hid']['denyDevices'])
+        else:
+            self._classifier = DeviceClassifier()
+        # (vendor, product, version, phys, name) -> DeviceClass, known devices need no ioctl
+        self._device_classes = {}
+        # path -> (evdev.InputDevice, DeviceClass), devices stay open between scans.
+        # Handed out devices are closed by their reader on the event loop thread
+        # when the read loop ends, this scan runs in an executor thread.
+        self._open_devices = {}
+        self._ignored_paths = set()
+        self._watcher = None
         self._devices = []
         self._keyboards = []
         self._mice = []
@@ -22,20 +79,96 @@ class HidScanner(object):
     def mouse_devices(self):
         return self._mice
 
-    async def scan(self):
+    async def scan(self, added_paths=()):
+        """added_paths: paths of hotplug add events - known ones were recreated and are opened again."""
         loop = asyncio.get_running_loop()
-        await loop.run_in_executor(None, self._scan_for_devices_via_blocking_evdev)
-    
-    def _scan_for_devices_via_blocking_evdev(self):
-        self._devices = [evdev.InputDevice(path) for path in evdev.list_devices()]
-        self._keyboards = []
-        self._mice = []
-        for device in self._devices:
-            # has device a right button -> it's a mouse
-            if evdev.ecodes.BTN_RIGHT in device.capabilities().get(evdev.ecodes.EV_KEY, []):
-                self._mice.append(device)
+        await loop.run_in_executor(None, self._scan_for_devices_via_blocking_evdev, set(added_paths))
+
+    def rescan_device(self, path):
+        """Scans again after the reader of the device ended. A device which still
+        exists, e.g. after a read error, is opened again."""
+        if self._watcher:
+            self._watcher.add_event(HotplugAction.Changed, path)
+
+    async def run(self, on_devices_change):
+        """Scans the devices and scans again on every hotplug event.
+        on_devices_change is called after each scan."""
+        await self.scan()
+        on_devices_change()
+        watcher = InputHotplugWatcher(self._input_path)
+        try:
+            watcher.start()
+        except OSError as e:
+            logging.warning(f"HID: Hotplug events not available - scanning every {HidScanner.POLL_INTERVAL} s: {e}")
+            while True:
+                await asyncio.sleep(HidScanner.POLL_INTERVAL)
+                await self.scan()
+                on_devices_change()
+        self._watcher = watcher
+        try:
+            while True:
+                events = await watcher.wait()
+                for action, path in events:
+                    logging.debug(f"HID: Hotplug {action.name}: {path}")
+                await self.scan([path for action, path in events if action == HotplugAction.Added])
+                on_devices_change()
+        finally:
+            self._watcher = None
+            watcher.stop()
+
+    def _scan_for_devices_via_blocking_evdev(self, added_paths=set()):
+        paths = evdev.list_devices(self._input_path)
+        for path, (device, device_class) in list(self._open_devices.items()):
+            # Removed, recreated under the same name or closed by its reader after a read error
+            if path not in paths or path in added_paths or device.fd < 0:
+                self._open_devices.pop(path)
+        self._ignored_paths &= set(paths) - added_paths
+        for path in paths:
+            if path not in self._open_devices and path not in self._ignored_paths:
+                self._add_device(path)
+        self._devices = [device for device, device_class in self._open_devices.values()]
+        self._keyboards = [device for device, device_class in self._open_devices.values() if device_class == DeviceClass.Keyboard]
+        self._mice = [device for device, device_class in self._open_devices.values() if device_class == DeviceClass.Mouse]
+
+    def _add_device(self, path):
+        fingerprint = self._read_sysfs_fingerprint(path)
+        device_class = self._device_classes.get(fingerprint)
+        if device_class == DeviceClass.Ignored:
+            self._ignored_paths.add(path)
+            return
+        try:
+            device = evdev.InputDevice(path)
+        except OSError as e:
+            # e.g. permissions not yet set by udev - retried on the next hotplug event
+            logging.debug(f"HID: {path} could not be opened: {e}")
+            return
+        if not device_class:
+            if not fingerprint:
+                fingerprint = (f"{device.info.vendor:04x}", f"{device.info.product:04x}", f"{device.info.version:04x}", device.phys, device.name)
+            device_class = self._classifier.classify(fingerprint, device.capabilities())
+            self._device_classes[fingerprint] = device_class
+            if device_class == DeviceClass.Ignored:
+                logging.info(f"HID: {device.name} ({path}) ignored - neither typing keys nor mouse buttons, "
+                    f"add \"{device.name}\" or \"{fingerprint[0]}:{fingerprint[1]}\" to hid.allowDevices to use it as keyboard")
             else:
-                self._keyboards.append(device)
+                logging.info(f"HID: {device.name} ({path}) classified as {device_class.name}")
+        if device_class == DeviceClass.Ignored:
+            device.close()
+            self._ignored_paths.add(path)
+        else:
+            self._open_devices[path] = (device, device_class)
+
+    def _read_sysfs_fingerprint(self, path):
+        """(vendor, product, version, phys, name) of the device without opening it or None."""
+        sysfs_device_path = os.path.join(self._sysfs_path, os.path.basename(path), "device")
+        try:
+            fingerprint = []
+            for attribute in ["id/vendor", "id/product", "id/version", "phys", "name"]:
+                with open(os.path.join(sysfs_device_path, attribute), 'r') as f:
+                    fingerprint.append(f.read().strip())
+            return tuple(fingerprint)
+        except OSError:
+            return None
 
     def info(self, verbose=False):
         logging.info(f"=== devices ========================")
@@ -51,8 +184,23 @@ class HidScanner(object):
         for device in self._mice:
             logging.info(f"{device.path} {device.name} {device.phys}")
 
+def check_classifier():
+    # Keyboards and numpads are used, remote control style nodes only if allowed
+    ecodes = evdev.ecodes
+    fingerprint = ("0001", "0002", "0001", "", "vc4-hdmi")
+    keyboard_keys = sorted(DeviceClassifier.LETTER_KEYS) + [ecodes.KEY_SPACE, ecodes.KEY_ENTER, ecodes.KEY_LEFTSHIFT]
+    remote_keys = [ecodes.KEY_UP, ecodes.KEY_DOWN, ecodes.KEY_LEFT, ecodes.KEY_RIGHT, ecodes.KEY_ENTER, ecodes.KEY_SELECT,
+        ecodes.KEY_VOLUMEUP, ecodes.KEY_VOLUMEDOWN, ecodes.KEY_MUTE, ecodes.KEY_POWER] + [getattr(ecodes, f"KEY_{digit}") for digit in "0123456789"]
+    classifier = DeviceClassifier()
+    print(classifier.classify(fingerprint, {ecodes.EV_KEY: keyboard_keys}) == DeviceClass.Keyboard)
+    print(classifier.classify(fingerprint, {ecodes.EV_KEY: sorted(DeviceClassifier.KEYPAD_KEYS) + [ecodes.KEY_KPENTER]}) == DeviceClass.Keyboard)
+    print(classifier.classify(fingerprint, {ecodes.EV_KEY: remote_keys}) == DeviceClass.Ignored)
+    print(classifier.classify(fingerprint, {ecodes.EV_KEY: [ecodes.KEY_POWER]}) == DeviceClass.Ignored)
+    print(DeviceClassifier(allow_devices=["vc4-hdmi"]).classify(fingerprint, {ecodes.EV_KEY: remote_keys}) == DeviceClass.Keyboard)
+
 async def main():
     logging.basicConfig(format='HID %(levelname)s: %(message)s', level=logging.DEBUG)
+    check_classifier()
     hid_manager = HidScanner()
     await hid_manager.scan()
     hid_manager.info()
@@ -1,13 +1,29 @@
 #!/usr/bin/python3
 
 import enum
-import numpy
+import time
+import logging
 from settings import Settings
 from usb_hid_decoder import UsbHidDecoder
 
 class HotkeyAktion(enum.Enum):
     SwitchToNextHost = 1
     IndicateHost = 2
+    SwitchToPreviousHost = 3
+    SwitchToHost = 4
+
+class HotkeyBinding(object):
+    def __init__(self, action, strokes, host_number=0):
+        self.action = action
+        # Combination keys (see HotkeyConfig.combination_key) pressed one after another
+        self.strokes = strokes
+        # 1 based position of the connected host in the client order (SwitchToHost)
+        self.host_number = host_number
+
+    def __str__(self):
+        if self.action == HotkeyAktion.SwitchToHost:
+            return f"{self.action.name} {self.host_number}"
+        return self.action.name
 
 class HotkeyConfig(object):
     def __init__(self, settings):
@@ -19,71 +35,161 @@ class HotkeyConfig(object):
         self.__init_keys()
     
     def __init_keys(self):
-        self.keys = {
-            HotkeyAktion.SwitchToNextHost: self._settings['hotkeys']['nextHost'],
-        }
-        self.__reduce_keys_to_compareable_format()
-
-    def __reduce_keys_to_compareable_format(self):
-        for action, hotkey_combination in self.keys.items():
-            reduced_combination = self.__combine_bitmask_and_remove_vendor_reserved(hotkey_combination)
-            self.keys[action] = reduced_combination
-    
-    def __combine_bitmask_and_remove_vendor_reserved(self, keyboard_input):
-        modifiers_int = UsbHidDecoder.convert_modifier_bit_mask_to_int(keyboard_input[0])
-        return [modifiers_int, *keyboard_input[1:7]]
+        self.sequence_timeout = self._settings['hotkeys']['sequenceTimeout']
+        self.bindings = [HotkeyBinding(HotkeyAktion.SwitchToNextHost, [HotkeyConfig.stroke_key(self._settings['hotkeys']['nextHost'])])]
+        for binding_settings in self._settings['hotkeys']['bindings']:
+            binding = HotkeyConfig.__create_binding(binding_settings)
+            if binding:
+                self.bindings.append(binding)
+
+    @staticmethod
+    def __create_binding(binding_settings):
+        try:
+            action = HotkeyAktion[binding_settings['action']]
+            strokes = [HotkeyConfig.stroke_key(stroke) for stroke in binding_settings['strokes']]
+            host_number = binding_settings.get('host', 0)
+        except (KeyError, TypeError, IndexError) as e:
+            logging.error(f"Hotkey: Invalid binding {binding_settings}: {e}")
+            return None
+        if not strokes or (action == HotkeyAktion.SwitchToHost and host_number < 1):
+            logging.error(f"Hotkey: Invalid binding {binding_settings}")
+            return None
+        return HotkeyBinding(action, strokes, host_number)
+
+    @staticmethod
+    def stroke_key(hotkey_combination):
+        """Combination key of a stroke in the settings format: [[8x modifier bool], up to 6 keys]"""
+        modifiers_int = UsbHidDecoder.convert_modifier_bit_mask_to_int(hotkey_combination[0])
+        keys = list(hotkey_combination[1:7])
+        keys += [0] * (6 - len(keys))
+        return HotkeyConfig.combination_key(modifiers_int, keys)
 
-class RingBuffer(object):
-    def __init__(self, size):
-        self.size = size
-        self.reset()
+    @staticmethod
+    def combination_key(modifiers_int, keys):
+        """Hashable key of the 6 key slots independent of the slot order.
+        Free slots (0) are part of the set, so both sides need all 6 slots."""
+        return (modifiers_int, frozenset(keys))
 
-    def reset(self):
-        self.data = [None for i in range(self.size)]
+class HotkeyTrie(object):
+    """Precompiled state machine over the strokes of all bindings.
 
-    def append(self, x):
-        self.data.insert(0, x)
-        self.data.pop(self.size)
+    Every node maps the combination key of the next stroke to its child, so
+    a keyboard report is matched with one dict lookup independent of the
+    number of bindings. Bindings sharing a prefix with an earlier binding
+    (e.g. a single and a double tap of the same key) can not be told apart
+    without delaying the shorter one - the earlier binding is kept.
+    """
+    class Node(object):
+        __slots__ = ["stroke", "children", "binding"]
 
-    def get(self):
-        return self.data
+        def __init__(self, stroke=None):
+            self.stroke = stroke
+            self.children = {}
+            self.binding = None
+
+    def __init__(self, bindings):
+        self.root = HotkeyTrie.Node()
+        for binding in bindings:
+            self._insert(binding)
+
+    def _insert(self, binding):
+        node = self.root
+        for stroke in binding.strokes:
+            if node.binding:
+                logging.warning(f"Hotkey: {binding} is unreachable - starts with the strokes of {node.binding}")
+                return
+            node = node.children.setdefault(stroke, HotkeyTrie.Node(stroke))
+        if node.binding or node.children:
+            logging.warning(f"Hotkey: {binding} is unreachable - conflicts with an earlier binding")
+            return
+        node.binding = binding
 
 class HotkeyDetector(object):
+    # Combination key part of a report without pressed regular keys
+    NO_KEYS = frozenset((0,))
+    NEXT_HOST_BINDING = HotkeyBinding(HotkeyAktion.SwitchToNextHost, [])
+
     def __init__(self, hotKeyConfig):
         self._config = hotKeyConfig
-        self._hot_keys = self._config.keys
-        self._key_strokes = RingBuffer(1)
-        self._mouse_buttons = [False, False, False, False, False, False, False, False]
+        self._compile()
+        self._mouse_buttons = 0
         self.activation = None
 
     def reload_settings(self):
         self._config.reload_settings()
-        self._hot_keys = self._config.keys
+        self._compile()
 
-    def evaluate_new_input(self, new_input):
-        self._key_strokes.append(new_input)
-        self.activation = None
-        for action, key_combination in self._hot_keys.items():
-            if numpy.array_equal(key_combination, self._key_strokes.get()[0]):
-                self.activation = action
-                self._key_strokes.reset()
-                break
+    def _compile(self):
+        self._trie = HotkeyTrie(self._config.bindings)
+        self._sequence_timeout = self._config.sequence_timeout
+        self._node = self._trie.root
+        self._last_stroke_time = 0
+
+    def evaluate_new_input(self, modifiers_int, keys):
+        """Returns the binding completed by this keyboard report or None."""
+        combination_key = HotkeyConfig.combination_key(modifiers_int, keys)
+        node = self._node
+        if node is not self._trie.root and time.monotonic() - self._last_stroke_time > self._sequence_timeout:
+            node = self._trie.root
+        next_node = node.children.get(combination_key)
+        if next_node is None:
+            if combination_key[1] == HotkeyDetector.NO_KEYS or (node.stroke and combination_key[1] >= node.stroke[1]):
+                # Releasing keys, changing modifiers or pressing the next key while the
+                # last stroke is still held keeps the sequence
+                self._node = node
+                self.activation = None
+                return None
+            # A stroke not continuing the sequence may start a new one
+            next_node = self._trie.root.children.get(combination_key)
+            if next_node is None:
+                self._node = self._trie.root
+                self.activation = None
+                return None
+        self.activation = next_node.binding
+        if self.activation:
+            self._node = self._trie.root
+        else:
+            self._node = next_node
+            self._last_stroke_time = time.monotonic()
         return self.activation
 
     def evaluate_new_mouse_input(self, new_mouse_button_input):
         last_mouse_buttons_buffer = self._mouse_buttons
         self._mouse_buttons = new_mouse_button_input
-        if new_mouse_button_input[2] and not last_mouse_buttons_buffer[2]:
-            return HotkeyAktion.SwitchToNextHost
+        # Bit 0x20 is not defined by USB - used as placeholder for the client switch button
+        if (new_mouse_button_input & 0x20) and not (last_mouse_buttons_buffer & 0x20):
+            return HotkeyDetector.NEXT_HOST_BINDING
         return None
             
 
 if __name__ == "__main__":
     settings = Settings()
+    no_modifiers = [False, False, False, False, False, False, False, False]
+    ctrl_alt = [False, False, False, False, False, True, False, True]
+    settings['hotkeys']['bindings'] = [
+        {"action": "SwitchToHost", "host": 2, "strokes": [[ctrl_alt, 0x1F]]}, # Ctrl+Alt+2
+        {"action": "SwitchToPreviousHost", "strokes": [[no_modifiers, 0x48], [no_modifiers, 0x48]]}, # Double tap Pause
+        {"action": "IndicateHost", "strokes": [[ctrl_alt, 0x0C], [ctrl_alt, 0x0B]]}, # Ctrl+Alt+I, Ctrl+Alt+H
+        {"action": "SwitchToHost", "host": 3, "strokes": [[no_modifiers, 0x47], [no_modifiers, 0x20]]}, # Unreachable: ScrollLock is next host
+    ]
     config = HotkeyConfig(settings)
     detector = HotkeyDetector(config)
-    print(detector.evaluate_new_input([0, 0, 0, 0, 0, 0, 0]) == None)
-    print(detector.evaluate_new_input([0, 0x47, 0, 0, 0, 0, 0]) == HotkeyAktion.SwitchToNextHost)
-    print(detector.evaluate_new_input([0, 0x46, 0, 0, 0, 0, 0]) == None)
-    print(detector.evaluate_new_input([0, 0x47, 0, 0, 0, 0, 0]) == HotkeyAktion.SwitchToNextHost)
-    print(detector.evaluate_new_input([0, 0, 0, 0, 0, 0, 0]) == None)
+    def action(binding):
+        return binding.action if binding else None
+    print(action(detector.evaluate_new_input(0, [0, 0, 0, 0, 0, 0])) == None)
+    print(action(detector.evaluate_new_input(0, [0x47, 0, 0, 0, 0, 0])) == HotkeyAktion.SwitchToNextHost)
+    print(action(detector.evaluate_new_input(0, [0x46, 0, 0, 0, 0, 0])) == None)
+    print(action(detector.evaluate_new_input(0, [0, 0, 0x47, 0, 0, 0])) == HotkeyAktion.SwitchToNextHost)
+    print(action(detector.evaluate_new_input(0x02, [0x47, 0, 0, 0, 0, 0])) == None)
+    print(action(detector.evaluate_new_input(0, [0, 0, 0, 0, 0, 0])) == None)
+    binding = detector.evaluate_new_input(0x05, [0x1F, 0, 0, 0, 0, 0])
+    print(action(binding) == HotkeyAktion.SwitchToHost and binding.host_number == 2)
+    print(action(detector.evaluate_new_input(0, [0x48, 0, 0, 0, 0, 0])) == None)
+    print(action(detector.evaluate_new_input(0, [0, 0, 0, 0, 0, 0])) == None)
+    print(action(detector.evaluate_new_input(0, [0x48, 0, 0, 0, 0, 0])) == HotkeyAktion.SwitchToPreviousHost)
+    print(action(detector.evaluate_new_input(0x05, [0x0C, 0, 0, 0, 0, 0])) == None)
+    print(action(detector.evaluate_new_input(0x05, [0x0B, 0x0C, 0, 0, 0, 0])) == None) # I still pressed
+    print(action(detector.evaluate_new_input(0x05, [0x0B, 0, 0, 0, 0, 0])) == HotkeyAktion.IndicateHost)
+    print(action(detector.evaluate_new_input(0, [0x48, 0, 0, 0, 0, 0])) == None)
+    detector._last_stroke_time -= config.sequence_timeout
+    print(action(detector.evaluate_new_input(0, [0x48, 0, 0, 0, 0, 0])) == None) # Timed out - starts a new sequence
@@ -8,7 +8,8 @@ import time
 import logging
 
 class InfoHub(object):
-    def __init__(self):
+    def __init__(self, kvm_dbus_iface=None):
+        self._kvm_dbus_iface = kvm_dbus_iface
         self._display = LcdDisplay()
         self._current_host = ""
         self._next_host = None
@@ -117,8 +118,9 @@ class InfoHub(object):
         await self._show_welcome()
 
         if not is_restart:
-            logging.info(f"D-Bus service connecting...")
-            await self._connect_to_dbus_service()
+            if not self._kvm_dbus_iface:
+                logging.info(f"D-Bus service connecting...")
+                await self._connect_to_dbus_service()
             await self._register_to_dbus_signals() # ready to handle signals and to display them
         await self._fetch_and_display_clients()
 
@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+
+import os
+import enum
+import struct
+import ctypes
+import ctypes.util
+import asyncio
+import logging
+import tempfile
+
+class HotplugAction(enum.Enum):
+    Added = 1
+    Removed = 2
+    Changed = 3 # Attributes changed, e.g. permissions set by udev after creation
+    Overflow = 4 # Kernel event queue overflowed - events were lost, rescan everything
+
+class InputHotplugWatcher(object):
+    """Watches a directory (/dev/input) via inotify for added and removed device nodes.
+
+    Nothing is polled, the event loop wakes up only when the directory changes.
+    """
+    INPUT_PATH = "/dev/input"
+    # inotify constants from <sys/inotify.h>
+    IN_ATTRIB = 0x00000004
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    WATCH_MASK = IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    # struct inotify_event: wd, mask, cookie, len - followed by the name
+    EVENT_STRUCT = struct.Struct("iIII")
+
+    def __init__(self, path=INPUT_PATH, name_prefix="event"):
+        self._path = path
+        self._name_prefix = name_prefix
+        self._fd = None
+        self._loop = None
+        self._events = []
+        self._waiter = None
+
+    @property
+    def path(self):
+        return self._path
+
+    def start(self):
+        """Raises OSError if inotify is not available."""
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(InputHotplugWatcher.IN_NONBLOCK | InputHotplugWatcher.IN_CLOEXEC)
+        if fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_init1: {os.strerror(errno)}")
+        if libc.inotify_add_watch(fd, os.fsencode(self._path), InputHotplugWatcher.WATCH_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(fd)
+            raise OSError(errno, f"inotify_add_watch {self._path}: {os.strerror(errno)}")
+        self._fd = fd
+        self._loop = asyncio.get_running_loop()
+        self._loop.add_reader(self._fd, self._on_readable)
+        logging.debug(f"Hotplug: Watching {self._path}")
+
+    def stop(self):
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+    async def wait(self):
+        """Waits for hotplug events and returns all pending ones as (HotplugAction, path)."""
+        if not self._events:
+            self._waiter = self._loop.create_future()
+            await self._waiter
+        events = self._events
+        self._events = []
+        return events
+
+    def add_event(self, action, path):
+        """Queues an event like one of the kernel, e.g. to scan a device again."""
+        self._events.append((action, path))
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _on_readable(self):
+        while True:
+            try:
+                buffer = os.read(self._fd, 4096)
+            except BlockingIOError:
+                break
+            if not buffer:
+                break
+            self._parse(buffer)
+        if self._events and self._waiter and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def _parse(self, buffer):
+        offset = 0
+        while offset + InputHotplugWatcher.EVENT_STRUCT.size <= len(buffer):
+            wd, mask, cookie, name_length = InputHotplugWatcher.EVENT_STRUCT.unpack_from(buffer, offset)
+            offset += InputHotplugWatcher.EVENT_STRUCT.size
+            name = buffer[offset:offset + name_length].rstrip(b"\0").decode(errors="replace")
+            offset += name_length
+            if mask & InputHotplugWatcher.IN_Q_OVERFLOW:
+                self._events.append((HotplugAction.Overflow, self._path))
+                continue
+            if not name.startswith(self._name_prefix):
+                continue
+            device_path = os.path.join(self._path, name)
+            if mask & (InputHotplugWatcher.IN_CREATE | InputHotplugWatcher.IN_MOVED_TO):
+                self._events.append((HotplugAction.Added, device_path))
+            elif mask & (InputHotplugWatcher.IN_DELETE | InputHotplugWatcher.IN_MOVED_FROM):
+                self._events.append((HotplugAction.Removed, device_path))
+            elif mask & InputHotplugWatcher.IN_ATTRIB:
+                self._events.append((HotplugAction.Changed, device_path))
+
+async def main():
+    # Plug and unplug fake device nodes inside a temp directory
+    with tempfile.TemporaryDirectory() as input_path:
+        watcher = InputHotplugWatcher(input_path)
+        watcher.start()
+        open(os.path.join(input_path, "event7"), "w").close()
+        open(os.path.join(input_path, "mouse0"), "w").close()
+        os.remove(os.path.join(input_path, "event7"))
+        events = await asyncio.wait_for(watcher.wait(), 1)
+        print([action for action, path in events] == [HotplugAction.Added, HotplugAction.Removed])
+        print(all(path == os.path.join(input_path, "event7") for action, path in events))
+        os.chmod(input_path, 0o755)
+        os.rename(os.path.join(input_path, "mouse0"), os.path.join(input_path, "event8"))
+        events = await asyncio.wait_for(watcher.wait(), 1)
+        print(events == [(HotplugAction.Added, os.path.join(input_path, "event8"))])
+        watcher.stop()
+
+if __name__ == "__main__":
+    asyncio.run( main() )
@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+
+import enum
+import time
+import struct
+import asyncio
+import logging
+import argparse
+import evdev
+from settings import Settings
+from latency import event_time_us
+from report_channel import DirectReportLink
+from keyboard import Keyboard, KeyboardAggregator, run_keyboards
+from mouse import KvmMouse, EventMouse, run_mice
+
+class InputTraceDeviceKind(enum.Enum):
+    Keyboard = 1
+    Mouse = 2
+
+class InputTraceFile(object):
+    """Binary trace of the evdev event streams of keyboards and mice.
+
+    The file starts with MAGIC followed by records. A device record announces
+    a device followed by its name, the event records reference it by its id.
+    """
+    MAGIC = b"RKVMTRC1"
+    # |- Event time in microseconds
+    # |  |- Device id
+    # |  |  |- evdev event type, DEVICE_RECORD for a device record
+    # |  |  |  |- evdev event code, InputTraceDeviceKind for a device record
+    # |  |  |  |  |- evdev event value, length of the name for a device record
+    # q, H, H, H, i
+    RECORD_STRUCT = struct.Struct("<qHHHi")
+    DEVICE_RECORD = 0xFFFF
+    MAX_DEVICES = 0x10000
+
+    @staticmethod
+    def read(path):
+        """Returns the devices as {device id: (InputTraceDeviceKind, name)} and
+        the events as list of (time us, device id, type, code, value)."""
+        with open(path, "rb") as f:
+            content = f.read()
+        if not content.startswith(InputTraceFile.MAGIC):
+            raise ValueError(f"{path}: Not an input trace file")
+        devices = {}
+        events = []
+        offset = len(InputTraceFile.MAGIC)
+        record_size = InputTraceFile.RECORD_STRUCT.size
+        while offset + record_size <= len(content):
+            record = InputTraceFile.RECORD_STRUCT.unpack_from(content, offset)
+            offset += record_size
+            time_us, device_id, event_type, code, value = record
+            if event_type == InputTraceFile.DEVICE_RECORD:
+                devices[device_id] = (InputTraceDeviceKind(code), content[offset:offset + value].decode(errors="replace"))
+                offset += value
+            else:
+                events.append(record)
+        return devices, events
+
+class InputTraceRecorder(object):
+    """Writes the events of the keyboards and mice it is attached to into a trace file."""
+    def __init__(self, path):
+        self._file = open(path, "wb")
+        self._file.write(InputTraceFile.MAGIC)
+        self._device_count = 0
+        self._event_count = 0
+
+    @property
+    def event_count(self):
+        return self._event_count
+
+    def add_keyboard(self, name):
+        """Returns the callback recording the events of the keyboard."""
+        return self._add_device(InputTraceDeviceKind.Keyboard, name)
+
+    def add_mouse(self, name):
+        """Returns the callback recording the events of the mouse."""
+        return self._add_device(InputTraceDeviceKind.Mouse, name)
+
+    def _add_device(self, kind, name):
+        if self._device_count == InputTraceFile.MAX_DEVICES:
+            raise ValueError(f"Input trace: More than {InputTraceFile.MAX_DEVICES} devices")
+        device_id = self._device_count
+        self._device_count += 1
+        name_bytes = name.encode()
+        self._file.write(InputTraceFile.RECORD_STRUCT.pack(0, device_id, InputTraceFile.DEVICE_RECORD, kind.value, len(name_bytes)))
+        self._file.write(name_bytes)
+        logging.info(f"Input trace: Recording {kind.name} {device_id} - {name}")
+
+        def record_event(event):
+            self._file.write(InputTraceFile.RECORD_STRUCT.pack(event_time_us(event), device_id, event.type, event.code, event.value))
+            self._event_count += 1
+        return record_event
+
+    def close(self):
+        self._file.close()
+
+class CountingReportHandler(object):
+    """Stands in for the kvm service and counts the reports reaching it."""
+    def __init__(self):
+        self.keyboard_reports = 0
+        self.mouse_reports = 0
+
+    def handle_keyboard_report(self, modifiers_int, keys, event_time_us=0, built_time_us=0, key_bitmap=None):
+        self.keyboard_reports += 1
+
+    def handle_mouse_report(self, buttons_int, x_pos, y_pos, v_wheel, h_wheel, event_time_us=0, built_time_us=0):
+        self.mouse_reports += 1
+
+    def get_link_stats(self):
+        # No bluetooth link - the mouse frame scheduler keeps its minimum rate
+        return None
+
+class TraceInputDevice(object):
+    """Stands in for the evdev input device of a recorded device."""
+    def __init__(self, device_id, name):
+        self.path = f"trace:{device_id}"
+        self.name = name
+
+class InputTraceReplayer(object):
+    """Feeds a trace through the Keyboard and EventMouse event handlers into the report pipeline.
+
+    In real time the recorded timing is kept and the mouse frame scheduler
+    paces the mouse reports. As fast as possible every completed mouse frame
+    is sent right away, so the reports only depend on the trace.
+    """
+    def __init__(self, path, report_handler=None, batch_frames=True):
+        self._devices, self._events = InputTraceFile.read(path)
+        self._report_handler = report_handler if report_handler else CountingReportHandler()
+        self._batch_frames = batch_frames
+
+    async def run(self, realtime=False):
+        """Returns the throughput, plus the produced reports if the report handler counts them."""
+        report_link = DirectReportLink(self._report_handler)
+        aggregator = KeyboardAggregator(report_link, self._batch_frames)
+        kvm_mouse = KvmMouse(report_link)
+        await aggregator.start()
+        if realtime:
+            await kvm_mouse.start()
+        keyboards = {}
+        mice = {}
+        for device_id, (kind, name) in self._devices.items():
+            input_device = TraceInputDevice(device_id, name)
+            if kind == InputTraceDeviceKind.Keyboard:
+                keyboards[device_id] = Keyboard(input_device, aggregator)
+                aggregator.keyboards[input_device.path] = keyboards[device_id]
+            else:
+                mice[device_id] = EventMouse(input_device)
+                mice[device_id].commit_frame_cb = kvm_mouse.scheduler.commit_frame
+                kvm_mouse.event_mice[input_device.path] = mice[device_id]
+
+        loop = asyncio.get_running_loop()
+        first_time_us = self._events[0][0] if self._events else 0
+        start_time = loop.time()
+        start_ns = time.perf_counter_ns()
+        for time_us, device_id, event_type, code, value in self._events:
+            if realtime:
+                delay = start_time + (time_us - first_time_us) / 1_000_000 - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            event = evdev.InputEvent(time_us // 1_000_000, time_us % 1_000_000, event_type, code, value)
+            if device_id in keyboards:
+                await keyboards[device_id]._handle_event(event)
+            elif device_id in mice:
+                mice[device_id]._handle_event(event)
+                if not realtime and event_type == evdev.ecodes.EV_SYN:
+                    await kvm_mouse.scheduler.flush()
+        await aggregator.commit_frame()
+        await kvm_mouse.scheduler.flush()
+        duration_s = (time.perf_counter_ns() - start_ns) / 1_000_000_000
+        kvm_mouse.stop()
+
+        result = {
+            "events": len(self._events),
+            "duration_s": duration_s,
+            "events_per_s": len(self._events) / duration_s if duration_s else 0,
+        }
+        if isinstance(self._report_handler, CountingReportHandler):
+            result["keyboard_reports"] = self._report_handler.keyboard_reports
+            result["mouse_reports"] = self._report_handler.mouse_reports
+        return result
+
+async def record(path):
+    settings = Settings()
+    settings.load_from_file()
+    recorder = InputTraceRecorder(path)
+    # Nothing grabs the input devices, the recording can run next to the KVM
+    report_link = DirectReportLink(CountingReportHandler())
+    try:
+        await asyncio.gather(
+            run_keyboards(report_link, settings, recorder),
+            run_mice(KvmMouse(report_link), settings, recorder))
+    finally:
+        recorder.close()
+        logging.info(f"Input trace: {recorder.event_count} events written to {path}")
+
+async def replay(path, realtime, batch_frames):
+    result = await InputTraceReplayer(path, batch_frames=batch_frames).run(realtime)
+    print(f"Events: {result['events']} in {result['duration_s']:.3f} s ({result['events_per_s']:.0f} events/s)")
+    print(f"Keyboard reports: {result['keyboard_reports']}")
+    print(f"Mouse reports: {result['mouse_reports']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Records and replays keyboard and mouse input traces")
+    commands = parser.add_subparsers(dest="command", required=True)
+    record_parser = commands.add_parser("record", help="Record all keyboards and mice till Ctrl+C is pressed")
+    record_parser.add_argument("trace")
+    replay_parser = commands.add_parser("replay", help="Replay a trace into the report pipeline")
+    replay_parser.add_argument("trace")
+    replay_parser.add_argument("--realtime", action="store_true", help="Keep the recorded timing instead of replaying as fast as possible")
+    replay_parser.add_argument("--per-key", action="store_true", help="One keyboard report per key change instead of per evdev frame")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        logging.basicConfig(format='Trace %(levelname)s: %(message)s', level=logging.INFO)
+        try:
+            asyncio.run( record(args.trace) )
+        except KeyboardInterrupt:
+            pass
+    else:
+        logging.basicConfig(format='Trace %(levelname)s: %(message)s', level=logging.WARNING)
+        asyncio.run( replay(args.trace, args.realtime, not args.per_key) )
+
+if __name__ == "__main__":
+    main()
@@ -3,28 +3,126 @@
 import asyncio
 import evdev
 from evdev import *
-import dbus_next
-from dbus_next.aio import MessageBus
 import logging
+from settings import Settings
 from hid_scanner import HidScanner
 from usb_hid_decoder import UsbHidDecoder
+from report_channel import KvmReportLink
+from latency import event_time_us
+
+# evdev key code -> usb key code or modifier bit (see UsbHidDecoder.build_evdev_lookup_table)
+KEY_LOOKUP_TABLE = UsbHidDecoder.build_evdev_lookup_table(ecodes.KEY, ecodes.KEY_MAX)
+
+class KeyboardAggregator(object):
+    """Merges the key state of all keyboards into one report stream.
+
+    Keys and modifiers are counted per pressing device, so a key held on two
+    keyboards stays pressed until both released it. A report is only sent
+    if the merged state changed.
+
+    Every key is tracked in a bitmap for the N-key rollover report and in the
+    6 key slots of the boot report, the service picks one per host.
+
+    With frame batching the changes are collected till the device completes
+    its evdev frame (SYN_REPORT), so a chord is sent as one report.
+    """
+    def __init__(self, report_link=None, batch_frames=True):
+        self.keyboards = dict()
+        self._report_link = report_link if report_link else KvmReportLink("Keyboard")
+        self._batch_frames = batch_frames
+        self._has_pending_changes = False
+        # Timestamp of the oldest change not yet sent - used for latency tracing
+        self._first_event_time_us = 0
+        # One byte size (bit map) to represent the pressed modifier keys
+        # 0x80: Right GUI, 0x40: Right Alt, 0x20: Right Shift, 0x10: Right Control
+        # 0x08: Left GUI,  0x04: Left Alt,  0x02: Left Shift,  0x01: Left Control
+        self._modifiers = 0
+        # Place for 6 simultaneously pressed regular keys
+        self._keys = [0, 0, 0, 0, 0, 0]
+        # Bitmap of all pressed regular keys, bit n of byte n // 8 is usb key code n
+        self._key_bitmap = bytearray(32)
+        # usb key code (modifiers with UsbHidDecoder.MODIFIER_KEY_FLAG) -> number of devices pressing it
+        self._press_counts = {}
+
+    async def start(self):
+        logging.info(f"KVM service connecting...")
+        await self._report_link.connect()
+
+    async def press(self, usb_key_code, event_time_us=0):
+        press_count = self._press_counts.get(usb_key_code, 0)
+        self._press_counts[usb_key_code] = press_count + 1
+        if press_count == 0:
+            self._apply(usb_key_code, True)
+            await self._on_state_change(event_time_us)
+
+    async def release(self, usb_key_code, event_time_us=0):
+        press_count = self._press_counts.get(usb_key_code, 0)
+        if press_count == 0:
+            return
+        if press_count > 1:
+            self._press_counts[usb_key_code] = press_count - 1
+            return
+        del self._press_counts[usb_key_code]
+        self._apply(usb_key_code, False)
+        await self._on_state_change(event_time_us)
+
+    async def commit_frame(self):
+        """Sends the changes of the completed evdev frame as one report."""
+        if self._has_pending_changes:
+            first_event_time_us = self._first_event_time_us
+            self._has_pending_changes = False
+            self._first_event_time_us = 0
+            await self._send_state(first_event_time_us)
+
+    async def _on_state_change(self, event_time_us):
+        if not self._batch_frames:
+            await self._send_state(event_time_us)
+            return
+        self._has_pending_changes = True
+        if event_time_us and not self._first_event_time_us:
+            self._first_event_time_us = event_time_us
+
+    def _apply(self, usb_key_code, is_pressed):
+        """Changes the report state for the first press or the last release of a key."""
+        if usb_key_code & UsbHidDecoder.MODIFIER_KEY_FLAG:
+            modifier_bit = usb_key_code & 0xFF
+            if is_pressed:
+                self._modifiers |= modifier_bit
+            else:
+                self._modifiers &= ~modifier_bit
+            return
+        if is_pressed:
+            self._key_bitmap[usb_key_code >> 3] |= 1 << (usb_key_code & 7)
+            # Keys beyond the 6 slots are only part of the bitmap
+            if 0x00 in self._keys:
+                self._keys[self._keys.index(0x00)] = usb_key_code
+            return
+        self._key_bitmap[usb_key_code >> 3] &= ~(1 << (usb_key_code & 7))
+        if usb_key_code in self._keys:
+            # The longest held key without a slot moves into the freed one, 0x00 is a key release
+            self._keys[self._keys.index(usb_key_code)] = self._next_key_without_slot()
+
+    def _next_key_without_slot(self):
+        # _press_counts keeps the press order
+        for usb_key_code in self._press_counts:
+            if not usb_key_code & UsbHidDecoder.MODIFIER_KEY_FLAG and usb_key_code not in self._keys:
+                return usb_key_code
+        return 0x00
+
+    async def _send_state(self, event_time_us=0):
+        logging.debug(f"Keyboard: mod: {self._modifiers:08b} keys: {self._keys}")
+        await self._report_link.send_keyboard(self._modifiers, self._keys, event_time_us, self._key_bitmap)
 
 class Keyboard(object):
-    def __init__(self, input_device):
+    def __init__(self, input_device, aggregator):
         self._is_alive = False
         self._idev = input_device
         logging.info(f"{self._idev.path}: Init Keyboard - {self._idev.name}")
-        self._modifiers = [ # One byte size (bit map) to represent the pressed modifier keys
-            False, # Right GUI
-            False, # Right Alt
-            False, # Right Shift
-            False, # Right Control
-            False, # Left GUI
-            False, # Left Alt
-            False, # Left Shift
-            False] # Left Control
-        # Place for 6 simultaneously pressed regular keys
-        self._keys = [0, 0, 0, 0, 0, 0]
+        self._aggregator = aggregator
+        # usb key codes pressed on this device
+        self._pressed_keys = set()
+        # Called with every evdev event of this device, e.g. by the input trace recorder
+        self.trace_event_cb = None
 
     @property
     def is_alive(self):
@@ -39,92 +137,79 @@ class Keyboard(object):
         return self._idev.name
 
     async def run(self):
-        logging.info(f"{self._idev.path}: D-Bus service connecting...")
-        await self._connect_to_dbus_service()
-        logging.info(f"{self._idev.path}: Starting event loop")
         self._is_alive = True
+        logging.info(f"{self._idev.path}: Starting event loop")
         try:
             await self._event_loop()
         except Exception as e:
             logging.error(f"{self._idev.path}: {e}")
+        # Closed here, the read loop has removed its reader from the event loop
+        self._idev.close()
+        # Keys held while the device is unplugged would stay pressed on the host
+        for usb_key_code in self._pressed_keys:
+            await self._aggregator.release(usb_key_code)
+        self._pressed_keys.clear()
+        await self._aggregator.commit_frame()
         self._is_alive = False
 
     # poll for keyboard events
     async def _event_loop(self):
         async for event in self._idev.async_read_loop():
-            # only bother if we hit a key and its an up or down event
-            if event.type == ecodes.EV_KEY and event.value < 2:
-                self._handle_event(event)
-                await self._send_state()
-
-    async def _connect_to_dbus_service(self):
-        self._kvm_dbus_iface = None
-        while not self._kvm_dbus_iface:
-            try:
-                bus = await MessageBus(bus_type=dbus_next.BusType.SYSTEM).connect()
-                introspection = await bus.introspect(
-                    'org.rpi.kvmservice', '/org/rpi/kvmservice')
-                kvm_service_obj = bus.get_proxy_object(
-                    'org.rpi.kvmservice', '/org/rpi/kvmservice', introspection)
-                self._kvm_dbus_iface = kvm_service_obj.get_interface('org.rpi.kvmservice')
-                logging.info(f"{self._idev.path}: D-Bus service connected")
-            except dbus_next.DBusError:
-                logging.warning(f"{self._idev.path}: D-Bus service not available - reconnecting...")
-                await asyncio.sleep(5)
-
-    async def _send_state(self):
-        modifier_str = ''
-        for i in self._modifiers:
-            mod_value_str = "1" if i else "0"
-            modifier_str += mod_value_str
-        logging.debug(f"{self._idev.path}: mod: {modifier_str} keys: {self._keys}")
-        try:
-            await self._kvm_dbus_iface.call_send_keyboard_usb_telegram(self._modifiers, bytes(self._keys))
-        except dbus_next.DBusError:
-            logging.warning(f"{self._idev.path}: D-Bus connection terminated - reconnecting...")
-            await self._connect_to_dbus_service()
-
-    def _handle_event(self, event):
-        if event.code not in ecodes.KEY:
-            logging.warning(f"{self._idev.path}: unsupported key press code: {event.code}")
+            if self.trace_event_cb:
+                self.trace_event_cb(event)
+            await self._handle_event(event)
+
+    async def _handle_event(self, event):
+        # only bother if we hit a key and its an up or down event
+        if event.type == ecodes.EV_KEY and event.value < 2:
+            await self._handle_key_event(event)
+        elif event.type == ecodes.EV_SYN and event.code == ecodes.SYN_REPORT:
+            await self._aggregator.commit_frame()
+
+    async def _handle_key_event(self, event):
+        usb_key_code = KEY_LOOKUP_TABLE[event.code] if event.code < len(KEY_LOOKUP_TABLE) else 0
+        if not usb_key_code:
+            logging.debug(f"{self._idev.path}: unsupported key press code: {event.code}")
             return
-        evdev_code = ecodes.KEY[event.code]
-        if UsbHidDecoder.is_modifier_key(evdev_code):
-            modifier_index = UsbHidDecoder.encode_modifier_key_index(evdev_code)
-            self._modifiers[modifier_index] = not self._modifiers[modifier_index]
-        else:
-            usb_key_code = UsbHidDecoder.encode_regular_key(evdev_code)
-            for i in range(0, 6):
-                if self._keys[i] == usb_key_code and event.value == 0:
-                    self._keys[i] = 0x00 # Code 0x00 represents a key release
-                elif self._keys[i] == 0x00 and event.value == 1:
-                    self._keys[i] = usb_key_code
-                    break
+        if event.value == 1 and usb_key_code not in self._pressed_keys:
+            self._pressed_keys.add(usb_key_code)
+            await self._aggregator.press(usb_key_code, event_time_us(event))
+        elif event.value == 0 and usb_key_code in self._pressed_keys:
+            self._pressed_keys.remove(usb_key_code)
+            await self._aggregator.release(usb_key_code, event_time_us(event))
 
-async def main():
-    logging.basicConfig(format='KB %(levelname)s: %(message)s', level=logging.DEBUG)
+async def run_keyboards(report_link=None, settings=None, recorder=None):
     logging.info("Creating HID Manager")
-    hid_manager = HidScanner()
-    keyboards = dict()
-
-    while True:
-        await hid_manager.scan()
+    hid_manager = HidScanner(settings)
+    aggregator = KeyboardAggregator(report_link, settings['hid']['keyboardFrameBatching'] if settings else True)
+    await aggregator.start()
 
-        removed_keyboards = [keyboard for keyboard in keyboards.values() if not keyboard.is_alive]
+    def on_devices_change():
+        removed_keyboards = [keyboard for keyboard in aggregator.keyboards.values() if not keyboard.is_alive]
         for keyboard in removed_keyboards:
             logging.info(f"Removing keyboard: {keyboard.path}")
-            del keyboards[keyboard.path]
+            del aggregator.keyboards[keyboard.path]
 
         device_paths = [keyboard_device.path for keyboard_device in hid_manager.keyboard_devices]
         if len(device_paths) == 0:
-            logging.warning("No keyboard found, waiting till next device scan")
+            logging.warning("No keyboard found, waiting till a keyboard is plugged in")
         else:
-            new_keyboards = [keyboard_device for keyboard_device in hid_manager.keyboard_devices if keyboard_device.path not in keyboards]
+            new_keyboards = [keyboard_device for keyboard_device in hid_manager.keyboard_devices if keyboard_device.path not in aggregator.keyboards]
             for keyboard_device in new_keyboards:
-                kb = Keyboard(keyboard_device)
-                keyboards[keyboard_device.path] = kb
-                asyncio.create_task(kb.run())
-        await asyncio.sleep(5)
+                kb = Keyboard(keyboard_device, aggregator)
+                if recorder:
+                    kb.trace_event_cb = recorder.add_keyboard(keyboard_device.name)
+                aggregator.keyboards[keyboard_device.path] = kb
+                task = asyncio.create_task(kb.run())
+                task.add_done_callback(lambda task, path=keyboard_device.path: hid_manager.rescan_device(path))
+
+    await hid_manager.run(on_devices_change)
+
+async def main():
+    logging.basicConfig(format='KB %(levelname)s: %(message)s', level=logging.DEBUG)
+    settings = Settings()
+    settings.load_from_file()
+    await run_keyboards(settings=settings)
 
 if __name__ == "__main__":
     asyncio.run( main() )
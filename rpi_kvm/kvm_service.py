@@ -12,24 +12,64 @@ from dbus_next import Variant
 import signal
 import logging
 import json
+import time
 from settings import Settings
 from bt_server import BtServer
 from hotkey import HotkeyDetector, HotkeyConfig, HotkeyAktion
 from usb_hid_decoder import UsbHidDecoder
+from report_channel import ReportChannelServer, ReportFrame
+from latency import LatencyTracer, now_us
+from mouse_motion import MouseMotionAccumulator
+from hid_report_encoder import HidReportEncoder
+from persistence import JsonFileWriter
 
 class KvmDbusService(ServiceInterface):
+    # Reports per mouse frame for motion not fitting into one report. The rest is
+    # carried into the next frames, so a fast flick is spread over a few frames.
+    MAX_MOUSE_REPORTS_PER_FRAME = 4
+
     def __init__(self, settings, hotkey_detector, bt_server):
         super().__init__("org.rpi.kvmservice")
         self._settings = settings
         self._hotkey_detector = hotkey_detector
         self._bt_server = bt_server
+        self._latency_tracer = bt_server.latency_tracer
+        self._mouse_motion_8bit = MouseMotionAccumulator(127)
+        self._mouse_motion_16bit = MouseMotionAccumulator(32767)
+        # Host the carried motion belongs to
+        self._mouse_motion_host = ""
+        self._report_encoder = HidReportEncoder()
         self._stop_event = False
+        # Handlers of components running inside the same process (see all_in_one.py)
+        self._local_signal_handlers = {
+            "host_change": [],
+            "clients_change": [],
+            "restart_info_hub": [],
+        }
 
     def stop(self):
         self._stop_event = True
 
     def on_clients_change(self, clients):
-        self.signal_clients_change(clients)
+        self._emit_clients_change(clients)
+
+    def add_local_signal_handler(self, signal_name, handler):
+        self._local_signal_handlers[signal_name].append(handler)
+
+    def _emit_host_change(self, client_names):
+        self.signal_host_change(client_names)
+        for handler in self._local_signal_handlers["host_change"]:
+            handler(client_names)
+
+    def _emit_clients_change(self, client_names):
+        self.signal_clients_change(client_names)
+        for handler in self._local_signal_handlers["clients_change"]:
+            handler(client_names)
+
+    def _emit_restart_info_hub(self):
+        self.signal_restart_info_hub()
+        for handler in self._local_signal_handlers["restart_info_hub"]:
+            handler()
 
     async def run(self):
         logging.info("D-Bus: Register D-Bus service")
@@ -56,6 +96,16 @@ class KvmDbusService(ServiceInterface):
     def GetClientsInfo(self) -> 's':
         return json.dumps(self._bt_server.get_clients_info_dict())
 
+    @dbus_next.service.method()
+    def GetLatencyStats(self) -> 's':
+        return json.dumps(self.get_latency_stats())
+
+    def get_latency_stats(self):
+        return {
+            "stages": LatencyTracer.STAGES,
+            "hosts": self._latency_tracer.as_dict()
+        }
+
     @dbus_next.service.method()
     def ConnectClient(self, client_address: 's') -> '':
         self._bt_server.connect_client(client_address)
@@ -78,84 +128,125 @@ class KvmDbusService(ServiceInterface):
 
     @dbus_next.service.method()
     def ReloadSettings(self) -> '':
-        logging.info(f"D-Bus: Reload settings")
-        self._hotkey_detector.reload_settings()
+        self.reload_settings()
         return
     
     @dbus_next.service.method()
     def RestartInfoHub(self) -> '':
-        logging.info(f"D-Bus: Restart Info Hub")
-        self.signal_restart_info_hub()
+        self.restart_info_hub()
         return
 
     @dbus_next.service.method()
     def SwitchActiveHost(self, client_address: 's') -> '':
+        self.switch_active_host(client_address)
+
+    def reload_settings(self):
+        logging.info(f"D-Bus: Reload settings")
+        self._hotkey_detector.reload_settings()
+
+    def restart_info_hub(self):
+        logging.info(f"D-Bus: Restart Info Hub")
+        self._emit_restart_info_hub()
+
+    def switch_active_host(self, client_address):
         self._bt_server.switch_active_host_to(client_address)
         client_names = self._bt_server.get_connected_client_names()
         logging.info(f"D-Bus: Switch active host to: {client_names[0]}")
-        self.signal_host_change(client_names)
+        self._emit_host_change(client_names)
 
     @dbus_next.service.method()
     def SendKeyboardUsbTelegram(self, modifiers: 'ab', keys: 'ay') -> '':
         modifiers_int =  UsbHidDecoder.convert_modifier_bit_mask_to_int(modifiers)
-        action = self._hotkey_detector.evaluate_new_input([modifiers_int, *keys])
-        # Only the last key of the hot key combination will not be sendted
-        if action == HotkeyAktion.SwitchToNextHost:
-            self._bt_server.switch_to_next_connected_host()
-            client_names = self._bt_server.get_connected_client_names()
-            logging.info(f"D-Bus: {action.name}: {client_names[0]}")
-            self.signal_host_change(client_names)
-        else:
-            # |- USB HID input report
-            # |     |- USB HID usage report => Keyboard
-            # |     |     |- Bit mask for modifier keys
-            # |     |     |  0x80: Right GUI
-            # |     |     |  0x40: Right Alt
-            # |     |     |  0x20: Right Shift
-            # |     |     |  0x10: Right Control
-            # |     |     |  0x08: Left GUI
-            # |     |     |  0x04: Left Alt
-            # |     |     |  0x02: Left Shift
-            # |     |     |  0x01: Left Control
-            # |     |     |     |- Vendor reserved
-            # |     |     |     |     |-> 6x pressed keys
-            # 0xA1, 0x01, 0xXX, 0x00, 0xXX, 0xXX, 0xXX, 0xXX, 0xXX, 0xXX
-            keyboard_usb_telegram = [0xA1, 1, modifiers_int, 0, *keys]
-            self._bt_server.send(keyboard_usb_telegram)
+        self.handle_keyboard_report(modifiers_int, keys)
 
     @dbus_next.service.method()
     def SendMouseUsbTelegram(self, buttons: 'ab', x_pos: 'i', y_pos: 'i', v_wheel: 'i', h_wheel: 'i') -> '':
-        action = self._hotkey_detector.evaluate_new_mouse_input(buttons)
-        if action == HotkeyAktion.SwitchToNextHost:
-            self._bt_server.switch_to_next_connected_host()
-            client_names = self._bt_server.get_connected_client_names()
-            logging.info(f"D-Bus: {action.name}: {client_names[0]}")
-            self.signal_host_change(client_names)
+        buttons_int = UsbHidDecoder.convert_modifier_bit_mask_to_int(buttons)
+        self.handle_mouse_report(buttons_int, x_pos, y_pos, v_wheel, h_wheel)
+
+    @dbus_next.service.method()
+    def SendReports(self, reports: 'a(yay)') -> '':
+        for kind, payload in reports:
+            ReportFrame.dispatch_payload(kind, payload, self)
+
+    def get_link_stats(self):
+        return self._bt_server.link_stats
+
+    def _trace_report_arrival(self, event_time_us, built_time_us):
+        host = self._bt_server.active_host_address
+        self._latency_tracer.record("input", host, built_time_us - event_time_us)
+        self._latency_tracer.record("transport", host, now_us() - built_time_us)
+        return host
+
+    def handle_keyboard_report(self, modifiers_int, keys, event_time_us=0, built_time_us=0, key_bitmap=None):
+        if event_time_us:
+            host = self._trace_report_arrival(event_time_us, built_time_us)
+            hotkey_start_ns = time.perf_counter_ns()
+            hotkey_binding = self._hotkey_detector.evaluate_new_input(modifiers_int, keys)
+            self._latency_tracer.record("hotkey", host, (time.perf_counter_ns() - hotkey_start_ns) // 1000)
         else:
-            buttons_byte = UsbHidDecoder.convert_modifier_bit_mask_to_int(buttons)
-            # limit the values to fit inside 1 byte
-            x_pos_byte = UsbHidDecoder.enshure_byte_size(x_pos)
-            y_pos_byte = UsbHidDecoder.enshure_byte_size(y_pos)
-            v_wheel_byte = UsbHidDecoder.enshure_byte_size(v_wheel)
-            h_wheel_byte = UsbHidDecoder.enshure_byte_size(h_wheel)
-            # |- USB HID input report
-            # |     |- USB HID usage report => Mouse
-            # |     |     |- Bit mask for mouse buttons
-            # |     |     |  0x80: Not defined
-            # |     |     |  0x40: Not defined
-            # |     |     |  0x20: Not defined
-            # |     |     |  0x10: Forward mouse button
-            # |     |     |  0x08: Backward mouse button
-            # |     |     |  0x04: Middle mouse button
-            # |     |     |  0x02: Right mouse button
-            # |     |     |  0x01: Left mouse button
-            # |     |     |     |- Mouse x position
-            # |     |     |     |     |- Mouse y position
-            # |     |     |     |     |     |- Vertical wheel position
-            # |     |     |     |     |     |     |- Horizontal wheel position
-            # 0xA1, 0x02, 0xXX, 0xXX, 0xXX, 0xXX, 0xXX]
-            mouse_usb_telegram = [0xA1, 2, buttons_byte, x_pos_byte, y_pos_byte, v_wheel_byte, h_wheel_byte]
-            self._bt_server.send(mouse_usb_telegram)
+            hotkey_binding = self._hotkey_detector.evaluate_new_input(modifiers_int, keys)
+        # Only the last stroke of the hot key sequence will not be sendted
+        if hotkey_binding:
+            self._execute_hotkey(hotkey_binding)
+        elif self._get_report_mode(self._bt_server.active_host_address, "keyboardReport") == "nkro":
+            # Reports without a bitmap (D-Bus telegrams) only know the 6 key slots
+            if key_bitmap is None:
+                key_bitmap = HidReportEncoder.key_bitmap_from_keys(keys)
+            self._send_report(self._report_encoder.keyboard_nkro_report(modifiers_int, key_bitmap), event_time_us)
+        else:
+            self._send_report(self._report_encoder.keyboard_report(modifiers_int, keys), event_time_us)
+
+    def handle_mouse_report(self, buttons_int, x_pos, y_pos, v_wheel, h_wheel, event_time_us=0, built_time_us=0):
+        if event_time_us:
+            self._trace_report_arrival(event_time_us, built_time_us)
+        hotkey_binding = self._hotkey_detector.evaluate_new_mouse_input(buttons_int)
+        if hotkey_binding:
+            self._execute_hotkey(hotkey_binding)
+        elif self._get_report_mode(self._bt_server.active_host_address, "mouseReport") == "16bit":
+            self._send_mouse_reports(self._mouse_motion_16bit, self._report_encoder.mouse_report_16bit,
+                buttons_int, x_pos, y_pos, v_wheel, h_wheel, event_time_us)
+        else:
+            self._send_mouse_reports(self._mouse_motion_8bit, self._report_encoder.mouse_report_8bit,
+                buttons_int, x_pos, y_pos, v_wheel, h_wheel, event_time_us)
+
+    def _execute_hotkey(self, hotkey_binding):
+        if hotkey_binding.action == HotkeyAktion.SwitchToNextHost:
+            self._bt_server.switch_to_next_connected_host()
+        elif hotkey_binding.action == HotkeyAktion.SwitchToPreviousHost:
+            self._bt_server.switch_to_previous_connected_host()
+        elif hotkey_binding.action == HotkeyAktion.SwitchToHost:
+            self._bt_server.switch_to_connected_host_number(hotkey_binding.host_number)
+        # IndicateHost only announces the current host
+        client_names = self._bt_server.get_connected_client_names()
+        logging.info(f"D-Bus: {hotkey_binding}: {client_names[0]}")
+        self._emit_host_change(client_names)
+
+    def _get_report_mode(self, host, report):
+        host_report_modes = self._settings['hid']['hostReportModes'].get(host)
+        if host_report_modes and report in host_report_modes:
+            return host_report_modes[report]
+        return self._settings['hid'][report]
+
+    def _send_mouse_reports(self, accumulator, encode_report, buttons_int, x_pos, y_pos, v_wheel, h_wheel, event_time_us):
+        # Motion carried over from the previous host is not sent to the new one
+        host = self._bt_server.active_host_address
+        if host != self._mouse_motion_host:
+            self._mouse_motion_8bit.reset()
+            self._mouse_motion_16bit.reset()
+            self._mouse_motion_host = host
+        accumulator.add(x_pos, y_pos, v_wheel, h_wheel)
+        # Motion not fitting into one report is carried into the following reports
+        for _ in range(KvmDbusService.MAX_MOUSE_REPORTS_PER_FRAME):
+            self._send_report(encode_report(buttons_int, *accumulator.take()), event_time_us)
+            if not accumulator.has_remainder:
+                break
+        # Bounded to what the next frame sends, the pointer must not drift on after the mouse stopped
+        accumulator.limit_remainder(KvmDbusService.MAX_MOUSE_REPORTS_PER_FRAME)
+
+    def _send_report(self, report, event_time_us):
+        if not self._report_encoder.is_repeated(self._bt_server.active_host_address, report):
+            self._bt_server.send(report, event_time_us)
 
     @dbus_next.service.signal()
     def signal_host_change(self, client_names: 'as') -> 'as':
@@ -185,6 +276,8 @@ async def main():
     hotkey_detector = HotkeyDetector(hotkey_config)
     kvm_dbus_service = KvmDbusService(settings, hotkey_detector, bt_server)
     kvm_dbus_service_task = asyncio.create_task( kvm_dbus_service.run() )
+    report_channel_server = ReportChannelServer(kvm_dbus_service)
+    report_channel_server_task = asyncio.create_task( report_channel_server.run() )
 
     main_future = asyncio.Future()
 
@@ -195,10 +288,14 @@ async def main():
 
     await main_future # wait unitl signal interrupts
 
+    report_channel_server.stop()
+    await report_channel_server_task
     kvm_dbus_service.stop()
     await kvm_dbus_service_task
     bt_server.stop()
     await bt_server_task
+    # Settings and client order changes not written yet
+    await JsonFileWriter.flush_all()
     logging.error("System: Shut down completed")
 
 if __name__ == "__main__":
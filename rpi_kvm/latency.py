@@ -0,0 +1,88 @@
+import bisect
+import time
+
+def now_us():
+    # Wall clock like the evdev event timestamps, comparable across processes
+    return time.time_ns() // 1000
+
+def event_time_us(event):
+    return event.sec * 1_000_000 + event.usec
+
+class LatencyHistogram(object):
+    # Upper bounds of the buckets in microseconds.
+    # The last bucket takes everything above the highest bound.
+    BUCKET_BOUNDS_US = [
+        50, 100, 200, 300, 500, 750,
+        1_000, 1_500, 2_000, 3_000, 5_000, 7_500,
+        10_000, 15_000, 20_000, 30_000, 50_000, 75_000,
+        100_000, 200_000, 500_000, 1_000_000]
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._counts = [0] * (len(LatencyHistogram.BUCKET_BOUNDS_US) + 1)
+        self._count = 0
+        self._max_us = 0
+
+    @property
+    def count(self):
+        return self._count
+
+    def record(self, duration_us):
+        if duration_us < 0: # wall clock jumped
+            duration_us = 0
+        self._counts[bisect.bisect_left(LatencyHistogram.BUCKET_BOUNDS_US, duration_us)] += 1
+        self._count += 1
+        if duration_us > self._max_us:
+            self._max_us = duration_us
+
+    def percentile(self, percent):
+        """Returns the upper bound of the bucket containing the percentile."""
+        if self._count == 0:
+            return 0
+        rank = self._count * percent / 100
+        accumulated = 0
+        for index, bucket_count in enumerate(self._counts):
+            accumulated += bucket_count
+            if accumulated >= rank and bucket_count > 0:
+                if index < len(LatencyHistogram.BUCKET_BOUNDS_US):
+                    return min(LatencyHistogram.BUCKET_BOUNDS_US[index], self._max_us)
+                return self._max_us
+        return self._max_us
+
+    def as_dict(self):
+        return {
+            "count": self._count,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self._max_us,
+        }
+
+class LatencyTracer(object):
+    # input:     evdev event timestamp -> report built by keyboard.py/mouse.py
+    # transport: report built -> received by kvm_service (report channel or D-Bus)
+    # hotkey:    hotkey evaluation inside kvm_service
+    # queue:     waiting inside the send queue of the bluetooth client
+    # send:      socket send till completion
+    # total:     evdev event timestamp -> socket send completed
+    STAGES = ["input", "transport", "hotkey", "queue", "send", "total"]
+
+    def __init__(self):
+        self._histograms = {}
+
+    def record(self, stage, host, duration_us):
+        host_histograms = self._histograms.get(host)
+        if host_histograms is None:
+            host_histograms = {stage_name: LatencyHistogram() for stage_name in LatencyTracer.STAGES}
+            self._histograms[host] = host_histograms
+        host_histograms[stage].record(duration_us)
+
+    def reset(self):
+        self._histograms = {}
+
+    def as_dict(self):
+        """Percentiles in microseconds per host and stage."""
+        return {host: {stage: histogram.as_dict() for stage, histogram in host_histograms.items()}
+                for host, host_histograms in self._histograms.items()}
@@ -0,0 +1,232 @@
+#!/usr/bin/python3
+
+import socket
+import random
+import asyncio
+import logging
+import argparse
+import dbus_next
+from dbus_next.aio import MessageBus
+from dbus_next.service import ServiceInterface, method, dbus_property, signal
+from dbus_next import Variant, PropertyAccess, Message
+
+async def ping(bus):
+    """Round trip to the bus daemon, all messages sent before are processed afterwards."""
+    await bus.call(Message(destination="org.freedesktop.DBus", path="/org/freedesktop/DBus",
+        interface="org.freedesktop.DBus.Peer", member="Ping"))
+
+class MockDevice(ServiceInterface):
+    """org.bluez.Device1 of a paired host."""
+    def __init__(self, address, name):
+        super().__init__("org.bluez.Device1")
+        self._address = address
+        self._name = name
+        self._connected = False
+        self._rssi = -50
+
+    @property
+    def object_path(self):
+        return MockBluez.ADAPTER_PATH + "/dev_" + self._address.replace(":", "_")
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Address(self) -> 's':
+        return self._address
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Name(self) -> 's':
+        return self._name
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Paired(self) -> 'b':
+        return True
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Connected(self) -> 'b':
+        return self._connected
+
+    @dbus_property(access=PropertyAccess.READ)
+    def RSSI(self) -> 'n':
+        return self._rssi
+
+    def set_connected(self, connected):
+        self._connected = connected
+        self.emit_properties_changed({"Connected": connected})
+
+    def set_rssi(self, rssi):
+        self._rssi = rssi
+        self.emit_properties_changed({"RSSI": rssi})
+
+    def as_managed_object(self):
+        return {"org.bluez.Device1": {
+            "Address": Variant('s', self._address),
+            "Name": Variant('s', self._name),
+            "Paired": Variant('b', True),
+            "Connected": Variant('b', self._connected),
+            "RSSI": Variant('n', self._rssi),
+        }}
+
+class MockProfileManager(ServiceInterface):
+    def __init__(self, mock_bluez):
+        super().__init__("org.bluez.ProfileManager1")
+        self._mock_bluez = mock_bluez
+        self.profiles = {}
+
+    @method()
+    async def RegisterProfile(self, profile: 'o', uuid: 's', options: 'a{sv}') -> '':
+        await self._mock_bluez.delay_reply()
+        self.profiles[uuid] = profile
+        logging.info(f"Mock bluez: Profile {uuid} registered at {profile}")
+
+class MockAdapter(ServiceInterface):
+    def __init__(self, mock_bluez):
+        super().__init__("org.bluez.Adapter1")
+        self._mock_bluez = mock_bluez
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Address(self) -> 's':
+        return MockBluez.ADAPTER_ADDRESS
+
+    @method()
+    async def RemoveDevice(self, device: 'o') -> '':
+        await self._mock_bluez.delay_reply()
+        self._mock_bluez.remove_device(device)
+
+class MockObjectManager(ServiceInterface):
+    def __init__(self, mock_bluez):
+        super().__init__("org.freedesktop.DBus.ObjectManager")
+        self._mock_bluez = mock_bluez
+
+    @method()
+    async def GetManagedObjects(self) -> 'a{oa{sa{sv}}}':
+        await self._mock_bluez.delay_reply()
+        return self._mock_bluez.managed_objects()
+
+    @signal()
+    def InterfacesRemoved(self, object_path, interfaces) -> 'oas':
+        return [object_path, interfaces]
+
+class MockBluez(object):
+    """Stand-in for the org.bluez service to run BtServer and BtClient without a radio.
+
+    Simulates any number of paired hosts, slow replies of the bluez methods
+    and storms of device property changes. Runs on the session bus, which
+    should be a private one (dbus-run-session), with BtClient.BLUEZ_BUS_TYPE
+    set to the session bus (RPI_KVM_BLUEZ_BUS=session).
+    """
+    BUS_NAME = "org.bluez"
+    ADAPTER_PATH = "/org/bluez/hci0"
+    ADAPTER_ADDRESS = "B8:27:EB:00:00:01"
+    # dbus_next drops the connection when a write finds the socket buffer full,
+    # which hundreds of concurrent introspection replies do with the default size
+    SEND_BUFFER_SIZE = 16 * 1024 * 1024
+    SO_SNDBUFFORCE = 32
+    # Exports per round trip - lets the signals of the exports drain
+    EXPORT_BATCH_SIZE = 50
+
+    def __init__(self, device_count, reply_delay=0):
+        self._reply_delay = reply_delay
+        self._bus = None
+        self._profile_manager = MockProfileManager(self)
+        self._adapter = MockAdapter(self)
+        self._object_manager = MockObjectManager(self)
+        self._devices = {}
+        for index in range(device_count):
+            device = MockDevice(f"AA:BB:CC:{(index >> 16) & 255:02X}:{(index >> 8) & 255:02X}:{index & 255:02X}", f"Mock host {index}")
+            self._devices[device.object_path] = device
+
+    @property
+    def devices(self):
+        return list(self._devices.values())
+
+    @property
+    def profiles(self):
+        return self._profile_manager.profiles
+
+    async def start(self, bus_type=dbus_next.BusType.SESSION):
+        self._bus = await MessageBus(bus_type=bus_type).connect()
+        self._enlarge_send_buffer()
+        self._bus.export("/", self._object_manager)
+        self._bus.export("/org/bluez", self._profile_manager)
+        self._bus.export(MockBluez.ADAPTER_PATH, self._adapter)
+        for index, (object_path, device) in enumerate(self._devices.items()):
+            self._bus.export(object_path, device)
+            if index % MockBluez.EXPORT_BATCH_SIZE == MockBluez.EXPORT_BATCH_SIZE - 1:
+                await ping(self._bus)
+        await self._bus.request_name(MockBluez.BUS_NAME)
+        logging.info(f"Mock bluez: Serving {len(self._devices)} paired devices")
+
+    def _enlarge_send_buffer(self):
+        try:
+            # Only root may exceed net.core.wmem_max
+            self._bus._sock.setsockopt(socket.SOL_SOCKET, MockBluez.SO_SNDBUFFORCE, MockBluez.SEND_BUFFER_SIZE)
+        except OSError:
+            self._bus._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, MockBluez.SEND_BUFFER_SIZE)
+        send_buffer_size = self._bus._sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
+        logging.debug(f"Mock bluez: Send buffer size {send_buffer_size} bytes")
+
+    def stop(self):
+        if self._bus:
+            self._bus.disconnect()
+            self._bus = None
+
+    async def delay_reply(self):
+        if self._reply_delay:
+            await asyncio.sleep(self._reply_delay)
+
+    def managed_objects(self):
+        objects = {MockBluez.ADAPTER_PATH: {"org.bluez.Adapter1": {"Address": Variant('s', MockBluez.ADAPTER_ADDRESS)}}}
+        for object_path, device in self._devices.items():
+            objects[object_path] = device.as_managed_object()
+        return objects
+
+    def remove_device(self, object_path):
+        device = self._devices.pop(object_path, None)
+        if not device:
+            raise dbus_next.DBusError("org.bluez.Error.DoesNotExist", f"Device {object_path} does not exist")
+        self._bus.unexport(object_path, device)
+        self._object_manager.InterfacesRemoved(object_path, ["org.bluez.Device1"])
+        logging.info(f"Mock bluez: Device {object_path} removed")
+
+    async def property_storm(self, change_count, rate_hz, property_name="RSSI"):
+        """Emits change_count property changes of random devices at rate_hz, returns the changes emitted."""
+        devices = self.devices
+        for index in range(change_count):
+            if not devices:
+                return index
+            device = random.choice(devices)
+            if property_name == "Connected":
+                device.set_connected(not device.Connected)
+            else:
+                device.set_rssi(random.randint(-90, -30))
+            # Emitted in bursts per loop iteration, sleeping per change is too coarse above 1000 Hz
+            if index % 64 == 63:
+                await asyncio.sleep(64 / rate_hz)
+        return change_count
+
+async def run_mock(args):
+    mock_bluez = MockBluez(args.devices, args.reply_delay)
+    await mock_bluez.start()
+    try:
+        while True:
+            if args.storm_rate:
+                await mock_bluez.property_storm(int(args.storm_rate), args.storm_rate, args.storm_property)
+            else:
+                await asyncio.sleep(3600)
+    finally:
+        mock_bluez.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves a mock org.bluez on the session bus, e.g. via dbus-run-session")
+    parser.add_argument("--devices", type=int, default=100, help="Number of paired devices")
+    parser.add_argument("--reply-delay", type=float, default=0, help="Seconds each bluez method call takes")
+    parser.add_argument("--storm-rate", type=float, default=0, help="Device property changes per second, 0 disables the storm")
+    parser.add_argument("--storm-property", choices=["RSSI", "Connected"], default="RSSI", help="Device property changed by the storm")
+    args = parser.parse_args()
+    logging.basicConfig(format='Mock bluez %(levelname)s: %(message)s', level=logging.INFO)
+    try:
+        asyncio.run( run_mock(args) )
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
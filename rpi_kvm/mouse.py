@@ -1,57 +1,171 @@
 #!/usr/bin/python3
 
 import asyncio
+import collections
 import evdev
 from evdev import *
-import dbus_next
-from dbus_next.aio import MessageBus
-import time
 import logging
+from settings import Settings
 from hid_scanner import HidScanner
 from usb_hid_decoder import UsbHidDecoder
+from report_channel import KvmReportLink
+from latency import event_time_us
+
+
+class MouseFrameScheduler(object):
+    """Merges the motion of all event mice into frames sent at an adaptive rate.
+
+    The frame rate follows the drain rate of the active host link reported by
+    the kvm_service: fast links get up to 1000 frames per second, congested
+    links (queued reports) fall back to 125 frames per second. Button changes
+    are sent immediately - every change as its own frame with the buttons of
+    its commit, so a press and release committed before the next send both
+    reach the host in order.
+    """
+    MIN_RATE_HZ = 125
+    MAX_RATE_HZ = 1000
+    # Share of the measured drain rate used for mouse frames - leaves room for keyboard reports
+    DRAIN_RATE_SHARE = 0.5
+    # Queued reports of the active host till the frame rate is reduced to the minimum
+    QUEUE_DEPTH_LIMIT = 2
+    # continuous mouse sync frame to prevent input lag on host
+    IDLE_SYNC_INTERVAL = 1
+
+    def __init__(self, report_link, buttons_provider):
+        self._report_link = report_link
+        self._buttons_provider = buttons_provider
+        self._loop = None
+        self._rate_hz = MouseFrameScheduler.MIN_RATE_HZ
+        self._last_send_time = 0
+        self._wake_future = None
+        # Buttons of the last committed frame - sent with the motion frames
+        self._buttons = 0
+        # Frames with button changes waiting to be sent: (buttons, x, y, v-wheel, h-wheel, event time)
+        self._button_frames = collections.deque()
+        self._reset_frame()
+
+    @property
+    def rate_hz(self):
+        return self._rate_hz
+
+    def _reset_frame(self):
+        self._x_pos = 0
+        self._y_pos = 0
+        self._v_wheel = 0
+        self._h_wheel = 0
+        self._has_pending_motion = False
+        # Timestamp of the oldest event not yet sent - used for latency tracing
+        self._first_event_time_us = 0
+
+    def commit_frame(self, x_pos, y_pos, v_wheel, h_wheel, have_buttons_changed, first_event_time_us):
+        self._x_pos += x_pos
+        self._y_pos += y_pos
+        self._v_wheel += v_wheel
+        self._h_wheel += h_wheel
+        if first_event_time_us and not self._first_event_time_us:
+            self._first_event_time_us = first_event_time_us
+        if have_buttons_changed:
+            # The motion so far goes with the button change, later motion follows it
+            self._buttons = self._buttons_provider()
+            self._button_frames.append((self._buttons, self._x_pos, self._y_pos, self._v_wheel, self._h_wheel, self._first_event_time_us))
+            self._reset_frame()
+            self._wake()
+        elif not self._has_pending_motion:
+            self._has_pending_motion = True
+            self._wake()
+
+    def _wake(self):
+        if self._wake_future and not self._wake_future.done():
+            self._wake_future.set_result(None)
+
+    async def _sleep(self, delay):
+        self._wake_future = self._loop.create_future()
+        timer = self._loop.call_later(delay, self._wake)
+        await self._wake_future
+        timer.cancel()
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        while True:
+            now = self._loop.time()
+            if self._button_frames:
+                due_time = now
+            elif self._has_pending_motion:
+                due_time = self._last_send_time + 1 / self._rate_hz
+            else:
+                due_time = self._last_send_time + MouseFrameScheduler.IDLE_SYNC_INTERVAL
+            if due_time > now:
+                # Woken up early by new input or on time - reevaluate in both cases
+                await self._sleep(due_time - now)
+                continue
+            await self._send_frame()
+
+    async def flush(self):
+        """Sends the pending frames right away, also if the scheduler is not running."""
+        if not self._loop:
+            self._loop = asyncio.get_running_loop()
+        while self._button_frames or self._has_pending_motion:
+            await self._send_frame()
+
+    async def _send_frame(self):
+        if self._button_frames:
+            buttons, x_pos, y_pos, v_wheel, h_wheel, first_event_time_us = self._button_frames.popleft()
+        else:
+            buttons, x_pos, y_pos, v_wheel, h_wheel = self._buttons, self._x_pos, self._y_pos, self._v_wheel, self._h_wheel
+            first_event_time_us = self._first_event_time_us
+            self._reset_frame()
+        self._last_send_time = self._loop.time()
+        self._rate_hz = self._select_rate()
+        # Motion arriving while the frame is sent is collected for the next frame
+        await self._report_link.send_mouse(buttons, x_pos, y_pos, v_wheel, h_wheel, first_event_time_us)
+
+    def _select_rate(self):
+        link_stats = self._report_link.link_stats
+        if not link_stats:
+            return MouseFrameScheduler.MIN_RATE_HZ
+        drain_rate, queue_depth = link_stats
+        if queue_depth > MouseFrameScheduler.QUEUE_DEPTH_LIMIT:
+            return MouseFrameScheduler.MIN_RATE_HZ
+        rate = drain_rate * MouseFrameScheduler.DRAIN_RATE_SHARE
+        return min(MouseFrameScheduler.MAX_RATE_HZ, max(MouseFrameScheduler.MIN_RATE_HZ, rate))
 
 
 class KvmMouse(object):
-    def __init__(self):
+    def __init__(self, report_link=None):
         self.event_mice = dict()
+        self._report_link = report_link if report_link else KvmReportLink("Mouse")
+        self._scheduler = MouseFrameScheduler(self._report_link, self.get_common_buttons)
+        self._scheduler_task = None
+
+    @property
+    def scheduler(self):
+        return self._scheduler
 
     async def start(self):
-        logging.info(f"D-Bus service connecting...")
-        await self._connect_to_dbus_service()
-
-    async def _connect_to_dbus_service(self):
-        self._kvm_dbus_iface = None
-        while not self._kvm_dbus_iface:
-            try:
-                bus = await MessageBus(bus_type=dbus_next.BusType.SYSTEM).connect()
-                introspection = await bus.introspect(
-                    'org.rpi.kvmservice', '/org/rpi/kvmservice')
-                kvm_service_obj = bus.get_proxy_object(
-                    'org.rpi.kvmservice', '/org/rpi/kvmservice', introspection)
-                self._kvm_dbus_iface = kvm_service_obj.get_interface('org.rpi.kvmservice')
-                logging.info(f"D-Bus service connected")
-            except dbus_next.DBusError:
-                logging.warning(f"D-Bus service not available - reconnecting...")
-                await asyncio.sleep(5)
-
-    async def send_state(self, buttons, x_pos, y_pos, v_wheel, h_wheel):
-        common_buttons = [False, False, False, False, False, False, False, False]
-        for event_mouse in self.event_mice.values():
-            for i, button_val in enumerate(event_mouse.buttons):
-                common_buttons[i] |= button_val
+        logging.info(f"KVM service connecting...")
+        self._report_link.subscribe_link_stats()
+        await self._report_link.connect()
+        self._scheduler_task = asyncio.create_task(self._scheduler.run())
 
-        try:
-            await self._kvm_dbus_iface.call_send_mouse_usb_telegram(common_buttons, x_pos, y_pos, v_wheel, h_wheel)
-        except dbus_next.DBusError:
-            logging.warning(f"{self._idev.path}: D-Bus connection terminated - reconnecting...")
-            await self._connect_to_dbus_service()
+    def stop(self):
+        if self._scheduler_task:
+            self._scheduler_task.cancel()
+            self._scheduler_task = None
+
+    def get_common_buttons(self):
+        common_buttons = 0
+        for event_mouse in self.event_mice.values():
+            common_buttons |= UsbHidDecoder.convert_modifier_bit_mask_to_int(event_mouse.buttons)
+        return common_buttons
 
 
 class EventMouse(object):
     def __init__(self, input_device):
         self._idev = input_device
         logging.info(f"{self._idev.path}: Init Mouse - {self._idev.name}")
-        self.send_state_cb = None
+        self.commit_frame_cb = None
+        # Called with every evdev event of this device, e.g. by the input trace recorder
+        self.trace_event_cb = None
         self.__client_switch_button_index = 2
         self._is_alive = False
 
@@ -69,8 +183,8 @@ class EventMouse(object):
         self._v_wheel = 0
         self._h_wheel = 0
         self._have_buttons_changed = False
-        self._last_syn_event_time = 0
-        self._update_rate = 20/1000
+        # Timestamp of the oldest event not yet sent - used for latency tracing
+        self._first_event_time_us = 0
 
     @property
     def is_alive(self):
@@ -90,46 +204,44 @@ class EventMouse(object):
 
     async def run(self):
         self._is_alive = True
-        logging.info(f"{self._idev.path}: Start sending mouse sync events continuously")
-        asyncio.create_task(self._continuous_sync_event())
         logging.info(f"{self._idev.path}: Start listening to mouse event loop")
         try:
             await self._event_loop()
         except Exception as e:
             logging.error(f"{self._idev.path}: {e}")
+        # Closed here, the read loop has removed its reader from the event loop
+        self._idev.close()
+        # Buttons held while the device is unplugged would stay pressed on the host
+        if any(self._buttons):
+            self._buttons = [False] * len(self._buttons)
+            if self.commit_frame_cb:
+                self.commit_frame_cb(0, 0, 0, 0, True, self._first_event_time_us)
         self._is_alive = False
 
     # poll for mouse events
     async def _event_loop(self):
         async for event in self._idev.async_read_loop():
-            await self._handle_event(event)
-
-    # continuous mouse sync event to prevent input lag on host
-    async def _continuous_sync_event(self):
-        while self._is_alive:
-            time_ns = time.time_ns()
-            time_s = int(time_ns / 1_000_000_000)
-            time_ms = int((time_ns - (time_s * 1_000_000_000)) / 1_000)
-            # InputEvent.__init__(self, sec, usec, type, code, value)
-             # code and value are chosen at random
-            basic_event = evdev.events.InputEvent(time_s, time_ms, ecodes.EV_SYN, 55, 55)
-            await self._handle_event(basic_event)
-            await asyncio.sleep(1)
-
-    async def _handle_event(self, event):
+            if self.trace_event_cb:
+                self.trace_event_cb(event)
+            self._handle_event(event)
+
+    def _handle_event(self, event):
         if event.type == ecodes.EV_SYN:
-            current_time = time.monotonic()
-            if current_time - self._last_syn_event_time < self._update_rate and not self._have_buttons_changed:
+            if event.code != ecodes.SYN_REPORT:
                 return
-            self._last_syn_event_time = current_time
-            if self.send_state_cb:
-                await self.send_state_cb(self._buttons, self._x_pos, self._y_pos, self._v_wheel, self._h_wheel)
+            # The frame of this device is complete - hand it over to the scheduler
+            if self.commit_frame_cb:
+                self.commit_frame_cb(self._x_pos, self._y_pos, self._v_wheel, self._h_wheel, self._have_buttons_changed, self._first_event_time_us)
+            self._first_event_time_us = 0
             self._x_pos = 0
             self._y_pos = 0
             self._v_wheel = 0
             self._h_wheel = 0
             self._have_buttons_changed = False
-        elif event.type == ecodes.EV_KEY:
+            return
+        if not self._first_event_time_us:
+            self._first_event_time_us = event_time_us(event)
+        if event.type == ecodes.EV_KEY:
             button_index = UsbHidDecoder.encode_mouse_button_index(event.code)
             if button_index >= 0 and event.value < 2:
                 self._have_buttons_changed = True
@@ -155,16 +267,12 @@ class EventMouse(object):
                 logging.debug(f"{self._idev.path}: H-Wheel movement: {event.value}")
                 self._h_wheel -= event.value
 
-async def main():
-    logging.basicConfig(format='Mouse %(levelname)s: %(message)s', level=logging.DEBUG)
+async def run_mice(kvm_mouse, settings=None, recorder=None):
     logging.info("Creating HID Manager")
-    hid_manager = HidScanner()
-    kvm_mouse = KvmMouse()
+    hid_manager = HidScanner(settings)
     await kvm_mouse.start()
 
-    while True:
-        await hid_manager.scan()
-
+    def on_devices_change():
         removed_event_mice = [event_mouse for event_mouse in kvm_mouse.event_mice.values() if not event_mouse.is_alive]
         for event_mouse in removed_event_mice:
             logging.info(f"Removing event mouse: {event_mouse.path}")
@@ -172,15 +280,25 @@ async def main():
 
         device_paths = [mouse_device.path for mouse_device in hid_manager.mouse_devices]
         if len(device_paths) == 0:
-            logging.warning("No mouse device found, waiting till next device scan")
+            logging.warning("No mouse device found, waiting till a mouse is plugged in")
         else:
             new_device_mice = [mouse_device for mouse_device in hid_manager.mouse_devices if mouse_device.path not in kvm_mouse.event_mice]
             for mouse_device in new_device_mice:
                 event_mouse = EventMouse(mouse_device)
-                event_mouse.send_state_cb = kvm_mouse.send_state
+                event_mouse.commit_frame_cb = kvm_mouse.scheduler.commit_frame
+                if recorder:
+                    event_mouse.trace_event_cb = recorder.add_mouse(mouse_device.name)
                 kvm_mouse.event_mice[mouse_device.path] = event_mouse
-                asyncio.create_task(event_mouse.run())
-        await asyncio.sleep(5)
+                task = asyncio.create_task(event_mouse.run())
+                task.add_done_callback(lambda task, path=mouse_device.path: hid_manager.rescan_device(path))
+
+    await hid_manager.run(on_devices_change)
+
+async def main():
+    logging.basicConfig(format='Mouse %(levelname)s: %(message)s', level=logging.DEBUG)
+    settings = Settings()
+    settings.load_from_file()
+    await run_mice(KvmMouse(), settings)
 
 if __name__ == "__main__":
     asyncio.run( main() )
@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+
+import random
+
+class MouseMotionAccumulator(object):
+    """Keeps the mouse motion which did not fit into the last report.
+
+    High DPI mice easily move more than a report field can hold. Instead of
+    clamping the motion away, the remainder is carried into the following
+    reports, so the total displacement on the host stays the same as long as
+    the remainder stays within limit_remainder.
+    """
+    def __init__(self, axis_limit, wheel_limit=127):
+        self._axis_limit = axis_limit
+        self._wheel_limit = wheel_limit
+        self.reset()
+
+    def reset(self):
+        self._x_pos = 0
+        self._y_pos = 0
+        self._v_wheel = 0
+        self._h_wheel = 0
+
+    @property
+    def has_remainder(self):
+        return self._x_pos != 0 or self._y_pos != 0 or self._v_wheel != 0 or self._h_wheel != 0
+
+    def add(self, x_pos, y_pos, v_wheel, h_wheel):
+        self._x_pos += x_pos
+        self._y_pos += y_pos
+        self._v_wheel += v_wheel
+        self._h_wheel += h_wheel
+
+    def limit_remainder(self, report_count):
+        """Clamps the remainder to the motion of report_count reports."""
+        axis_limit = self._axis_limit * report_count
+        wheel_limit = self._wheel_limit * report_count
+        self._x_pos = min(axis_limit, max(-axis_limit, self._x_pos))
+        self._y_pos = min(axis_limit, max(-axis_limit, self._y_pos))
+        self._v_wheel = min(wheel_limit, max(-wheel_limit, self._v_wheel))
+        self._h_wheel = min(wheel_limit, max(-wheel_limit, self._h_wheel))
+
+    def take(self):
+        """Returns the motion for the next report and keeps the remainder."""
+        x_pos = min(self._axis_limit, max(-self._axis_limit, self._x_pos))
+        y_pos = min(self._axis_limit, max(-self._axis_limit, self._y_pos))
+        v_wheel = min(self._wheel_limit, max(-self._wheel_limit, self._v_wheel))
+        h_wheel = min(self._wheel_limit, max(-self._wheel_limit, self._h_wheel))
+        self._x_pos -= x_pos
+        self._y_pos -= y_pos
+        self._v_wheel -= v_wheel
+        self._h_wheel -= h_wheel
+        return (x_pos, y_pos, v_wheel, h_wheel)
+
+def replay(accumulator, motion_frames):
+    reports = []
+    for frame in motion_frames:
+        accumulator.add(*frame)
+        reports.append(accumulator.take())
+        while accumulator.has_remainder:
+            reports.append(accumulator.take())
+    return reports
+
+if __name__ == "__main__":
+    # Replay fast flicks of a high DPI mouse and check that no motion is lost
+    rng = random.Random(4000)
+    frames = [(rng.randint(-3000, 3000), rng.randint(-3000, 3000), rng.randint(-300, 300), rng.randint(-2, 2)) for _ in range(1000)]
+    for axis_limit in [127, 32767]:
+        reports = replay(MouseMotionAccumulator(axis_limit), frames)
+        print(all(sum(report[axis] for report in reports) == sum(frame[axis] for frame in frames) for axis in range(4)))
+        print(all(abs(report[0]) <= axis_limit and abs(report[1]) <= axis_limit for report in reports))
+        print(all(abs(report[2]) <= 127 and abs(report[3]) <= 127 for report in reports))
+    accumulator = MouseMotionAccumulator(127)
+    accumulator.add(1000, -1000, 0, 0)
+    accumulator.limit_remainder(4)
+    print([accumulator.take() for _ in range(5)] == [(127, -127, 0, 0)] * 4 + [(0, 0, 0, 0)])
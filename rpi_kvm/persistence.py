@@ -0,0 +1,168 @@
+#!/usr/bin/python3
+
+import os
+import json
+import time
+import weakref
+import asyncio
+import logging
+import tempfile
+
+def write_file_atomically(path, content):
+    """Writes to a temp file next to the target, syncs it and renames it over the target,
+    so a crash leaves either the old or the new content."""
+    directory = os.path.dirname(os.path.abspath(path))
+    mode = os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o644
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_path, mode)
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+    # The rename itself is only durable after the directory is synced
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+class JsonFileWriter(object):
+    """Write-behind persistence of a JSON state file.
+
+    save() only marks the state dirty. Inside an event loop the file is written
+    DEBOUNCE_DELAY later, so bursts of changes end up in one write, and the
+    disk access runs in the default executor. Without a running event loop the
+    file is written right away.
+    """
+    DEBOUNCE_DELAY = 0.5
+    _instances = weakref.WeakSet()
+
+    def __init__(self, path, state_provider):
+        self._path = path
+        self._state_provider = state_provider
+        self._is_dirty = False
+        self._timer = None
+        self._write_future = None
+        JsonFileWriter._instances.add(self)
+
+    @property
+    def path(self):
+        return self._path
+
+    def save(self):
+        self._is_dirty = True
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_sync()
+            return
+        # A write in progress reschedules itself when it is done
+        if not self._timer and not self._write_future:
+            self._timer = loop.call_later(JsonFileWriter.DEBOUNCE_DELAY, self._start_write)
+
+    def _serialize(self):
+        # Serialized inside the event loop - the state is not changed concurrently
+        self._is_dirty = False
+        return json.dumps(self._state_provider(), indent=4)
+
+    def _start_write(self):
+        self._timer = None
+        loop = asyncio.get_running_loop()
+        self._write_future = loop.run_in_executor(None, self._write, self._serialize())
+        self._write_future.add_done_callback(self._on_write_done)
+
+    def _write(self, content):
+        start_time = time.perf_counter()
+        write_file_atomically(self._path, content)
+        logging.debug(f"{self._path} written in {(time.perf_counter() - start_time) * 1000:.1f} ms")
+
+    def _on_write_done(self, future):
+        self._write_future = None
+        if future.exception():
+            logging.error(f"Writing {self._path} failed: {future.exception()}")
+            self._is_dirty = True
+        if self._is_dirty and not self._timer:
+            self._timer = asyncio.get_running_loop().call_later(JsonFileWriter.DEBOUNCE_DELAY, self._start_write)
+
+    async def flush(self):
+        """Writes pending changes now and waits till they are on disk."""
+        while True:
+            # The done callback of a write may have scheduled the next one
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+            if self._write_future:
+                # Only one write at a time, changes saved meanwhile are written after it
+                await asyncio.wait([self._write_future])
+            elif self._is_dirty:
+                self._start_write()
+                write_future = self._write_future
+                await asyncio.wait([write_future])
+                if write_future.exception():
+                    # Logged and retried by _on_write_done
+                    return
+            else:
+                return
+
+    def flush_sync(self):
+        """Writes pending changes in the calling thread, for use without event loop."""
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        if self._is_dirty:
+            self._write(self._serialize())
+
+    @staticmethod
+    async def flush_all():
+        """Flushes all writers of this process, e.g. on shutdown."""
+        for writer in list(JsonFileWriter._instances):
+            await writer.flush()
+
+async def main():
+    # Saves bursts within the debounce delay as one write
+    with tempfile.TemporaryDirectory() as temp_dir:
+        state = {"value": 0}
+        writer = JsonFileWriter(os.path.join(temp_dir, "state.json"), lambda: state)
+        for value in range(100):
+            state["value"] = value
+            writer.save()
+        print(not os.path.exists(writer.path))
+        await writer.flush()
+        with open(writer.path, "r") as f:
+            print(json.load(f) == {"value": 99})
+        state["value"] = 100
+        writer.save()
+        await JsonFileWriter.flush_all()
+        with open(writer.path, "r") as f:
+            print(json.load(f) == {"value": 100})
+        print(os.listdir(temp_dir) == ["state.json"])
+        # A save during the write of a flush is written after it, never in parallel
+        active_writes = [0, 0]
+        write = writer._write
+        def counting_write(content):
+            active_writes[0] += 1
+            active_writes[1] = max(active_writes[1], active_writes[0])
+            time.sleep(0.05)
+            write(content)
+            active_writes[0] -= 1
+        writer._write = counting_write
+        state["value"] = 101
+        writer.save()
+        flush_task = asyncio.create_task(writer.flush())
+        await asyncio.sleep(0.01)
+        state["value"] = 102
+        writer.save()
+        await flush_task
+        with open(writer.path, "r") as f:
+            print(json.load(f) == {"value": 102} and active_writes[1] == 1)
+
+if __name__ == "__main__":
+    asyncio.run( main() )
@@ -0,0 +1,397 @@
+# Unix socket data channel for HID reports
+#
+# The input processes (keyboard.py, mouse.py) hand every report to the
+# kvm_service. A D-Bus method call per report costs a full round trip through
+# the bus daemon, so reports travel over a local AF_UNIX SOCK_SEQPACKET socket
+# instead. Every packet is one fixed-size binary frame. D-Bus stays in charge of
+# the control methods and the signals.
+
+import os
+import asyncio
+import socket
+import struct
+import logging
+import dbus_next
+from dbus_next import Message, MessageFlag
+from dbus_next.aio import MessageBus
+from latency import now_us
+
+class ReportFrame(object):
+    SOCKET_PATH = "/run/rpi-kvm/reports.sock"
+
+    KEYBOARD = 1
+    MOUSE = 2
+    LINK_STATS = 3
+    KEYBOARD_NKRO = 4
+
+    # A frame is the report kind byte followed by the report payload.
+    # Via D-Bus the kind and the payload are sent as (yay) struct.
+    KIND_SIZE = 1
+    # Every report carries two timestamps in microseconds for the latency tracing:
+    # the evdev event time and the time the report has been built.
+    # Zero means not traced.
+    # |- Bit mask for modifier keys
+    # |  |- 6x pressed keys
+    # |  |   |- Event time
+    # |  |   |  |- Report built time
+    # B, 6s, q, q
+    KEYBOARD_PAYLOAD = struct.Struct("<B6sqq")
+    # Keyboard report with the N-key rollover bitmap in addition to the 6 key slots
+    # |- Bit mask for modifier keys
+    # |  |- 6x pressed keys
+    # |  |   |- Bitmap of the pressed keys, bit n of byte n // 8 is usb key code n
+    # |  |   |   |- Event time
+    # |  |   |   |  |- Report built time
+    # B, 6s, 32s, q, q
+    KEYBOARD_NKRO_PAYLOAD = struct.Struct("<B6s32sqq")
+    # |- Bit mask for mouse buttons
+    # |  |- Mouse x movement
+    # |  |  |- Mouse y movement
+    # |  |  |  |- Vertical wheel movement
+    # |  |  |  |  |- Horizontal wheel movement
+    # |  |  |  |  |  |- Event time
+    # |  |  |  |  |  |  |- Report built time
+    # B, i, i, i, i, q, q
+    MOUSE_PAYLOAD = struct.Struct("<Biiiiqq")
+
+    KEYBOARD_STRUCT = struct.Struct("<B" + KEYBOARD_PAYLOAD.format[1:])
+    KEYBOARD_NKRO_STRUCT = struct.Struct("<B" + KEYBOARD_NKRO_PAYLOAD.format[1:])
+    MOUSE_STRUCT = struct.Struct("<B" + MOUSE_PAYLOAD.format[1:])
+
+    MAX_SIZE = max(KEYBOARD_STRUCT.size, KEYBOARD_NKRO_STRUCT.size, MOUSE_STRUCT.size)
+
+    # Sent by the kvm_service to input processes which subscribed via a
+    # frame only consisting of the LINK_STATS kind byte.
+    # |- Frame kind
+    # |  |- Drain rate of the active host link in reports per second
+    # |  |  |- Queued reports of the active host
+    # B, I, H
+    LINK_STATS_STRUCT = struct.Struct("<BIH")
+    LINK_STATS_SUBSCRIPTION = bytes([LINK_STATS])
+    LINK_STATS_INTERVAL = 0.25
+
+    @staticmethod
+    def encode_keyboard(modifiers, keys, event_time_us, built_time_us):
+        return ReportFrame.KEYBOARD_STRUCT.pack(ReportFrame.KEYBOARD, modifiers, bytes(keys), event_time_us, built_time_us)
+
+    @staticmethod
+    def encode_keyboard_nkro(modifiers, keys, key_bitmap, event_time_us, built_time_us):
+        return ReportFrame.KEYBOARD_NKRO_STRUCT.pack(ReportFrame.KEYBOARD_NKRO, modifiers, bytes(keys), bytes(key_bitmap), event_time_us, built_time_us)
+
+    @staticmethod
+    def encode_mouse(buttons, x_pos, y_pos, v_wheel, h_wheel, event_time_us, built_time_us):
+        return ReportFrame.MOUSE_STRUCT.pack(ReportFrame.MOUSE, buttons, x_pos, y_pos, v_wheel, h_wheel, event_time_us, built_time_us)
+
+    @staticmethod
+    def encode_keyboard_payload(modifiers, keys, event_time_us, built_time_us):
+        return ReportFrame.KEYBOARD_PAYLOAD.pack(modifiers, bytes(keys), event_time_us, built_time_us)
+
+    @staticmethod
+    def encode_keyboard_nkro_payload(modifiers, keys, key_bitmap, event_time_us, built_time_us):
+        return ReportFrame.KEYBOARD_NKRO_PAYLOAD.pack(modifiers, bytes(keys), bytes(key_bitmap), event_time_us, built_time_us)
+
+    @staticmethod
+    def encode_mouse_payload(buttons, x_pos, y_pos, v_wheel, h_wheel, event_time_us, built_time_us):
+        return ReportFrame.MOUSE_PAYLOAD.pack(buttons, x_pos, y_pos, v_wheel, h_wheel, event_time_us, built_time_us)
+
+    @staticmethod
+    def dispatch(frame, report_handler):
+        ReportFrame._dispatch(frame[0], frame, ReportFrame.KIND_SIZE, report_handler)
+
+    @staticmethod
+    def dispatch_payload(kind, payload, report_handler):
+        ReportFrame._dispatch(kind, payload, 0, report_handler)
+
+    @staticmethod
+    def _dispatch(kind, buffer, offset, report_handler):
+        payload_size = len(buffer) - offset
+        if kind == ReportFrame.KEYBOARD and payload_size == ReportFrame.KEYBOARD_PAYLOAD.size:
+            modifiers, keys, event_time_us, built_time_us = ReportFrame.KEYBOARD_PAYLOAD.unpack_from(buffer, offset)
+            report_handler.handle_keyboard_report(modifiers, keys, event_time_us, built_time_us)
+        elif kind == ReportFrame.KEYBOARD_NKRO and payload_size == ReportFrame.KEYBOARD_NKRO_PAYLOAD.size:
+            modifiers, keys, key_bitmap, event_time_us, built_time_us = ReportFrame.KEYBOARD_NKRO_PAYLOAD.unpack_from(buffer, offset)
+            report_handler.handle_keyboard_report(modifiers, keys, event_time_us, built_time_us, key_bitmap)
+        elif kind == ReportFrame.MOUSE and payload_size == ReportFrame.MOUSE_PAYLOAD.size:
+            buttons, x_pos, y_pos, v_wheel, h_wheel, event_time_us, built_time_us = ReportFrame.MOUSE_PAYLOAD.unpack_from(buffer, offset)
+            report_handler.handle_mouse_report(buttons, x_pos, y_pos, v_wheel, h_wheel, event_time_us, built_time_us)
+        else:
+            logging.warning(f"Channel: Dropping malformed report of kind {kind} with {payload_size} bytes")
+
+
+class ReportChannelServer(object):
+    def __init__(self, report_handler, socket_path=ReportFrame.SOCKET_PATH):
+        self._report_handler = report_handler
+        self._socket_path = socket_path
+        self._loop = asyncio.get_event_loop()
+        self._stop_event = False
+        self._connection_tasks = set()
+        self._link_stats_subscribers = set()
+
+    def stop(self):
+        self._stop_event = True
+
+    async def run(self):
+        server_socket = self._create_server_socket()
+        logging.info(f"Channel: Listening for report frames on {self._socket_path}")
+        link_stats_task = asyncio.create_task(self._publish_link_stats())
+        while not self._stop_event:
+            try:
+                connection, _ = await asyncio.wait_for(self._loop.sock_accept(server_socket), timeout=2)
+                connection.setblocking(False)
+                task = asyncio.create_task(self._serve_connection(connection))
+                self._connection_tasks.add(task)
+                task.add_done_callback(self._connection_tasks.discard)
+            except asyncio.TimeoutError:
+                pass
+        logging.info("Channel: Closing report channel")
+        link_stats_task.cancel()
+        server_socket.close()
+        for task in list(self._connection_tasks):
+            task.cancel()
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+        logging.info("Channel: Report channel finished")
+
+    def _create_server_socket(self):
+        os.makedirs(os.path.dirname(self._socket_path), exist_ok=True)
+        if os.path.exists(self._socket_path):
+            os.unlink(self._socket_path)
+        server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        server_socket.bind(self._socket_path)
+        # The input processes are not running as root
+        os.chmod(self._socket_path, 0o666)
+        server_socket.listen(5)
+        server_socket.setblocking(False)
+        return server_socket
+
+    async def _serve_connection(self, connection):
+        logging.info("Channel: Input process connected")
+        try:
+            while True:
+                frame = await self._loop.sock_recv(connection, ReportFrame.MAX_SIZE)
+                if not frame:
+                    break
+                if frame == ReportFrame.LINK_STATS_SUBSCRIPTION:
+                    self._link_stats_subscribers.add(connection)
+                    continue
+                ReportFrame.dispatch(frame, self._report_handler)
+        except OSError as e:
+            logging.warning(f"Channel: Connection error: {e}")
+        finally:
+            self._link_stats_subscribers.discard(connection)
+            connection.close()
+        logging.info("Channel: Input process disconnected")
+
+    async def _publish_link_stats(self):
+        while True:
+            await asyncio.sleep(ReportFrame.LINK_STATS_INTERVAL)
+            if not self._link_stats_subscribers:
+                continue
+            link_stats = self._report_handler.get_link_stats()
+            if not link_stats:
+                continue
+            drain_rate, queue_depth = link_stats
+            frame = ReportFrame.LINK_STATS_STRUCT.pack(ReportFrame.LINK_STATS, min(drain_rate, 0xFFFFFFFF), min(queue_depth, 0xFFFF))
+            for connection in list(self._link_stats_subscribers):
+                try:
+                    # Never wait on a slow subscriber - the next update follows soon
+                    connection.send(frame)
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    self._link_stats_subscribers.discard(connection)
+
+
+class KvmReportLink(object):
+    """Sends reports to the kvm_service.
+
+    The report channel socket is preferred. If the running kvm_service does not
+    provide it, the reports are sent via D-Bus. All reports which pile up while
+    a D-Bus message is written are batched into the next SendReports call. The
+    calls are sent without expecting a reply, so the input loop never waits on
+    the bus.
+
+    Link stats of the active host are only available via the report channel
+    and after subscribe_link_stats() has been called.
+    """
+    def __init__(self, name, socket_path=ReportFrame.SOCKET_PATH):
+        self._name = name
+        self._socket_path = socket_path
+        self._loop = asyncio.get_event_loop()
+        self._socket = None
+        self._bus = None
+        self._pending_reports = []
+        self._send_future = None
+        self._is_flush_scheduled = False
+        self._is_link_stats_subscribed = False
+        self._link_stats = None
+        self._link_stats_task = None
+
+    @property
+    def link_stats(self):
+        """Drain rate in reports per second and queue depth of the active host or None."""
+        return self._link_stats
+
+    def subscribe_link_stats(self):
+        self._is_link_stats_subscribed = True
+
+    @property
+    def is_connected(self):
+        if self._socket:
+            return True
+        return self._bus is not None and self._bus.connected
+
+    async def connect(self):
+        self._close()
+        while not self.is_connected:
+            if await self._connect_to_report_channel():
+                logging.info(f"{self._name}: Report channel connected")
+            elif await self._connect_to_dbus_service():
+                logging.info(f"{self._name}: Report channel not available - D-Bus service connected")
+            else:
+                logging.warning(f"{self._name}: D-Bus service not available - reconnecting...")
+                await asyncio.sleep(5)
+
+    async def _connect_to_report_channel(self):
+        channel_socket = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        channel_socket.setblocking(False)
+        try:
+            await self._loop.sock_connect(channel_socket, self._socket_path)
+        except OSError:
+            channel_socket.close()
+            return False
+        self._socket = channel_socket
+        if self._is_link_stats_subscribed:
+            await self._loop.sock_sendall(self._socket, ReportFrame.LINK_STATS_SUBSCRIPTION)
+            self._link_stats_task = asyncio.create_task(self._receive_link_stats())
+        return True
+
+    async def _receive_link_stats(self):
+        try:
+            while self._socket:
+                frame = await self._loop.sock_recv(self._socket, ReportFrame.LINK_STATS_STRUCT.size)
+                if not frame:
+                    break
+                if len(frame) == ReportFrame.LINK_STATS_STRUCT.size and frame[0] == ReportFrame.LINK_STATS:
+                    _, drain_rate, queue_depth = ReportFrame.LINK_STATS_STRUCT.unpack(frame)
+                    self._link_stats = (drain_rate, queue_depth)
+        except OSError:
+            pass
+        self._link_stats = None
+
+    async def _connect_to_dbus_service(self):
+        try:
+            bus = await MessageBus(bus_type=dbus_next.BusType.SYSTEM).connect()
+            # Ensure the KVM service is running before reports are sent into the void
+            await bus.introspect('org.rpi.kvmservice', '/org/rpi/kvmservice')
+            self._bus = bus
+            return True
+        except dbus_next.DBusError:
+            return False
+
+    def _close(self):
+        if self._link_stats_task:
+            self._link_stats_task.cancel()
+            self._link_stats_task = None
+        self._link_stats = None
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+        if self._bus:
+            self._bus.disconnect()
+            self._bus = None
+        self._pending_reports = []
+        self._send_future = None
+        self._is_flush_scheduled = False
+
+    async def send_keyboard(self, modifiers, keys, event_time_us=0, key_bitmap=None):
+        built_time_us = now_us() if event_time_us else 0
+        if key_bitmap is None:
+            if self._socket:
+                await self._send_frame(ReportFrame.encode_keyboard(modifiers, keys, event_time_us, built_time_us))
+            else:
+                await self._queue_dbus_report(ReportFrame.KEYBOARD, ReportFrame.encode_keyboard_payload(modifiers, keys, event_time_us, built_time_us))
+        elif self._socket:
+            await self._send_frame(ReportFrame.encode_keyboard_nkro(modifiers, keys, key_bitmap, event_time_us, built_time_us))
+        else:
+            await self._queue_dbus_report(ReportFrame.KEYBOARD_NKRO, ReportFrame.encode_keyboard_nkro_payload(modifiers, keys, key_bitmap, event_time_us, built_time_us))
+
+    async def send_mouse(self, buttons, x_pos, y_pos, v_wheel, h_wheel, event_time_us=0):
+        built_time_us = now_us() if event_time_us else 0
+        if self._socket:
+            await self._send_frame(ReportFrame.encode_mouse(buttons, x_pos, y_pos, v_wheel, h_wheel, event_time_us, built_time_us))
+        else:
+            await self._queue_dbus_report(ReportFrame.MOUSE, ReportFrame.encode_mouse_payload(buttons, x_pos, y_pos, v_wheel, h_wheel, event_time_us, built_time_us))
+
+    async def _send_frame(self, frame):
+        try:
+            await self._loop.sock_sendall(self._socket, frame)
+        except OSError:
+            logging.warning(f"{self._name}: Report channel terminated - reconnecting...")
+            await self.connect()
+
+    async def _queue_dbus_report(self, kind, payload):
+        if not self.is_connected:
+            logging.warning(f"{self._name}: D-Bus connection terminated - reconnecting...")
+            await self.connect()
+            if self._socket:
+                await self._send_frame(bytes([kind]) + payload)
+                return
+        self._pending_reports.append([kind, payload])
+        # Reports of the same evdev read batch are collected till the loop iteration ends
+        if not self._send_future and not self._is_flush_scheduled:
+            self._is_flush_scheduled = True
+            self._loop.call_soon(self._flush_dbus_reports)
+
+    def _on_dbus_message_written(self, future):
+        self._send_future = None
+        if future.cancelled() or future.exception():
+            logging.warning(f"{self._name}: D-Bus reports could not be sent")
+            return
+        self._flush_dbus_reports()
+
+    def _flush_dbus_reports(self):
+        self._is_flush_scheduled = False
+        if not self._pending_reports or not self.is_connected:
+            return
+        reports = self._pending_reports
+        self._pending_reports = []
+        message = Message(destination='org.rpi.kvmservice',
+                          path='/org/rpi/kvmservice',
+                          interface='org.rpi.kvmservice',
+                          member='SendReports',
+                          signature='a(yay)',
+                          body=[reports],
+                          flags=MessageFlag.NO_REPLY_EXPECTED)
+        # Reports arriving till the message is written are batched into the next message
+        self._send_future = self._bus.send(message)
+        self._send_future.add_done_callback(self._on_dbus_message_written)
+
+
+class DirectReportLink(object):
+    """Hands reports straight to the report handler running in the same process."""
+    def __init__(self, report_handler):
+        self._report_handler = report_handler
+
+    @property
+    def is_connected(self):
+        return True
+
+    @property
+    def link_stats(self):
+        return self._report_handler.get_link_stats()
+
+    def subscribe_link_stats(self):
+        pass
+
+    async def connect(self):
+        pass
+
+    async def send_keyboard(self, modifiers, keys, event_time_us=0, key_bitmap=None):
+        built_time_us = now_us() if event_time_us else 0
+        self._report_handler.handle_keyboard_report(modifiers, bytes(keys), event_time_us, built_time_us,
+            bytes(key_bitmap) if key_bitmap is not None else None)
+
+    async def send_mouse(self, buttons, x_pos, y_pos, v_wheel, h_wheel, event_time_us=0):
+        built_time_us = now_us() if event_time_us else 0
+        self._report_handler.handle_mouse_report(buttons, x_pos, y_pos, v_wheel, h_wheel, event_time_us, built_time_us)
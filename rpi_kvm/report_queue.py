@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+
+import asyncio
+import collections
+
+class ReportQueue(object):
+    """Send queue of one bluetooth client which knows the report types.
+
+    All reports are sent in the order they were queued with one exception:
+    a keyboard report moves ahead of queued pure mouse motion. Keyboard
+    reports and mouse reports changing the buttons are never reordered or
+    dropped, so key taps and clicks (e.g. Ctrl+click) reach the host in order.
+    Only motion is merged or dropped: consecutive motion reports are merged
+    into one, so a stalled link does not replay a burst of stale motion once
+    it recovers. Beyond max_depth the oldest motion is dropped, without motion
+    the queue grows past max_depth.
+    Reports are stored as bytes ready to be sent.
+    """
+    MOUSE_REPORT_IDS = (2, 3)
+    # Value range of the motion fields per mouse report id: x, y, v-wheel, h-wheel
+    MOUSE_FIELD_LIMITS = {
+        2: (127, 127, 127, 127),
+        3: (32767, 32767, 127, 127),
+    }
+    MAX_DEPTH = 64
+    # Kinds of the queued entries
+    KEYBOARD = 0
+    MOUSE_MOTION = 1
+    MOUSE_BUTTONS = 2
+    ALIVE = 3
+    # Sent periodically to notice a broken connection, not a HID report
+    ALIVE_MESSAGE = bytes([0, 0, 0, 0])
+
+    def __init__(self, max_depth=MAX_DEPTH):
+        self._max_depth = max_depth
+        # Entries: [message, enqueue time, event time, kind]
+        self._reports = collections.deque()
+        # Buttons of the last queued mouse report and its entry while it is queued
+        self._mouse_buttons = 0
+        self._last_mouse_entry = None
+        self._waiter = None
+        self.collapsed_keyboard_reports = 0
+        self.dropped_mouse_reports = 0
+        self.merged_mouse_reports = 0
+
+    def __len__(self):
+        return len(self._reports)
+
+    def clear(self):
+        self._reports.clear()
+        # A new connection starts without pressed buttons
+        self._mouse_buttons = 0
+        self._last_mouse_entry = None
+
+    @property
+    def stats(self):
+        stats_dict = {}
+        stats_dict["depth"] = len(self)
+        stats_dict["collapsedKeyboardReports"] = self.collapsed_keyboard_reports
+        stats_dict["droppedMouseReports"] = self.dropped_mouse_reports
+        stats_dict["mergedMouseReports"] = self.merged_mouse_reports
+        return stats_dict
+
+    def put(self, message, enqueue_time_us=0, event_time_us=0):
+        report_id = message[1] if len(message) > 1 else 0
+        if report_id in ReportQueue.MOUSE_REPORT_IDS:
+            if message[2] != self._mouse_buttons:
+                self._mouse_buttons = message[2]
+                kind = ReportQueue.MOUSE_BUTTONS
+            else:
+                kind = ReportQueue.MOUSE_MOTION
+                if self._last_mouse_entry and self._merge_mouse_report(self._last_mouse_entry, message, event_time_us):
+                    self.merged_mouse_reports += 1
+                    return
+            self._make_room()
+            self._last_mouse_entry = [bytes(message), enqueue_time_us, event_time_us, kind]
+            self._reports.append(self._last_mouse_entry)
+        elif bytes(message) == ReportQueue.ALIVE_MESSAGE:
+            # Waiting reports check the connection as well
+            if self._reports:
+                return
+            self._reports.append([ReportQueue.ALIVE_MESSAGE, enqueue_time_us, event_time_us, ReportQueue.ALIVE])
+        else:
+            # Keyboard reports keep their order and only move ahead of the pure
+            # motion at the end of the queue
+            index = len(self._reports)
+            while index and self._reports[index - 1][3] == ReportQueue.MOUSE_MOTION:
+                index -= 1
+            # A repeated key state changes nothing on the host
+            if index and self._reports[index - 1][3] == ReportQueue.KEYBOARD and self._reports[index - 1][0] == bytes(message):
+                self.collapsed_keyboard_reports += 1
+                return
+            self._make_room()
+            self._reports.insert(index, [bytes(message), enqueue_time_us, event_time_us, ReportQueue.KEYBOARD])
+        self.wake()
+
+    def wake(self):
+        """Resumes a pending wait_ready, also used to notice a stop or disconnect."""
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def get_nowait(self):
+        if not self._reports:
+            raise asyncio.QueueEmpty()
+        entry = self._reports.popleft()
+        if entry is self._last_mouse_entry:
+            self._last_mouse_entry = None
+        return tuple(entry[:3])
+
+    async def wait_ready(self):
+        """Waits till reports are queued or wake is called - without a timer."""
+        if len(self):
+            return
+        self._waiter = asyncio.get_running_loop().create_future()
+        await self._waiter
+
+    def _make_room(self):
+        if len(self) < self._max_depth:
+            return
+        # Only motion is dropped, key and button reports are kept even beyond the depth
+        for index, entry in enumerate(self._reports):
+            if entry[3] == ReportQueue.MOUSE_MOTION:
+                del self._reports[index]
+                if entry is self._last_mouse_entry:
+                    self._last_mouse_entry = None
+                self.dropped_mouse_reports += 1
+                return
+
+    @staticmethod
+    def _merge_mouse_report(entry, message, event_time_us):
+        queued = entry[0]
+        # Motion is only merged into motion, button changes keep their position
+        if entry[3] != ReportQueue.MOUSE_MOTION or queued[1] != message[1] or queued[2] != message[2]:
+            return False
+        report_id = message[1]
+        queued_fields = ReportQueue._decode_mouse_fields(queued)
+        new_fields = ReportQueue._decode_mouse_fields(message)
+        merged_fields = [queued_field + new_field for queued_field, new_field in zip(queued_fields, new_fields)]
+        for merged_field, limit in zip(merged_fields, ReportQueue.MOUSE_FIELD_LIMITS[report_id]):
+            if abs(merged_field) > limit:
+                return False
+        entry[0] = ReportQueue._encode_mouse_report(report_id, queued[2], merged_fields)
+        # The enqueue and event time of the oldest merged report are kept
+        if not entry[2]:
+            entry[2] = event_time_us
+        return True
+
+    @staticmethod
+    def _to_signed(value, bits):
+        return value - (1 << bits) if value >= (1 << (bits - 1)) else value
+
+    @staticmethod
+    def _decode_mouse_fields(message):
+        if message[1] == 2:
+            # 0xA1, 0x02, buttons, x, y, v-wheel, h-wheel
+            return [ReportQueue._to_signed(value, 8) for value in message[3:7]]
+        # 0xA1, 0x03, buttons, x low, x high, y low, y high, v-wheel, h-wheel
+        return [
+            ReportQueue._to_signed(message[3] | (message[4] << 8), 16),
+            ReportQueue._to_signed(message[5] | (message[6] << 8), 16),
+            ReportQueue._to_signed(message[7], 8),
+            ReportQueue._to_signed(message[8], 8)]
+
+    @staticmethod
+    def _encode_mouse_report(report_id, buttons_int, fields):
+        x_pos, y_pos, v_wheel, h_wheel = fields
+        if report_id == 2:
+            return bytes([0xA1, 2, buttons_int, x_pos & 255, y_pos & 255, v_wheel & 255, h_wheel & 255])
+        return bytes([0xA1, 3, buttons_int,
+            x_pos & 255, (x_pos >> 8) & 255,
+            y_pos & 255, (y_pos >> 8) & 255,
+            v_wheel & 255, h_wheel & 255])
+
+if __name__ == "__main__":
+    # Stall the link with a burst of motion and key presses and check the queue rules
+    queue = ReportQueue(max_depth=32)
+    queue.put([0xA1, 1, 0, 0, 4, 0, 0, 0, 0, 0])
+    for _ in range(100):
+        queue.put([0xA1, 2, 0, 10, 256 - 10, 0, 0])
+    queue.put([0xA1, 1, 0, 0, 0, 0, 0, 0, 0, 0])
+    for _ in range(100):
+        queue.put([0xA1, 2, 1, 10, 0, 0, 0])
+    reports = []
+    while len(queue):
+        reports.append(queue.get_nowait()[0])
+    print(reports[0] == bytes([0xA1, 1, 0, 0, 4, 0, 0, 0, 0, 0]))
+    print(reports[1] == bytes([0xA1, 1, 0, 0, 0, 0, 0, 0, 0, 0]))
+    mouse_reports = reports[2:]
+    print(sum(ReportQueue._decode_mouse_fields(report)[0] for report in mouse_reports) == 2000)
+    print(mouse_reports[8][2] == 0 and all(report[2] == 1 for report in mouse_reports[9:]))
+    print(queue.dropped_mouse_reports == 0 and queue.collapsed_keyboard_reports == 0)
+    # Ctrl+click keeps its order, key reports only pass the motion
+    queue = ReportQueue()
+    queue.put([0xA1, 2, 0, 5, 0, 0, 0])
+    queue.put([0xA1, 1, 1, 0, 0, 0, 0, 0, 0, 0])
+    queue.put([0xA1, 2, 1, 0, 0, 0, 0])
+    queue.put([0xA1, 2, 0, 0, 0, 0, 0])
+    queue.put([0xA1, 2, 0, 5, 0, 0, 0])
+    queue.put([0xA1, 1, 0, 0, 0, 0, 0, 0, 0, 0])
+    reports = [queue.get_nowait()[0] for _ in range(len(queue))]
+    print([report[1:3] for report in reports] == [bytes([1, 1]), bytes([2, 0]), bytes([2, 1]), bytes([2, 0]), bytes([1, 0]), bytes([2, 0])])
+    # A full queue drops motion, never button changes
+    queue = ReportQueue(max_depth=4)
+    for index in range(10):
+        queue.put([0xA1, 2, (index + 1) & 1, 0, 0, 0, 0])
+        queue.put([0xA1, 1, 0, 0, 4, 0, 0, 0, 0, 0])
+    reports = [queue.get_nowait()[0] for _ in range(len(queue))]
+    print([report[2] for report in reports if report[1] == 2] == [1, 0] * 5)
+    # Key taps are never dropped, repeated key states and alive messages behind reports are
+    queue = ReportQueue(max_depth=4)
+    queue.put(ReportQueue.ALIVE_MESSAGE)
+    for _ in range(10):
+        queue.put([0xA1, 1, 0, 0, 4, 0, 0, 0, 0, 0])
+        queue.put([0xA1, 1, 0, 0, 4, 0, 0, 0, 0, 0])
+        queue.put(ReportQueue.ALIVE_MESSAGE)
+        queue.put([0xA1, 1, 0, 0, 0, 0, 0, 0, 0, 0])
+    reports = [queue.get_nowait()[0] for _ in range(len(queue))]
+    print(reports[0] == ReportQueue.ALIVE_MESSAGE and [report[4] for report in reports[1:]] == [4, 0] * 10)
+    print(queue.collapsed_keyboard_reports == 10)
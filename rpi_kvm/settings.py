@@ -3,6 +3,7 @@
 import os
 import json
 import logging
+from persistence import JsonFileWriter
 
 class Settings(object):
     PATH_TO_FILE = "./conf/rpi-kvm-settings.json"
@@ -25,9 +26,44 @@ class Settings(object):
                             #[False, False, False, False, False, False, False, False]
                 "nextHost": [[False, False, False, False, False, False, False, False],
                             # 6 pressed keys
-                            71, 0, 0, 0, 0, 0] # KEY_SCROLLLOCK 71
+                            71, 0, 0, 0, 0, 0], # KEY_SCROLLLOCK 71
+                # Further hotkeys, each a list of strokes pressed one after another
+                # in the format of nextHost. Actions:
+                # "SwitchToHost" with "host": 1 based position of the connected host
+                # "SwitchToPreviousHost", "SwitchToNextHost", "IndicateHost"
+                # e.g. Left Control + Left Alt + 1 switches to the first host:
+                # {"action": "SwitchToHost", "host": 1, "strokes": [[[False, False, False, False, False, True, False, True], 30, 0, 0, 0, 0, 0]]}
+                # e.g. double tap of Pause switches to the previous host:
+                # {"action": "SwitchToPreviousHost", "strokes": [[[False, False, False, False, False, False, False, False], 72], [[False, False, False, False, False, False, False, False], 72]]}
+                "bindings": [],
+                # Seconds till the next stroke of a sequence has to be pressed
+                "sequenceTimeout": 1.0
+            },
+            "hid": {
+                # Mouse report for hosts without an entry in hostReportModes
+                # "8bit": report id 2 with 8 bit movement
+                # "16bit": report id 3 with 16 bit movement. The host has to be paired
+                #          with the current SDP record to know this report.
+                "mouseReport": "8bit",
+                # Keyboard report for hosts without an entry in hostReportModes
+                # "6kro": boot keyboard report id 1 with 6 key slots, understood by every host
+                # "nkro": report id 4 with a bitmap of all pressed keys. The host has to be
+                #         paired with the current SDP record to know this report.
+                "keyboardReport": "6kro",
+                # true: one keyboard report per evdev frame (SYN_REPORT), e.g. a chord is one report
+                # false: one report per key change like before, for hosts missing keys of a chord
+                "keyboardFrameBatching": True,
+                # Report modes per host address
+                # e.g. "00:1A:7D:DA:71:11": {"mouseReport": "16bit", "keyboardReport": "nkro"}
+                "hostReportModes": {},
+                # Input devices by name or "vendor:product" id (hex), e.g. "046d:c52b"
+                # allowDevices: used as keyboard even if not classified as keyboard or mouse
+                # denyDevices: never used
+                "allowDevices": [],
+                "denyDevices": []
             }
         }
+        self._file_writer = JsonFileWriter(Settings.PATH_TO_FILE, self.as_dict)
 
     def __getitem__(self, key):
         return self._settings_dict[key]
@@ -63,10 +99,13 @@ class Settings(object):
             return False
 
     def save_to_file(self):
-        file_content = json.dumps(self._settings_dict, indent=4)
-        with open(Settings.PATH_TO_FILE, 'w') as f:
-            f.write(file_content)
-        logging.info(f"Settings written to: {Settings.PATH_TO_FILE}")
+        # Written in the background, see flush
+        self._file_writer.save()
+        logging.info(f"Settings saved to: {Settings.PATH_TO_FILE}")
+
+    async def flush(self):
+        """Waits till the saved settings are on disk, e.g. before other processes reload them."""
+        await self._file_writer.flush()
 
     def load_from_file(self):
         if not os.path.exists(Settings.PATH_TO_FILE):
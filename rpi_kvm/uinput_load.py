@@ -0,0 +1,149 @@
+#!/usr/bin/python3
+
+import os
+import math
+import random
+import asyncio
+import logging
+import argparse
+from evdev import UInput, ecodes
+
+# Keys of the virtual keyboards - letters and space make them keyboards for the DeviceClassifier
+LETTER_KEYS = [getattr(ecodes, f"KEY_{letter}") for letter in "ABCDEFGHIJKLMNOPQRSTUVWXYZ"]
+DIGIT_KEYS = [getattr(ecodes, f"KEY_{digit}") for digit in "0123456789"]
+KEYBOARD_KEYS = LETTER_KEYS + DIGIT_KEYS + [ecodes.KEY_SPACE, ecodes.KEY_ENTER, ecodes.KEY_LEFTSHIFT]
+MOUSE_BUTTONS = [ecodes.BTN_LEFT, ecodes.BTN_RIGHT, ecodes.BTN_MIDDLE]
+MOUSE_AXES = [ecodes.REL_X, ecodes.REL_Y, ecodes.REL_WHEEL]
+# pid.codes test ids, the devices are matched like real ones by HidScanner
+LOAD_VENDOR = 0x1209
+LOAD_KEYBOARD_PRODUCT = 0x0001
+LOAD_MOUSE_PRODUCT = 0x0002
+CIRCLE_STEPS = 64
+
+def char_to_stroke(char):
+    """Returns (key code, shifted) for the characters the virtual keyboards can type, otherwise None."""
+    if char == " ":
+        return ecodes.KEY_SPACE, False
+    if char == "\n":
+        return ecodes.KEY_ENTER, False
+    if char.isascii() and char.isalnum():
+        return getattr(ecodes, f"KEY_{char.upper()}"), char.isupper()
+    return None
+
+def key_frames(text, rng):
+    """Endless frames (lists of (type, code, value)) typing the text or random letters.
+    A key stroke is a press frame followed by a release frame."""
+    strokes = [stroke for stroke in map(char_to_stroke, text) if stroke] if text else None
+    while True:
+        if strokes:
+            for key, shifted in strokes:
+                yield from stroke_frames(key, shifted)
+        else:
+            yield from stroke_frames(rng.choice(LETTER_KEYS), False)
+
+def stroke_frames(key, shifted):
+    if shifted:
+        yield [(ecodes.EV_KEY, ecodes.KEY_LEFTSHIFT, 1), (ecodes.EV_KEY, key, 1)]
+        yield [(ecodes.EV_KEY, key, 0), (ecodes.EV_KEY, ecodes.KEY_LEFTSHIFT, 0)]
+    else:
+        yield [(ecodes.EV_KEY, key, 1)]
+        yield [(ecodes.EV_KEY, key, 0)]
+
+def motion_frames(pattern, rng):
+    """Endless mouse motion frames, random jitter or a circle."""
+    if pattern == "circle":
+        # Rounded deltas between the points of the circle, so the pointer returns to the start
+        points = [(round(100 * math.cos(2 * math.pi * i / CIRCLE_STEPS)), round(100 * math.sin(2 * math.pi * i / CIRCLE_STEPS))) for i in range(CIRCLE_STEPS + 1)]
+        deltas = [(x1 - x0, y1 - y0) for (x0, y0), (x1, y1) in zip(points, points[1:])]
+        while True:
+            for x_pos, y_pos in deltas:
+                yield [(ecodes.EV_REL, ecodes.REL_X, x_pos), (ecodes.EV_REL, ecodes.REL_Y, y_pos)]
+    while True:
+        yield [(ecodes.EV_REL, ecodes.REL_X, rng.randint(-10, 10)), (ecodes.EV_REL, ecodes.REL_Y, rng.randint(-10, 10))]
+
+class LoadDevice(object):
+    """Virtual input device emitting frames at a fixed rate.
+
+    Frames falling due while the event loop was busy or above the timer
+    resolution are emitted right after each other, so the average rate holds
+    also for an 8000 Hz mouse.
+    """
+    def __init__(self, uinput, rate_hz, frames):
+        self._uinput = uinput
+        self._rate_hz = rate_hz
+        self._frames = frames
+        self.frame_count = 0
+
+    @property
+    def name(self):
+        return self._uinput.name
+
+    async def run(self, duration_s=None):
+        loop = asyncio.get_running_loop()
+        interval = 1 / self._rate_hz
+        next_time = loop.time()
+        end_time = next_time + duration_s if duration_s else None
+        while end_time is None or next_time < end_time:
+            # Also yields if behind - other devices keep their rate
+            await asyncio.sleep(max(0, next_time - loop.time()))
+            for event_type, code, value in next(self._frames):
+                self._uinput.write(event_type, code, value)
+            self._uinput.syn()
+            self.frame_count += 1
+            next_time += interval
+
+    def close(self):
+        self._uinput.close()
+
+def create_keyboard(index, key_rate, text, rng):
+    uinput = UInput({ecodes.EV_KEY: KEYBOARD_KEYS}, name=f"RPi KVM load keyboard {index}",
+        vendor=LOAD_VENDOR, product=LOAD_KEYBOARD_PRODUCT)
+    # Every key stroke consists of a press and a release frame
+    return LoadDevice(uinput, key_rate * 2, key_frames(text, rng))
+
+def create_mouse(index, mouse_rate, pattern, rng):
+    uinput = UInput({ecodes.EV_KEY: MOUSE_BUTTONS, ecodes.EV_REL: MOUSE_AXES}, name=f"RPi KVM load mouse {index}",
+        vendor=LOAD_VENDOR, product=LOAD_MOUSE_PRODUCT)
+    return LoadDevice(uinput, mouse_rate, motion_frames(pattern, rng))
+
+async def run_load(args):
+    rng = random.Random(args.seed)
+    devices = [create_keyboard(index, args.key_rate, args.text, rng) for index in range(args.keyboards)]
+    devices += [create_mouse(index, args.mouse_rate, args.pattern, rng) for index in range(args.mice)]
+    # Gives the KVM time to pick up the devices before the load starts
+    logging.info(f"Load: Created {len(devices)} devices, starting in {args.delay} s")
+    await asyncio.sleep(args.delay)
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
+    try:
+        await asyncio.gather(*[device.run(args.duration) for device in devices])
+    finally:
+        duration_s = loop.time() - start_time
+        for device in devices:
+            logging.info(f"Load: {device.name}: {device.frame_count} frames ({device.frame_count / duration_s:.0f} frames/s)")
+            device.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Creates virtual keyboards and mice via /dev/uinput and drives them at fixed rates")
+    parser.add_argument("--keyboards", type=int, default=1, help="Number of virtual keyboards")
+    parser.add_argument("--mice", type=int, default=1, help="Number of virtual mice")
+    parser.add_argument("--key-rate", type=float, default=200, help="Key strokes per second and keyboard")
+    parser.add_argument("--mouse-rate", type=float, default=1000, help="Motion frames per second and mouse, e.g. 8000")
+    parser.add_argument("--text", default="", help="Text typed repeatedly instead of random letters (letters, digits, space, newline)")
+    parser.add_argument("--pattern", choices=["random", "circle"], default="random", help="Mouse motion")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds of load, 0 runs till Ctrl+C")
+    parser.add_argument("--delay", type=float, default=2, help="Seconds between creating the devices and the load")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the random streams")
+    args = parser.parse_args()
+    logging.basicConfig(format='Load %(levelname)s: %(message)s', level=logging.INFO)
+
+    if not os.access("/dev/uinput", os.W_OK):
+        logging.error("No write access to /dev/uinput: Execute as root or with sudo")
+        return
+    try:
+        asyncio.run( run_load(args) )
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,3 @@
-import logging
-
 class UsbHidDecoder(object):
     # Python translation of the USB - HID Usage Tables:
     # https://www.usb.org/sites/default/files/documents/hut1_12v2.pdf
@@ -187,17 +185,6 @@ class UsbHidDecoder(object):
         "KEY_CALC": 251
     }
 
-    MODIFIER_KEYS_BIT_MASK_INDEX = {
-        "KEY_RIGHTMETA": 0,
-        "KEY_RIGHTALT": 1,
-        "KEY_RIGHTSHIFT": 2,
-        "KEY_RIGHTCTRL": 3,
-        "KEY_LEFTMETA": 4,
-        "KEY_LEFTALT": 5,
-        "KEY_LEFTSHIFT": 6,
-        "KEY_LEFTCTRL": 7
-    }
-
     MODIFIER_KEYS_BIT_MASK_VALUE = {
         "KEY_RIGHTMETA": 0x80,
         "KEY_RIGHTALT": 0x40,
@@ -211,12 +198,25 @@ class UsbHidDecoder(object):
 
     BIT_MASK = [0x80, 0x40, 0x20, 0x10, 0x08, 0x04, 0x02, 0x01]
 
+    # Marks the modifier keys inside the evdev lookup table, the lower byte holds the modifier bit
+    MODIFIER_KEY_FLAG = 0x100
+
     @staticmethod
-    def is_modifier_key(evdev_keycode):
-        if type(evdev_keycode) == list:
-            return False
-        else:
-            return (evdev_keycode in UsbHidDecoder.MODIFIER_KEYS_BIT_MASK_INDEX)
+    def build_evdev_lookup_table(evdev_key_names, evdev_key_max):
+        """Flat table indexed by the evdev key code. An entry holds the usb key code,
+        the modifier bit combined with MODIFIER_KEY_FLAG or 0 for unmapped keys."""
+        lookup_table = [0] * (evdev_key_max + 1)
+        for evdev_code, evdev_keycode in evdev_key_names.items():
+            if evdev_code > evdev_key_max:
+                continue
+            for keycode in (evdev_keycode if type(evdev_keycode) == list else [evdev_keycode]):
+                if keycode in UsbHidDecoder.MODIFIER_KEYS_BIT_MASK_VALUE:
+                    lookup_table[evdev_code] = UsbHidDecoder.MODIFIER_KEY_FLAG | UsbHidDecoder.MODIFIER_KEYS_BIT_MASK_VALUE[keycode]
+                    break
+                if keycode in UsbHidDecoder.KEY_CODES:
+                    lookup_table[evdev_code] = UsbHidDecoder.KEY_CODES[keycode]
+                    break
+        return lookup_table
 
     @staticmethod
     def convert_modifier_bit_mask_to_int(modifier_bit_mask):
@@ -225,25 +225,6 @@ class UsbHidDecoder(object):
             if modifier_bit_mask[i]: modifier_int += UsbHidDecoder.BIT_MASK[i]
         return modifier_int
 
-    @staticmethod
-    def encode_regular_key(evdev_keycode):
-        if type(evdev_keycode) == list:
-            for keycode in evdev_keycode:
-                if keycode in UsbHidDecoder.KEY_CODES:
-                    return UsbHidDecoder.KEY_CODES[keycode]
-            logging.error(f"USB-HID: Keycode '{evdev_keycode}' could not be mapped to an usb integer value")
-            return 0
-        else:
-            if evdev_keycode in UsbHidDecoder.KEY_CODES:
-                return UsbHidDecoder.KEY_CODES[evdev_keycode]
-            else:
-                logging.error(f"USB-HID: Keycode '{evdev_keycode}' could not be mapped to an usb integer value")
-                return 0
-
-    @staticmethod
-    def encode_modifier_key_index(evdev_keycode):
-        return UsbHidDecoder.MODIFIER_KEYS_BIT_MASK_INDEX[evdev_keycode]
-
     @staticmethod
     def encode_mouse_button_index(evdev_event_code):
         if evdev_event_code >= 272 and evdev_event_code <= 276:
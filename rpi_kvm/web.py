@@ -14,8 +14,9 @@ from usb_hid_decoder import UsbHidDecoder
 from clipboard import Clipboard
 
 class WebServer(object):
-    def __init__(self, settings):
+    def __init__(self, settings, kvm_dbus_iface=None):
         self._settings = settings
+        self._kvm_dbus_iface = kvm_dbus_iface
         self._server_url = ""
         self._is_alive = False
         self._server_future = None
@@ -35,6 +36,7 @@ class WebServer(object):
         self._app.add_routes([web.post('/set_settings', self.set_settings)])
         self._app.add_routes([web.post('/restart_service', self.restart_service)])
         self._app.add_routes([web.get('/get_keyboard_codes', self.get_keyboard_codes)])
+        self._app.add_routes([web.get('/latency_stats', self.get_latency_stats)])
         self._app.add_routes([web.get('/is_update_available', self.is_update_available)])
         self._app.add_routes([web.get('/perform_update', self.perform_update)])
         self._app.add_routes([web.get('/clipboard-socket', self._clipboard.websocket_handler)])
@@ -68,6 +70,14 @@ class WebServer(object):
             await self._connect_to_dbus_service()
             await self._fetch_bt_clients()
 
+    async def _fetch_latency_stats(self):
+        try:
+            return await self._kvm_dbus_iface.call_get_latency_stats()
+        except dbus_next.DBusError:
+            logging.warning(f"D-Bus connection terminated - reconnecting...")
+            await self._connect_to_dbus_service()
+            return await self._fetch_latency_stats()
+
     async def _connect_bt_client(self, client_address):
         try:
             await self._kvm_dbus_iface.call_connect_client(client_address)
@@ -125,8 +135,9 @@ class WebServer(object):
             await self._trigger_restart_info_hub()
 
     async def run(self):
-        logging.info(f"D-Bus service connecting...")
-        await self._connect_to_dbus_service()
+        if not self._kvm_dbus_iface:
+            logging.info(f"D-Bus service connecting...")
+            await self._connect_to_dbus_service()
 
         self._is_alive = True
         while self._is_alive:
@@ -163,6 +174,10 @@ class WebServer(object):
         print('BT-Clients: websocket connection closed')
         return ws
 
+    async def get_latency_stats(self, request):
+        latency_stats = await self._fetch_latency_stats()
+        return web.Response(text=latency_stats)
+
     async def connect_client(self, request):
         data = await request.json()
         await self._connect_bt_client(data['clientAddress'])
@@ -196,6 +211,8 @@ class WebServer(object):
         if "settings" in data:
             has_changed = self._settings.apply_settings_from_dict(data["settings"])
             if has_changed:
+                # The KVM service reloads the settings from the file
+                await self._settings.flush()
                 await self._trigger_reload_settings()
         return web.Response()
 
@@ -22,9 +22,21 @@ initRpiKvmTmux()
 	tmux select-pane -t rpi-kvm:kvm.0
 }
 
+initRpiKvmSingleProcessTmux()
+{
+    tmux new-session -s rpi-kvm -n kvm -d
+    # Remember the mode for restarts via 'rpi-kvm.sh restart'
+    tmux set-environment -t rpi-kvm RPI_KVM_MODE single
+    tmux send-keys -t rpi-kvm:kvm.0 'cd $RPI_KVM_PATH && reset && sudo ./rpi_kvm/all_in_one.py' C-m
+}
+
 tmux has-session -t rpi-kvm 2>/dev/null
 
 # Tmux session does not exist -> Create one
 if [ $? != 0 ]; then
-    initRpiKvmTmux
+    if [ "$1" == "single" ]; then
+        initRpiKvmSingleProcessTmux
+    else
+        initRpiKvmTmux
+    fi
 fi
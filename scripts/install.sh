@@ -13,7 +13,7 @@ sudo apt-get install git tmux python-is-python3 python3 python3-dev python3-pip
 echo "Install required bluetooth packages via apt-get"
 sudo apt-get install bluez bluez-tools bluez-firmware python3-bluez -y
 echo "Install required python packages via apt-get"
-sudo apt-get install python3-pyudev python3-evdev python3-dbus python3-dbus-next python3-aiohttp python3-rpi.gpio python3-numpy python3-gi -y
+sudo apt-get install python3-pyudev python3-evdev python3-dbus python3-dbus-next python3-aiohttp python3-rpi.gpio python3-gi -y
 echo "Install nodejs"
 sudo apt-get update
 sudo apt-get install -y ca-certificates curl gnupg